@@ -0,0 +1,113 @@
+"""Measure how many completions burst coalescing saves.
+
+Simulates private chats whose users send messages in bursts (a few messages
+with short gaps, then a pause) through telegramClient.process_message, with
+the local DynamoDB stand-in and a completion that only sleeps. Reports the
+completions, the coalescing rate and the time from a message to the end of
+the completion that answers it, without coalescing and with the window.
+
+    python benchmark_coalescing.py [--chats 20] [--bursts 5] [--window 1] [--completion-ms 800]
+"""
+import argparse
+import os
+import random
+import threading
+import time
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("DYNAMODB_TABLE_NAME", "history")
+os.environ.setdefault("CONTEXT_LENGTH", "50")
+os.environ.setdefault("BOT_ID", "1")
+os.environ.setdefault("BOT_NAME", "benchmark_bot")
+os.environ.setdefault("TELEGRAM_TOKEN", "token")
+os.environ.setdefault("FREQUENCY", "0")
+os.environ.setdefault("ALLOWED_CHATS", ",".join(str(chat_id) for chat_id in range(1, 1001)))
+os.environ.setdefault("RESET_COMMAND", "reset")
+os.environ.setdefault("OPENAI_KEY", "key")
+os.environ.setdefault("TEMPERATURE", "1")
+os.environ.setdefault("MAX_TOKENS", "100")
+os.environ.setdefault("METRICS_ENABLED", "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import telegram_client
+from dinamodb_client import dynamoDBClient
+from local_dynamodb import localDynamoDBResource
+
+
+def _percentile(values: list, percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def run(window: float, args) -> dict:
+    telegram_client.dynamoDB_client = dynamoDBClient(localDynamoDBResource(latency=args.rtt_ms / 1000))
+    bot = telegram_client.telegramClient(coalesce_window=window)
+    arrivals = {}
+    waits = []
+    completions = []
+    lock = threading.Lock()
+
+    def complete_chat(user_message, chat_id, bot_id, burst_ids=None, **kwargs):
+        time.sleep(args.completion_ms / 1000)
+        finished = time.monotonic()
+        with lock:
+            completions.append(chat_id)
+            waits.extend(finished - arrivals[(chat_id, message_id)] for message_id in burst_ids or [user_message["id"]])
+        return {"text": ""}
+
+    telegram_client.openai_client.complete_chat = complete_chat
+    telegram_client.openai_client.update_summary = lambda chat_id, bot_id: None
+
+    def chat(chat_id: int) -> None:
+        rng = random.Random(chat_id)
+        handlers = []
+        message_id = 0
+        for _ in range(args.bursts):
+            for _ in range(rng.randint(1, args.burst_size)):
+                message_id += 1
+                update = {"message": {"message_id": message_id, "from": {"id": chat_id, "is_bot": False, "username": "user"},
+                                      "chat": {"id": chat_id}, "text": f"message {message_id}"}}
+                with lock:
+                    arrivals[(chat_id, str(message_id))] = time.monotonic()
+                handlers.append(threading.Thread(target=bot.process_message, args=(update,)))
+                handlers[-1].start()
+                time.sleep(rng.uniform(0, 2 * args.gap))
+            time.sleep(window + args.pause)
+        for handler in handlers:
+            handler.join()
+
+    chats = [threading.Thread(target=chat, args=(chat_id,)) for chat_id in range(1, args.chats + 1)]
+    for thread in chats:
+        thread.start()
+    for thread in chats:
+        thread.join()
+    return {
+        "messages": len(arrivals),
+        "completions": len(completions),
+        "rate": 1 - len(completions) / len(arrivals),
+        "mean_ms": sum(waits) / len(waits) * 1000,
+        "p95_ms": _percentile(waits, 95) * 1000,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=20, help="chats sending messages at the same time (at most 1000)")
+    parser.add_argument("--bursts", type=int, default=5, help="bursts per chat")
+    parser.add_argument("--burst-size", type=int, default=5, help="most messages in a burst")
+    parser.add_argument("--gap", type=float, default=0.4, help="mean seconds between the messages of a burst")
+    parser.add_argument("--pause", type=float, default=2.0, help="seconds between bursts beyond the window")
+    parser.add_argument("--window", type=float, default=1.0, help="COALESCE_WINDOW to compare with no coalescing")
+    parser.add_argument("--completion-ms", type=float, default=800, help="duration of a completion")
+    parser.add_argument("--rtt-ms", type=float, default=5, help="simulated DynamoDB round trip")
+    args = parser.parse_args()
+
+    print(f"{'window':>7} {'messages':>9} {'completions':>12} {'coalesced':>10} {'mean ms':>9} {'p95 ms':>9}")
+    for window in (0.0, args.window):
+        result = run(window, args)
+        print(f"{window:>7.1f} {result['messages']:>9} {result['completions']:>12} {result['rate']:>9.0%} "
+              f"{result['mean_ms']:>9.0f} {result['p95_ms']:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Compare the legacy text encoding of histories with the binary one.
+
+Reports encode/decode time and stored size for realistic histories of 50 to
+500 messages (chat messages, long answers, tool calls and tool responses).
+
+    python benchmark_codec.py [--repeat 20]
+"""
+import argparse
+import json
+import random
+import string
+import time
+
+from history_codec import encode_history, decode_history, orjson
+
+HISTORY_LENGTHS = [50, 100, 250, 500]
+ITEM_LIMIT = 400 * 1024
+
+
+def _words(count: int) -> str:
+    return " ".join("".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9))) for _ in range(count))
+
+
+def _history(length: int) -> list:
+    messages = []
+    for index in range(length):
+        kind = random.random()
+        if kind < 0.05:
+            messages.append({
+                "role": "assistant", "content": None, "username": "legacy_user", "text": "",
+                "id": f"legacy-{index}", "reply_to_id": None, "images": [],
+                "tool_calls": [{"id": f"call_{index}", "type": "function", "function": {
+                    "name": "generate_image", "arguments": json.dumps({"prompt": _words(25)})}}],
+            })
+            messages.append({
+                "role": "tool", "tool_call_id": f"call_{index}", "username": "legacy_user", "text": "",
+                "id": f"legacy-{index}-tool", "reply_to_id": None, "images": [],
+                "content": json.dumps({"status": "image_generated", "prompt": _words(25), "mime_type": "image/png"}),
+            })
+        elif kind < 0.3:
+            messages.append({
+                "role": "assistant", "username": "bot", "text": _words(random.randint(40, 250)),
+                "id": f"{index}-assistant", "reply_to_id": str(index), "images": [], "tool_images_meta": [],
+            })
+        else:
+            messages.append({
+                "role": "user", "username": f"user{index % 9}", "text": _words(random.randint(3, 60)),
+                "id": str(index), "reply_to_id": str(index - 2) if index % 4 == 0 else None, "images": [],
+            })
+    return messages[:length]
+
+
+def _text_encode(messages: list) -> str:
+    return "\n\n".join(json.dumps(message) for message in messages)
+
+
+def _text_decode(data: str) -> list:
+    return [json.loads(raw) for raw in data.split("\n\n")]
+
+
+def _timed(function, argument, repeat: int):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = function(argument)
+    return result, (time.perf_counter() - started) * 1000 / repeat
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20, help="repetitions per measurement")
+    args = parser.parse_args()
+    random.seed(7)
+
+    print(f"JSON library: {'orjson' if orjson else 'json'}")
+    print(f"{'messages':>8} {'format':>6} {'size KB':>9} {'% of item':>9} {'encode ms':>10} {'decode ms':>10}")
+    for length in HISTORY_LENGTHS:
+        messages = _history(length)
+        for name, encode, decode in (("text", _text_encode, _text_decode), ("binary", encode_history, decode_history)):
+            encoded, encode_ms = _timed(encode, messages, args.repeat)
+            decoded, decode_ms = _timed(decode, encoded, args.repeat)
+            assert decoded == messages
+            size = len(encoded.encode("utf-8") if isinstance(encoded, str) else encoded)
+            print(f"{length:>8} {name:>6} {size / 1024:>9.1f} {size * 100 / ITEM_LIMIT:>9.1f} "
+                  f"{encode_ms:>10.2f} {decode_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
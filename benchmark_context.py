@@ -0,0 +1,77 @@
+"""Compare the prompt size of a fixed message window with a token budget.
+
+Replays synthetic group chats (mostly short messages, some long answers and
+now and then a pasted log) and reports the distribution of history tokens
+sent per request with the last CONTEXT_LENGTH messages and with the token
+budgeted selection.
+
+    python benchmark_context.py [--requests 2000] [--context-length 50] [--budget 8000]
+"""
+import argparse
+import json
+import os
+import random
+import string
+
+os.environ.setdefault("CONTEXT_TOKEN_BUDGET", "8000")
+
+from context_window import message_tokens, select_context, with_token_count
+
+
+def _words(count: int) -> str:
+    return " ".join("".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9))) for _ in range(count))
+
+
+def _message(index: int) -> list:
+    kind = random.random()
+    if kind < 0.02:
+        # A pasted log or document
+        return [with_token_count({"role": "user", "username": f"user{index % 9}", "text": _words(random.randint(1500, 6000)),
+                                  "id": str(index), "reply_to_id": None, "images": []})]
+    if kind < 0.05:
+        call_id = f"call_{index}"
+        return [
+            with_token_count({"role": "assistant", "content": None, "id": f"{index}-call", "tool_calls": [{
+                "id": call_id, "type": "function",
+                "function": {"name": "generate_image", "arguments": json.dumps({"prompt": _words(30)})}}]}),
+            with_token_count({"role": "tool", "tool_call_id": call_id, "id": f"{index}-tool",
+                              "content": json.dumps({"status": "image_generated", "prompt": _words(30)})}),
+        ]
+    if kind < 0.25:
+        return [with_token_count({"role": "assistant", "username": "bot", "text": _words(random.randint(40, 300)),
+                                  "id": f"{index}-assistant", "reply_to_id": str(index), "images": []})]
+    return [with_token_count({"role": "user", "username": f"user{index % 9}", "text": _words(random.randint(2, 40)),
+                              "id": str(index), "reply_to_id": None, "images": []})]
+
+
+def _percentile(values: list, percent: float) -> int:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="messages replayed")
+    parser.add_argument("--context-length", type=int, default=50, help="messages kept in storage")
+    parser.add_argument("--budget", type=int, default=int(os.environ["CONTEXT_TOKEN_BUDGET"]), help="history token budget")
+    args = parser.parse_args()
+    random.seed(3)
+
+    history: list = []
+    results = {"window": {"tokens": [], "messages": []}, "budget": {"tokens": [], "messages": []}}
+    for index in range(args.requests):
+        window = history[-args.context_length:]
+        for name, context in (("window", window), ("budget", select_context(window, args.budget))):
+            results[name]["tokens"].append(sum(message_tokens(message) for message in context))
+            results[name]["messages"].append(len(context))
+        history.extend(_message(index))
+
+    print(f"{'selection':>9} {'p50':>7} {'p90':>7} {'p99':>7} {'max':>7} {'messages':>9}")
+    for name, result in results.items():
+        tokens = result["tokens"]
+        print(f"{name:>9} {_percentile(tokens, 50):>7} {_percentile(tokens, 90):>7} {_percentile(tokens, 99):>7} "
+              f"{max(tokens):>7} {sum(result['messages']) / len(result['messages']):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
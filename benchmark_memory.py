@@ -0,0 +1,66 @@
+"""Measure the long-term memory index at 10k to 1M remembered messages.
+
+Reports the stored (segment) size, load time and top-k query time of a vectorIndex
+filled with random unit vectors, and the throughput of the local hashing
+embedder.
+
+    python benchmark_memory.py [--dimensions 256] [--queries 50] [--sizes 10000 100000 1000000]
+"""
+import argparse
+import random
+import string
+import time
+
+import numpy as np
+
+from chat_memory import hashingEmbedder, vectorIndex
+
+
+def _words(count: int) -> str:
+    return " ".join("".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9))) for _ in range(count))
+
+
+def _index(size: int, dimensions: int, rng: np.random.Generator) -> vectorIndex:
+    vectors = rng.standard_normal((size, dimensions), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    records = [{"id": str(index), "username": "user", "text": "x" * 80} for index in range(size)]
+    return vectorIndex(dimensions, vectors, records)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dimensions", type=int, default=256, help="vector dimensions")
+    parser.add_argument("--queries", type=int, default=50, help="queries per index size")
+    parser.add_argument("--top-k", type=int, default=5, help="results per query")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="index sizes")
+    args = parser.parse_args()
+    random.seed(5)
+    rng = np.random.default_rng(5)
+
+    embedder = hashingEmbedder(args.dimensions)
+    texts = [_words(random.randint(5, 60)) for _ in range(1000)]
+    started = time.perf_counter()
+    embedder.embed(texts)
+    print(f"hashing embedder: {len(texts) / (time.perf_counter() - started):.0f} messages/s")
+
+    print(f"{'messages':>9} {'vectors MB':>10} {'stored MB':>9} {'memory MB':>9} {'load ms':>8} {'query ms':>9}")
+    for size in args.sizes:
+        index = _index(size, args.dimensions, rng)
+        data = index.to_bytes()
+        started = time.perf_counter()
+        index = vectorIndex.from_bytes(data, args.dimensions)
+        load_ms = (time.perf_counter() - started) * 1000
+
+        queries = rng.standard_normal((args.queries, args.dimensions), dtype=np.float32)
+        timings = []
+        for query in queries:
+            started = time.perf_counter()
+            index.search(query / np.linalg.norm(query), args.top_k)
+            timings.append((time.perf_counter() - started) * 1000)
+        print(f"{size:>9} {index.nbytes() / 2**20:>10.1f} {len(data) / 2**20:>9.1f} "
+              f"{index.vectors.nbytes / 2**20:>9.1f} {load_ms:>8.0f} {float(np.median(timings)):>9.2f}")
+        del index, data
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Measure the cold start of the Lambda: importing lambda_function in a fresh interpreter.
+
+Every run starts a new Python process, imports the handler module with
+placeholder settings and reports the import time and the peak resident
+memory. --path measures another checkout, to compare before and after a change.
+
+    python benchmark_startup.py [--runs 10] [--path .]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Settings the modules read at import time, no request is sent
+ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "DYNAMODB_TABLE_NAME": "benchmark",
+    "CONTEXT_LENGTH": "10",
+    "BOT_ID": "1",
+    "BOT_NAME": "benchmark",
+    "TELEGRAM_TOKEN": "token",
+    "FREQUENCY": "0",
+    "ALLOWED_CHATS": "1",
+    "RESET_COMMAND": "reset",
+    "OPENAI_KEY": "key",
+    "OPENAI_MODEL": "model",
+    "TEMPERATURE": "1",
+    "MAX_TOKENS": "10",
+    "SYSTEM_PROMPT": "prompt",
+}
+
+PROBE = """
+import json, resource, time
+started = time.perf_counter()
+import lambda_function
+import_ms = (time.perf_counter() - started) * 1000
+print(json.dumps({"import_ms": import_ms, "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+"""
+
+
+def _run(path: str) -> dict:
+    environment = dict(os.environ, **ENVIRONMENT)
+    output = subprocess.run([sys.executable, "-c", PROBE], cwd=path, env=environment,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="fresh processes to start")
+    parser.add_argument("--path", default=os.path.dirname(os.path.abspath(__file__)), help="checkout to measure")
+    args = parser.parse_args()
+
+    # The first run warms the file system cache and is not counted
+    _run(args.path)
+    results = [_run(args.path) for _ in range(args.runs)]
+    import_ms = sorted(result["import_ms"] for result in results)
+    rss_mb = [result["rss_mb"] for result in results]
+    print(f"import lambda_function: median {statistics.median(import_ms):.0f} ms, "
+          f"min {import_ms[0]:.0f} ms, max {import_ms[-1]:.0f} ms over {args.runs} runs")
+    print(f"peak RSS: median {statistics.median(rss_mb):.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
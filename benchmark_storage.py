@@ -0,0 +1,76 @@
+"""Compare the blob and per-message items storage layouts.
+
+Runs the non-reply path (load the context, append one message, save) against
+the local DynamoDB stand-in and reports consumed write/read units, requests
+and latency per stored message at several context lengths.
+
+    python benchmark_storage.py [--messages 50] [--rtt-ms 5]
+"""
+import argparse
+import os
+import random
+import string
+import time
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("DYNAMODB_TABLE_NAME", "history")
+os.environ.setdefault("DYNAMODB_MESSAGES_TABLE_NAME", "messages")
+os.environ.setdefault("CONTEXT_LENGTH", "50")
+
+from dinamodb_client import dynamoDBClient, DYNAMODB_MESSAGES_TABLE_NAME
+from local_dynamodb import localDynamoDBResource
+
+CONTEXT_LENGTHS = [10, 50, 100, 200, 400]
+
+
+def _random_message(index: int) -> dict:
+    words = ["".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9))) for _ in range(random.randint(8, 90))]
+    return {
+        "role": "user",
+        "username": f"user{index % 7}",
+        "text": " ".join(words),
+        "id": str(index),
+        "reply_to_id": str(index - 1) if index % 3 == 0 else None,
+        "images": [],
+    }
+
+
+def run(layout: str, context_length: int, messages: int, rtt: float) -> dict:
+    resource = localDynamoDBResource({DYNAMODB_MESSAGES_TABLE_NAME: ("chat_id", "message_key")}, latency=rtt)
+    client = dynamoDBClient(resource, layout)
+    chat_key = "-100_1"
+    client.save_messages(chat_key, [_random_message(index) for index in range(context_length)])
+    resource.reset_stats()
+
+    started = time.perf_counter()
+    for index in range(context_length, context_length + messages):
+        previous_messages = client.load_messages(chat_key, limit=context_length)
+        client.save_messages(chat_key, previous_messages[-(context_length - 1):] + [_random_message(index)])
+    elapsed = time.perf_counter() - started
+
+    tables = resource.tables.values()
+    return {
+        "wcu": sum(table.write_units for table in tables) / messages,
+        "rcu": sum(table.read_units for table in tables) / messages,
+        "requests": resource.request_count / messages,
+        "ms": elapsed * 1000 / messages,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=50, help="messages appended per run")
+    parser.add_argument("--rtt-ms", type=float, default=5.0, help="simulated round trip per DynamoDB request")
+    args = parser.parse_args()
+    random.seed(42)
+
+    print(f"{'context':>8} {'layout':>6} {'WCU/msg':>9} {'RCU/msg':>9} {'req/msg':>8} {'ms/msg':>8}")
+    for context_length in CONTEXT_LENGTHS:
+        for layout in ("blob", "items"):
+            result = run(layout, context_length, args.messages, args.rtt_ms / 1000)
+            print(f"{context_length:>8} {layout:>6} {result['wcu']:>9.1f} {result['rcu']:>9.1f} "
+                  f"{result['requests']:>8.1f} {result['ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
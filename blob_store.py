@@ -0,0 +1,127 @@
+"""Storage of binary objects (images) outside DynamoDB.
+
+`s3BlobStore` keeps them in an S3 bucket, `localBlobStore` in a local
+directory with the same interface, for development and tests.
+"""
+import os
+from typing import List, Optional
+
+from botocore.exceptions import ClientError
+
+from logger import get_logger
+
+# "local" or "s3"
+BLOB_STORE_BACKEND = os.environ.get('BLOB_STORE_BACKEND', 'local')
+BLOB_STORE_BUCKET = os.environ.get('BLOB_STORE_BUCKET')
+BLOB_STORE_PREFIX = os.environ.get('BLOB_STORE_PREFIX', '')
+BLOB_STORE_PATH = os.environ.get('BLOB_STORE_PATH', '/tmp/blob_store')
+
+log = get_logger("storage")
+
+
+class s3BlobStore:
+    def __init__(self, bucket: str = BLOB_STORE_BUCKET, prefix: str = BLOB_STORE_PREFIX, client=None) -> None:
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = client
+
+    @property
+    def client(self):
+        # Created on first use, so processes that never touch images do not load boto3
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3')
+        return self._client
+
+    def put(self, key: str, data: bytes, content_type: str = "application/octet-stream") -> None:
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data, ContentType=content_type)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return response['Body'].read()
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def keys(self, prefix: str) -> List[str]:
+        """The keys starting with `prefix`, sorted"""
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            keys += [item['Key'][len(self.prefix):] for item in page.get('Contents', [])]
+        return sorted(keys)
+
+    def delete_prefix(self, prefix: str) -> int:
+        """Delete every object whose key starts with `prefix`, returns how many were deleted"""
+        deleted = 0
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            keys = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if keys:
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': keys, 'Quiet': True})
+                deleted += len(keys)
+        return deleted
+
+
+class localBlobStore:
+    def __init__(self, path: str = BLOB_STORE_PATH) -> None:
+        self.path = path
+
+    def _file(self, key: str) -> str:
+        file_path = os.path.normpath(os.path.join(self.path, key))
+        if not file_path.startswith(os.path.normpath(self.path) + os.sep):
+            raise ValueError(f"Invalid blob key {key}")
+        return file_path
+
+    def put(self, key: str, data: bytes, content_type: str = "application/octet-stream") -> None:
+        file_path = self._file(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        temporary = f"{file_path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(data)
+        os.replace(temporary, file_path)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._file(key), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def keys(self, prefix: str) -> List[str]:
+        """The keys starting with `prefix`, sorted"""
+        keys = []
+        for directory, _, files in os.walk(self.path):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), self.path).replace(os.sep, "/")
+                # Files being written are not objects yet
+                if key.startswith(prefix) and not key.endswith(".tmp"):
+                    keys.append(key)
+        return sorted(keys)
+
+    def delete_prefix(self, prefix: str) -> int:
+        keys = self.keys(prefix)
+        for key in keys:
+            self.delete(key)
+        return len(keys)
+
+
+def create_blob_store():
+    if BLOB_STORE_BACKEND == "s3":
+        return s3BlobStore()
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        # /tmp belongs to one container and is gone when it is recycled
+        log.warning("BLOB_STORE_BACKEND is %s on Lambda: images and the long-term memory are kept in %s of this "
+                    "container only, set BLOB_STORE_BACKEND=s3", BLOB_STORE_BACKEND, BLOB_STORE_PATH)
+    return localBlobStore()
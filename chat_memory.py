@@ -0,0 +1,305 @@
+"""Long-term memory of chats: messages that left the history, searchable by similarity.
+
+Evicted messages are buffered and, once the answer was delivered, embedded
+in one batch and added to a per-chat vector index. The index lives in the
+blob store (S3 on Lambda) under `memory/{chat}/` as append-only segments,
+.npz files of float16 normalized vectors plus the message records; every
+flush writes one new segment and many small segments are merged into one.
+"""
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import metrics
+from logger import get_logger
+
+MEMORY_EMBEDDER = os.environ.get('MEMORY_EMBEDDER', 'hashing')
+MEMORY_EMBEDDING_MODEL = os.environ.get('MEMORY_EMBEDDING_MODEL', 'text-embedding-3-small')
+MEMORY_DIMENSIONS = int(os.environ.get('MEMORY_DIMENSIONS', '256'))
+MEMORY_TOP_K = int(os.environ.get('MEMORY_TOP_K', '5'))
+MEMORY_MIN_SCORE = float(os.environ.get('MEMORY_MIN_SCORE', '0.25'))
+MEMORY_CACHE_SIZE = int(os.environ.get('MEMORY_CACHE_SIZE', '16'))
+# Seconds a loaded index is used before the segments written by other containers are read
+MEMORY_REFRESH_INTERVAL = float(os.environ.get('MEMORY_REFRESH_INTERVAL', '60'))
+# Segments of a chat that are merged into one
+MEMORY_COMPACT_SEGMENTS = int(os.environ.get('MEMORY_COMPACT_SEGMENTS', '32'))
+
+# Longer messages (pasted logs) are cut, a recalled message should stay short
+MEMORY_TEXT_CHARS = 1000
+
+log = get_logger("memory")
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+class hashingEmbedder:
+    """Deterministic local embedder: signed feature hashing of words and word pairs
+
+    Needs no network and gives the same vector for the same text everywhere,
+    it only captures shared vocabulary, not meaning.
+    """
+
+    def __init__(self, dimensions: int = MEMORY_DIMENSIONS) -> None:
+        self.dimensions = dimensions
+
+    def _features(self, text: str) -> List[str]:
+        words = _WORD.findall(text.lower())
+        return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                vectors[row, digest % self.dimensions] += 1.0 if digest >> 63 else -1.0
+        return _normalized(vectors)
+
+
+class openaiEmbedder:
+    """Embeddings from the OpenAI API, one request per batch of texts"""
+
+    def __init__(self, client, model: str = MEMORY_EMBEDDING_MODEL, dimensions: int = MEMORY_DIMENSIONS) -> None:
+        self.client = client
+        self.model = model
+        self.dimensions = dimensions
+
+    @metrics.timed("openai_embedding")
+    def embed(self, texts: List[str]) -> np.ndarray:
+        response = self.client.embeddings.create(model=self.model, input=texts, dimensions=self.dimensions)
+        return _normalized(np.array([item.embedding for item in response.data], dtype=np.float32))
+
+
+def create_embedder(openai_client=None):
+    if MEMORY_EMBEDDER == "openai":
+        return openaiEmbedder(openai_client)
+    return hashingEmbedder()
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _record_positions(records: List[Dict[str, Any]], start: int = 0):
+    """(id, position) pairs of records, the bot's answers also under their Telegram message id"""
+    for offset, record in enumerate(records):
+        if record.get("telegram_id"):
+            yield str(record["telegram_id"]), start + offset
+        yield str(record["id"]), start + offset
+
+
+class vectorIndex:
+    """Normalized vectors with their records, searched by cosine similarity"""
+
+    def __init__(self, dimensions: int, vectors: Optional[np.ndarray] = None,
+                 records: Optional[List[Dict[str, Any]]] = None) -> None:
+        self.dimensions = dimensions
+        # float32 in memory for fast matrix products, float16 on disk
+        self.vectors = vectors if vectors is not None else np.zeros((0, dimensions), dtype=np.float32)
+        self.records: List[Dict[str, Any]] = records or []
+        self.positions: Optional[Dict[str, int]] = None
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def add(self, vectors: np.ndarray, records: List[Dict[str, Any]]) -> None:
+        self.vectors = np.concatenate([self.vectors, vectors.astype(np.float32)])
+        if self.positions is not None:
+            self.positions.update(_record_positions(records, len(self.records)))
+        self.records.extend(records)
+
+    def find(self, message_id: str) -> Optional[Dict[str, Any]]:
+        """The record of a message by its id"""
+        if self.positions is None:
+            self.positions = dict(_record_positions(self.records))
+        position = self.positions.get(str(message_id))
+        return dict(self.records[position]) if position is not None else None
+
+    def search(self, vector: np.ndarray, k: int) -> List[Dict[str, Any]]:
+        """The `k` most similar records, best first, with their similarity as `score`"""
+        if not self.records or k <= 0:
+            return []
+        scores = self.vectors @ vector.astype(np.float32)
+        if k < len(scores):
+            best = np.argpartition(-scores, k)[:k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        return [dict(self.records[index], score=float(scores[index])) for index in best]
+
+    def nbytes(self) -> int:
+        """Size of the stored vectors"""
+        return len(self) * self.dimensions * 2
+
+    def to_bytes(self) -> bytes:
+        output = io.BytesIO()
+        np.savez(
+            output,
+            vectors=self.vectors.astype(np.float16),
+            records=np.frombuffer(json.dumps(self.records).encode("utf-8"), dtype=np.uint8),
+        )
+        return output.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, dimensions: int) -> "vectorIndex":
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            vectors = arrays["vectors"].astype(np.float32)
+            records = json.loads(arrays["records"].tobytes().decode("utf-8"))
+        if vectors.shape[1] != dimensions:
+            raise ValueError(f"{vectors.shape[1]} dimensions instead of {dimensions}")
+        return cls(dimensions, vectors, records)
+
+
+class chatMemory:
+    """Per-chat vector indexes of evicted messages, kept in a blob store and cached in memory"""
+
+    def __init__(self, embedder=None, store=None, cache_size: int = MEMORY_CACHE_SIZE,
+                 refresh_interval: float = MEMORY_REFRESH_INTERVAL,
+                 compact_segments: int = MEMORY_COMPACT_SEGMENTS) -> None:
+        if store is None:
+            from blob_store import create_blob_store
+            store = create_blob_store()
+        self.embedder = embedder or hashingEmbedder()
+        self.store = store
+        self.cache_size = cache_size
+        self.refresh_interval = refresh_interval
+        self.compact_segments = compact_segments
+        # chat_key -> {"index", "segments" (keys read into it), "refreshed_at"}
+        self.indexes: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # Records waiting for `flush`, by chat
+        self.pending: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def _prefix(self, chat_key: str) -> str:
+        return f"memory/{chat_key}/"
+
+    def _add(self, index: vectorIndex, vectors: np.ndarray, records: List[Dict[str, Any]]) -> None:
+        # Merged segments repeat records of segments that were already read
+        new = [position for position, record in enumerate(records) if index.find(record["id"]) is None]
+        if new:
+            index.add(vectors[new], [records[position] for position in new])
+
+    def _refresh(self, chat_key: str, cached: Dict[str, Any]) -> None:
+        """Read the segments of the chat that are not in the cached index yet"""
+        for key in self.store.keys(self._prefix(chat_key)):
+            if key in cached["segments"]:
+                continue
+            data = self.store.get(key)
+            cached["segments"].add(key)
+            if data is None:
+                continue
+            try:
+                segment = vectorIndex.from_bytes(data, self.embedder.dimensions)
+            except ValueError as exc:
+                log.warning("Skipping the memory segment %s: %s", key, exc)
+                continue
+            self._add(cached["index"], segment.vectors, segment.records)
+        cached["refreshed_at"] = time.monotonic()
+
+    def _cached(self, chat_key: str) -> Dict[str, Any]:
+        cached = self.indexes.get(chat_key)
+        if cached is None:
+            cached = {"index": vectorIndex(self.embedder.dimensions), "segments": set(), "refreshed_at": None}
+            self.indexes[chat_key] = cached
+            while len(self.indexes) > self.cache_size:
+                self.indexes.popitem(last=False)
+        self.indexes.move_to_end(chat_key)
+        if cached["refreshed_at"] is None or time.monotonic() - cached["refreshed_at"] >= self.refresh_interval:
+            self._refresh(chat_key, cached)
+        return cached
+
+    def _index(self, chat_key: str) -> vectorIndex:
+        return self._cached(chat_key)["index"]
+
+    def remember(self, chat_key: str, messages: List[Dict[str, Any]]) -> int:
+        """Buffer the conversation messages among `messages` for `flush`, returns how many there were
+
+        Nothing is embedded or written here, this runs inside history writes.
+        """
+        records = [
+            {
+                "id": message.get("id"),
+                "telegram_id": message.get("telegram_id"),
+                "reply_to_id": message.get("reply_to_id"),
+                "username": message.get("username", "user"),
+                "text": message["text"][:MEMORY_TEXT_CHARS],
+            }
+            for message in messages
+            if message.get("role") in ("user", "assistant") and message.get("text")
+        ]
+        if records:
+            with self.lock:
+                self.pending[chat_key].extend(records)
+        return len(records)
+
+    def flush(self) -> int:
+        """Embed the buffered records, one batch and one new segment per chat, returns how many were added"""
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(list)
+        added = 0
+        for chat_key, records in pending.items():
+            vectors = self.embedder.embed([record["text"] for record in records])
+            segment = vectorIndex(self.embedder.dimensions, vectors, records)
+            key = f"{self._prefix(chat_key)}{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.npz"
+            self.store.put(key, segment.to_bytes())
+            with self.lock:
+                cached = self._cached(chat_key)
+                if key not in cached["segments"]:
+                    cached["segments"].add(key)
+                    self._add(cached["index"], segment.vectors, records)
+                if len(cached["segments"]) > self.compact_segments:
+                    self._compact(chat_key, cached)
+            added += len(records)
+        return added
+
+    def _compact(self, chat_key: str, cached: Dict[str, Any]) -> None:
+        """Replace the segments read into the index by one segment holding all of it"""
+        merged = f"{self._prefix(chat_key)}{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.npz"
+        self.store.put(merged, cached["index"].to_bytes())
+        # Segments written meanwhile by other containers were not read and stay
+        for key in cached["segments"]:
+            self.store.delete(key)
+        cached["segments"] = {merged}
+
+    def recall(self, chat_key: str, text: str, k: int = MEMORY_TOP_K,
+               min_score: float = MEMORY_MIN_SCORE) -> List[Dict[str, Any]]:
+        """Remembered messages similar to `text`, most similar first"""
+        if not text or k <= 0:
+            return []
+        with self.lock:
+            index = self._index(chat_key)
+        if not len(index):
+            return []
+        vector = self.embedder.embed([text])[0]
+        return [record for record in index.search(vector, k) if record["score"] >= min_score]
+
+    def thread(self, chat_key: str, message_id: Optional[str], limit: int = MEMORY_TOP_K) -> List[Dict[str, Any]]:
+        """The remembered message `message_id` and the ones it replies to, newest first"""
+        with self.lock:
+            index = self._index(chat_key)
+        records: List[Dict[str, Any]] = []
+        seen = set()
+        while message_id and message_id not in seen and len(records) < limit:
+            seen.add(message_id)
+            record = index.find(message_id)
+            if not record:
+                break
+            records.append(record)
+            message_id = record.get("reply_to_id")
+        return records
+
+    def forget(self, chat_key: str) -> None:
+        with self.lock:
+            self.indexes.pop(chat_key, None)
+            self.pending.pop(chat_key, None)
+            self.store.delete_prefix(self._prefix(chat_key))
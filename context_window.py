@@ -0,0 +1,126 @@
+"""Selection of the history sent to the model within a token budget.
+
+Token counts are computed once per message and kept in its `token_count`
+field, so they are stored with the history. tiktoken is used when it is
+installed, otherwise the count is estimated from the text length.
+"""
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '8000'))
+TOKENIZER_ENCODING = os.environ.get('TOKENIZER_ENCODING', 'o200k_base')
+# What the API charges for one image at high detail, roughly
+IMAGE_TOKENS = int(os.environ.get('IMAGE_TOKENS', '765'))
+
+# Role, separators and the "@user said (message id)" prefix of every message
+MESSAGE_OVERHEAD_TOKENS = 16
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if not text:
+        return 0
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        return len(_encoding.encode(text, disallowed_special=()))
+    # About four characters per token for English, less for other scripts
+    return len(text) // 4 + 1
+
+
+def _count_message(message: Dict[str, Any]) -> int:
+    parts = [message.get("text") or "", message.get("username") or ""]
+    # Tool calls and tool responses keep their payload in "content"
+    if isinstance(message.get("content"), str):
+        parts.append(message["content"])
+    for tool_call in message.get("tool_calls") or []:
+        parts.append(json.dumps(tool_call.get("function", {})))
+    return MESSAGE_OVERHEAD_TOKENS + count_tokens("\n".join(parts))
+
+
+def with_token_count(message: Dict[str, Any]) -> Dict[str, Any]:
+    """Store the token count of a new or changed message in it"""
+    message["token_count"] = _count_message(message)
+    return message
+
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    """Tokens of a message as it is sent to the model, images included"""
+    count = message.get("token_count", message.get("_token_count"))
+    if count is None:
+        # Stored before counts existed, keep it for this request only
+        count = message["_token_count"] = _count_message(message)
+    return int(count) + IMAGE_TOKENS * len(message.get("images") or [])
+
+
+def _units(messages: List[Dict[str, Any]]):
+    """Groups of message positions kept or dropped together, and the group of every message"""
+    # An assistant tool call and its tool responses form one group
+    units: List[List[int]] = []
+    unit_of: List[int] = []
+    for position, message in enumerate(messages):
+        if message.get("role") == "tool" and units and messages[units[-1][0]].get("tool_calls"):
+            units[-1].append(position)
+        else:
+            units.append([position])
+        unit_of.append(len(units) - 1)
+    return units, unit_of
+
+
+def reply_chain(messages: List[Dict[str, Any]], reply_to_id: Optional[str]) -> List[int]:
+    """Positions of the messages on the reply chain that starts at `reply_to_id`, newest first
+
+    The bot's answers are also found by the id of their Telegram message.
+    """
+    positions = {str(message["telegram_id"]): position
+                 for position, message in enumerate(messages) if message.get("telegram_id")}
+    positions.update((str(message["id"]), position) for position, message in enumerate(messages) if message.get("id"))
+    chain: List[int] = []
+    current = str(reply_to_id) if reply_to_id else None
+    while current in positions:
+        position = positions.pop(current)
+        if position in chain:
+            break
+        chain.append(position)
+        parent = messages[position].get("reply_to_id")
+        current = str(parent) if parent else None
+    return chain
+
+
+def select_context(messages: List[Dict[str, Any]], budget: int = CONTEXT_TOKEN_BUDGET,
+                   reply_to_id: Optional[str] = None, start: int = 0) -> List[Dict[str, Any]]:
+    """The messages sent to the model within `budget` tokens, in chronological order
+
+    The reply chain of `reply_to_id` is packed first, then the newest messages
+    from position `start` on. A message (or tool call with its responses) that
+    does not fit is skipped so shorter ones can still use the budget. A budget
+    of 0 keeps all the messages from `start` on and the whole chain.
+    """
+    units, unit_of = _units(messages)
+    chosen = [False] * len(units)
+    remaining = budget if budget > 0 else float("inf")
+
+    def take(unit: int) -> None:
+        nonlocal remaining
+        if chosen[unit]:
+            return
+        tokens = sum(message_tokens(messages[position]) for position in units[unit])
+        if tokens <= remaining:
+            chosen[unit] = True
+            remaining -= tokens
+
+    for position in reply_chain(messages, reply_to_id):
+        take(unit_of[position])
+    for unit in range(len(units) - 1, -1, -1):
+        if units[unit][0] >= start:
+            take(unit)
+    # Chronological order keeps the serialized history stable between requests
+    return [messages[position] for unit, positions in enumerate(units) if chosen[unit] for position in positions]
@@ -1,35 +1,326 @@
 import os
-import boto3
+import random
+import threading
+import time
 import json
-from typing import List, Dict, Any
+from typing import Callable, List, Dict, Any, Optional
 
 from botocore.exceptions import ClientError
 
+import metrics
+from logger import get_logger
+from history_cache import historyCache
+from history_codec import encode_history, decode_history
+
 DYNAMODB_TABLE_NAME = os.environ.get('DYNAMODB_TABLE_NAME')
+DYNAMODB_MESSAGES_TABLE_NAME = os.environ.get('DYNAMODB_MESSAGES_TABLE_NAME')
+# "blob" keeps the whole history in one item, "items" stores one item per message
+STORAGE_LAYOUT = os.environ.get('STORAGE_LAYOUT', 'blob')
+CONTEXT_LENGTH = int(os.environ.get('CONTEXT_LENGTH'))
+# Attempts of a conditional history write before giving up
+SAVE_RETRIES = int(os.environ.get('SAVE_RETRIES', '8'))
+# "binary" stores blob histories compressed, "text" keeps the legacy "\n\n"-joined JSON
+HISTORY_ENCODING = os.environ.get('HISTORY_ENCODING', 'binary')
+# Records of processed updates share the history table under keys with this prefix
+UPDATE_KEY_PREFIX = "update_"
+
+log = get_logger("dynamodb")
+
+_dynamodb = None
+_dynamodb_lock = threading.Lock()
+
+
+def dynamodb_resource():
+    """The DynamoDB resource shared by the whole process, boto3 is imported on first use"""
+    global _dynamodb
+    with _dynamodb_lock:
+        if _dynamodb is None:
+            import boto3
+            _dynamodb = boto3.resource('dynamodb')
+    return _dynamodb
 
-dynamodb = boto3.resource('dynamodb')
+
+def trim_history(messages: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    """Keep the last `limit` messages without starting in the middle of a tool call sequence"""
+    trimmed = messages[-limit:]
+    # A clean start is: user message, or assistant message without tool_calls
+    while trimmed and (
+        trimmed[0].get("role") == "tool" or
+        (trimmed[0].get("role") == "assistant" and trimmed[0].get("tool_calls"))
+    ):
+        trimmed = trimmed[1:]
+    return trimmed
 
 
 class dynamoDBClient:
-    def __init__(self) -> None:
-        pass
+    def __init__(self, resource=None, layout: Optional[str] = None) -> None:
+        self._resource = resource
+        self.layout = layout or STORAGE_LAYOUT
+        # message_key -> encoded message for the items seen by the last load/save of a chat
+        self._stored_items: Dict[str, Dict[str, str]] = {}
+        # Version and contents of the blob item seen by the last load/save of a chat
+        self._blob_states: Dict[str, Dict[str, Any]] = {}
+        self.cache = historyCache()
+        # Called with the messages that a write drops from a stored history
+        self.on_evict: Optional[Callable[[str, List[Dict[str, Any]]], None]] = None
+        # Called with the messages a write is about to drop and the ones it keeps, before
+        # the write; returning False keeps the dropped ones stored for a later write
+        self.before_evict: Optional[Callable[[str, List[Dict[str, Any]], List[Dict[str, Any]]], bool]] = None
+
+    @property
+    def dynamodb(self):
+        return self._resource or dynamodb_resource()
+
+    def _record(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        # Keys starting with "_" are runtime bookkeeping and are never persisted
+        return {key: value for key, value in message.items() if not key.startswith("_")}
+
+    def _encode_message(self, message: Dict[str, Any]) -> str:
+        return json.dumps(self._record(message))
 
-    def _encode_messages(self, messages: List[Dict[str, Any]]):
-        return "\n\n".join([json.dumps(message) for message in messages])
+    def _approximate_size(self, messages: List[Dict[str, Any]]) -> int:
+        return sum(len(message.get("text") or "") + 256 for message in messages)
 
+    def _new_message_key(self, offset: int) -> str:
+        return f"{time.time_ns():020d}-{offset:04d}"
+
+    @metrics.timed("dynamodb_save")
     def save_messages(self, table_id, messages: List[Dict[str, Any]]):
-        """Save messages to a DynamoDB table"""
-        data = {
-            'chat_id': table_id,
-            'messages': self._encode_messages(messages)
+        """Save messages to a DynamoDB table
+
+        In the blob layout the write is conditional on the version that was loaded.
+        If the history changed in the meantime, the messages added by others are
+        merged in and the write is retried.
+        """
+        if self.layout == "items":
+            return self._save_message_items(table_id, messages)
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        state = self._blob_states.get(table_id)
+        released: set = set()
+        for attempt in range(SAVE_RETRIES):
+            version = state["version"] if state else None
+            if state:
+                messages = self._hold_blob_messages(table_id, messages, state, released)
+            records = [self._record(message) for message in messages]
+            data = {
+                'chat_id': table_id,
+                'version': (version or 0) + 1,
+                'base_version': (version or 0) + 1,
+            }
+            if HISTORY_ENCODING == "binary":
+                data['history'] = encode_history(records)
+            else:
+                data['messages'] = "\n\n".join(json.dumps(record) for record in records)
+            metrics.put("history_bytes", len(data.get('history') or data.get('messages')), metrics.BYTES)
+            try:
+                if state is None:
+                    # Nothing was loaded, the history must not exist yet
+                    response = table.put_item(Item=data, ConditionExpression='attribute_not_exists(chat_id)')
+                elif version is None:
+                    response = table.put_item(Item=data, ConditionExpression='attribute_not_exists(version)')
+                else:
+                    response = table.put_item(
+                        Item=data,
+                        ConditionExpression='version = :version',
+                        ExpressionAttributeValues={':version': version},
+                    )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                metrics.add("dynamodb_save_conflicts")
+                # Back off a little so a burst of appends can settle
+                time.sleep(random.uniform(0, min(0.02 * 2 ** attempt, 1)))
+                messages, state = self._merge_concurrent_changes(table_id, messages, state or self._blob_state({}, []))
+                continue
+            # Keep the messages exactly as a later load would decode them
+            saved = [self._decode_message(dict(record), index) for index, record in enumerate(records)]
+            encodings = [self._encode_message(message) for message in saved]
+            if state:
+                written = set(encodings)
+                self._evicted(table_id, [json.loads(encoded) for encoded in state["sequence"] if encoded not in written])
+            state = self._blob_state(data, encodings)
+            self._blob_states[table_id] = state
+            self.cache.put(table_id, state["version"], saved, self._approximate_size(saved), state=state)
+            return response
+        log.error("Could not save the history of %s: it kept changing after %s attempts", table_id, SAVE_RETRIES)
+        return None
+
+    def _blob_state(self, item: Dict[str, Any], known: List[str]) -> Dict[str, Any]:
+        return {
+            "version": int(item['version']) if 'version' in item else None,
+            "base_version": int(item['base_version']) if 'base_version' in item else None,
+            "pending": len(item.get('pending', [])),
+            # Encodings of the decoded messages, to tell new messages apart
+            "known": set(known),
+            "sequence": list(known),
         }
-        table = dynamodb.Table(DYNAMODB_TABLE_NAME)
-        response = table.put_item(Item=data)
-        return response
 
-    def _decode_message(self, raw_message: str, index: int) -> Dict[str, Any]:
+    def _merge_concurrent_changes(self, table_id, messages: List[Dict[str, Any]], state: Dict[str, Any]):
+        """Splice the messages stored since `state` was read into `messages`"""
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        response = table.get_item(
+            Key={'chat_id': table_id},
+            ProjectionExpression='version, base_version, pending',
+            ConsistentRead=True,
+        )
+        current = response.get('Item', {})
+        if current and state["base_version"] is not None and current.get('base_version') == state["base_version"]:
+            # Only appends happened: the new messages are the tail of the pending list
+            raw_tail = current.get('pending', [])[state["pending"]:]
+            tail = [self._decode_message(raw, len(messages) + index) for index, raw in enumerate(raw_tail)]
+            stored = state["sequence"] + [self._encode_message(message) for message in tail]
+        else:
+            # Someone rewrote the whole history, anything we did not see is new
+            current, raw_messages = self._read_blob_item(table_id, consistent=True)
+            fresh = [self._decode_message(raw, index) for index, raw in enumerate(raw_messages)]
+            tail = [message for message in fresh if self._encode_message(message) not in state["known"]]
+            stored = [self._encode_message(message) for message in fresh]
+
+        known = state["known"] | {self._encode_message(message) for message in tail}
+        log.info("History of %s changed while it was being updated, merging %s new messages", table_id, len(tail))
+
+        # New messages go after the message being answered and before the bot's records
+        start = next((index for index, message in enumerate(messages)
+                      if self._encode_message(message) not in state["known"]), len(messages))
+        position = next((index for index in range(start, len(messages))
+                         if messages[index].get("role") in ("assistant", "tool")), len(messages))
+        merged = trim_history(messages[:position] + tail + messages[position:], max(CONTEXT_LENGTH, len(messages)))
+        merged_state = self._blob_state(current, list(known))
+        # What the item holds now, in order
+        merged_state["sequence"] = stored
+        return merged, merged_state
+
+    @metrics.timed("dynamodb_append")
+    def append_message(self, table_id, message: Dict[str, Any]) -> bool:
+        """Add one message to a chat history with a single write and without reading it first
+
+        Returns True if the append had to compact the stored history, i.e. the
+        oldest messages left the CONTEXT_LENGTH window.
+        """
+        if self.layout == "items":
+            # Older items are not deleted here: reads are limited to the newest ones
+            # and the next save_messages removes everything before the kept history.
+            table = self.dynamodb.Table(DYNAMODB_MESSAGES_TABLE_NAME)
+            table.put_item(Item={
+                'chat_id': table_id,
+                'message_key': self._new_message_key(0),
+                'message': self._encode_message(message),
+            })
+            return False
+
+        # The blob layout collects appended messages in a `pending` list next to the
+        # encoded history. It is capped at CONTEXT_LENGTH entries, once it is full the
+        # item is compacted and trimmed before the append is retried.
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
         try:
-            message_obj = json.loads(raw_message)
+            table.update_item(
+                Key={'chat_id': table_id},
+                UpdateExpression='SET pending = list_append(if_not_exists(pending, :empty), :message), '
+                                 'version = if_not_exists(version, :zero) + :one',
+                ConditionExpression='attribute_not_exists(pending) OR size(pending) < :max_pending',
+                ExpressionAttributeValues={
+                    ':empty': [],
+                    ':message': [self._encode_message(message)],
+                    ':max_pending': CONTEXT_LENGTH,
+                    ':zero': 0,
+                    ':one': 1,
+                },
+            )
+            return False
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        self.save_messages(table_id, self.load_messages(table_id, limit=CONTEXT_LENGTH - 1) + [message])
+        return True
+
+    def _evicted(self, table_id, messages: List[Dict[str, Any]]) -> None:
+        if self.on_evict and messages:
+            self.on_evict(table_id, messages)
+
+    def _release(self, table_id, dropped: List[Dict[str, Any]], kept: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """The messages of `dropped` that a write must still keep, as `before_evict` decides
+
+        Held messages are kept until a later write gets them released, at most
+        CONTEXT_LENGTH of them so a failing hook cannot grow the history forever.
+        """
+        if not dropped or not self.before_evict:
+            return []
+        try:
+            if self.before_evict(table_id, dropped, kept):
+                return []
+        except Exception as e:
+            log.error("Could not release the messages dropped from %s: %s", table_id, e)
+        if len(dropped) > CONTEXT_LENGTH:
+            log.error("Dropping %s messages of %s that could not be released", len(dropped) - CONTEXT_LENGTH, table_id)
+        metrics.add("held_messages", min(len(dropped), CONTEXT_LENGTH))
+        return dropped[-CONTEXT_LENGTH:]
+
+    def _hold_blob_messages(self, table_id, messages: List[Dict[str, Any]], state: Dict[str, Any],
+                            released: set) -> List[Dict[str, Any]]:
+        """`messages` preceded by the stored ones it drops that `before_evict` does not release"""
+        if not self.before_evict:
+            return messages
+        encodings = {self._encode_message(message) for message in messages}
+        ids = {message.get("id") for message in messages}
+        # A message whose record changed (e.g. a resolved reply) is still kept
+        dropped = [encoded for encoded in state["sequence"] if encoded not in encodings and encoded not in released
+                   and json.loads(encoded).get("id") not in ids]
+        held = self._release(table_id, [json.loads(encoded) for encoded in dropped], messages)
+        held_encodings = {self._encode_message(message) for message in held}
+        released.update(encoded for encoded in dropped if encoded not in held_encodings)
+        return held + messages
+
+    def _save_message_items(self, table_id, messages: List[Dict[str, Any]]):
+        """Write only new or changed messages and delete the ones trimmed from the history"""
+        if table_id not in self._stored_items:
+            self._load_message_items(table_id)
+        known = dict(self._stored_items.get(table_id, {}))
+        retained: Dict[str, str] = {}
+        table = self.dynamodb.Table(DYNAMODB_MESSAGES_TABLE_NAME)
+        first_key = next((message["_key"] for message in messages if message.get("_key")), None)
+        if first_key:
+            # Items before the kept history that were never loaded: older appends, and appends
+            # whose key was taken before the history was loaded but that landed after it. Only
+            # the oldest of them, beyond CONTEXT_LENGTH, are outside the history and deleted.
+            older = [item for item in self._query_message_items(
+                         table_id, keys_only=not (self.on_evict or self.before_evict), before=first_key)
+                     if item['message_key'] not in known]
+            for item in older[:max(0, len(older) + len(messages) - CONTEXT_LENGTH)]:
+                known[item['message_key']] = item.get('message', "")
+        kept_keys = {message["_key"] for message in messages if message.get("_key")}
+        dropped = [key for key in sorted(known) if key not in kept_keys]
+        held = self._release(table_id, [self._decode_message(known[key], key) for key in dropped if known[key]],
+                             messages)
+        held_ids = {message.get("id") for message in held}
+        for key in dropped:
+            if known[key] and self._decode_message(known[key], key).get("id") in held_ids:
+                retained[key] = known[key]
+        saved: List[Dict[str, Any]] = []
+        with table.batch_writer() as batch:
+            for offset, message in enumerate(messages):
+                key = message.get("_key") or self._new_message_key(offset)
+                encoded = self._encode_message(message)
+                if known.get(key) != encoded:
+                    batch.put_item(Item={'chat_id': table_id, 'message_key': key, 'message': encoded})
+                retained[key] = encoded
+                saved_message = self._decode_message(encoded, key)
+                saved_message["_key"] = key
+                saved.append(saved_message)
+            for key in known:
+                if key not in retained:
+                    batch.delete_item(Key={'chat_id': table_id, 'message_key': key})
+        self._evicted(table_id, [self._decode_message(known[key], key) for key in sorted(known)
+                                 if known[key] and key not in retained])
+        self._stored_items[table_id] = retained
+        if saved:
+            self.cache.put(table_id, saved[-1]["_key"], saved, self._approximate_size(saved), state=dict(retained))
+        else:
+            self.cache.invalidate(table_id)
+
+    def _decode_message(self, raw_message, index) -> Dict[str, Any]:
+        try:
+            # Records of binary histories are already parsed
+            message_obj = raw_message if isinstance(raw_message, dict) else json.loads(raw_message)
         except json.JSONDecodeError:
             message_obj = {
                 "role": "user",
@@ -56,26 +347,295 @@ class dynamoDBClient:
         message_obj.setdefault("role", "user")
         return message_obj
 
-    def load_messages(self, table_id) -> List[Dict[str, Any]]:
-        """Load messages from a DynamoDB table"""
-        table = dynamodb.Table(DYNAMODB_TABLE_NAME)
+    @metrics.timed("dynamodb_load")
+    def load_messages(self, table_id, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Load messages from a DynamoDB table, only the last `limit` ones if it is set"""
+        if self.layout == "items":
+            return self._load_message_items(table_id, limit)
 
+        messages = self._load_blob_messages(table_id)
+        return messages[-limit:] if limit else messages
+
+    def _read_blob_item(self, table_id, consistent: bool = False):
+        """Read the blob item of a chat, returns it with its stored messages"""
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        response = table.get_item(Key={'chat_id': table_id}, ConsistentRead=consistent)
+        item = response.get('Item', {})
+        if 'history' in item:
+            raw_messages = decode_history(item['history'])
+        elif item.get("messages"):
+            # Legacy text encoding
+            raw_messages = item["messages"].split("\n\n")
+        else:
+            raw_messages = []
+        raw_messages += item.get("pending", [])
+        return item, raw_messages
+
+    def _load_blob_messages(self, table_id) -> List[Dict[str, Any]]:
         try:
-            response = table.get_item(Key={'chat_id': table_id})
+            if self.cache.version(table_id) is not None:
+                # Only the version is read when the cached history may still be current
+                table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+                item = table.get_item(Key={'chat_id': table_id}, ProjectionExpression='version').get('Item', {})
+                cached = self.cache.get(table_id, int(item['version']) if 'version' in item else None)
+                if cached:
+                    self._blob_states[table_id] = cached["state"]
+                    return cached["messages"]
+            item, raw_messages = self._read_blob_item(table_id)
         except ClientError as e:
-            print(e.response['Error']['Message'])
-            messages: List[Dict[str, Any]] = []
-        else:
-            if 'Item' in response:
-                raw_messages = response['Item']["messages"].split("\n\n")
-                messages = [self._decode_message(message, index) for index, message in enumerate(raw_messages)]
-            else:
-                messages = []
+            log.error("Could not load the history of %s: %s", table_id, e.response['Error']['Message'])
+            return []
+
+        messages = [self._decode_message(message, index) for index, message in enumerate(raw_messages)]
+        state = self._blob_state(item, [self._encode_message(m) for m in messages])
+        self._blob_states[table_id] = state
+        if state["version"] is not None:
+            self.cache.put(table_id, state["version"], messages, self._approximate_size(messages), state=state)
+        return messages
+
+    def _query_message_items(self, table_id, limit: Optional[int] = None, keys_only: bool = False,
+                             before: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Query the newest items of a chat, returned oldest first"""
+        table = self.dynamodb.Table(DYNAMODB_MESSAGES_TABLE_NAME)
+        query_args: Dict[str, Any] = {
+            'KeyConditionExpression': 'chat_id = :chat_id',
+            'ExpressionAttributeValues': {':chat_id': table_id},
+            'ScanIndexForward': False,
+        }
+        if before:
+            query_args['KeyConditionExpression'] += ' AND message_key < :before'
+            query_args['ExpressionAttributeValues'][':before'] = before
+        if keys_only:
+            query_args['ProjectionExpression'] = 'chat_id, message_key'
+        items: List[Dict[str, Any]] = []
+        while True:
+            if limit:
+                query_args['Limit'] = limit - len(items)
+            response = table.query(**query_args)
+            items.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response or (limit and len(items) >= limit):
+                break
+            query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        items.reverse()
+        return items
+
+    def _load_message_items(self, table_id, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        try:
+            if self.cache.version(table_id) is not None:
+                # The newest key identifies the stored history, it is the only item read
+                newest = self._query_message_items(table_id, limit=1, keys_only=True)
+                cached = self.cache.get(table_id, newest[0]['message_key'] if newest else None, limit)
+                if cached:
+                    self._stored_items[table_id] = dict(cached["state"])
+                    return cached["messages"]
+            items = self._query_message_items(table_id, limit)
+        except ClientError as e:
+            log.error("Could not load the history of %s: %s", table_id, e.response['Error']['Message'])
+            return []
+
+        if not items:
+            # Chats written with the old layout are migrated on first access
+            messages = self.migrate_chat(table_id)
+            return messages[-limit:] if limit else messages
 
+        messages: List[Dict[str, Any]] = []
+        stored: Dict[str, str] = {}
+        for item in items:
+            key = item['message_key']
+            message = self._decode_message(item['message'], key)
+            stored[key] = self._encode_message(message)
+            message["_key"] = key
+            messages.append(message)
+        self._stored_items[table_id] = stored
+        self.cache.put(table_id, items[-1]['message_key'], messages, self._approximate_size(messages),
+                       limit=limit, state=dict(stored))
         return messages
 
+    def migrate_chat(self, table_id, delete_blob: bool = False) -> List[Dict[str, Any]]:
+        """Copy a chat history from the blob layout into per-message items"""
+        messages = self._load_blob_messages(table_id)
+        if not messages:
+            self._stored_items[table_id] = {}
+            return []
+        self._stored_items[table_id] = {}
+        self._save_message_items(table_id, messages)
+        for message, key in zip(messages, self._stored_items[table_id]):
+            message["_key"] = key
+        if delete_blob:
+            self.dynamodb.Table(DYNAMODB_TABLE_NAME).delete_item(Key={'chat_id': table_id})
+        log.info("Migrated %s messages of %s to the items layout", len(messages), table_id)
+        return messages
+
+    def migrate_all(self, delete_blob: bool = False) -> int:
+        """Migrate every chat of the blob table, returns the number of migrated chats"""
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        scan_args: Dict[str, Any] = {'ProjectionExpression': 'chat_id'}
+        migrated = 0
+        while True:
+            response = table.scan(**scan_args)
+            for item in response.get('Items', []):
+                # The table also holds the records of updates, summaries, bursts and albums
+                if item['chat_id'].startswith(UPDATE_KEY_PREFIX) or '#' in item['chat_id']:
+                    continue
+                if self.migrate_chat(item['chat_id'], delete_blob):
+                    migrated += 1
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return migrated
+
+    @metrics.timed("dynamodb_claim_update")
+    def claim_update(self, update_key: str, ttl: int) -> bool:
+        """Record an update as being processed, returns False if it was already recorded
+
+        The record expires after `ttl` seconds, the table needs TTL enabled on `expires_at`.
+        """
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        now = int(time.time())
+        try:
+            table.put_item(
+                Item={'chat_id': update_key, 'expires_at': now + ttl},
+                # DynamoDB deletes expired items lazily, so they are checked explicitly
+                ConditionExpression='attribute_not_exists(chat_id) OR expires_at < :now',
+                ExpressionAttributeValues={':now': now},
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            log.error("Could not claim %s: %s", update_key, e.response['Error']['Message'])
+        return True
+
+    @metrics.timed("dynamodb_release_update")
+    def release_update(self, update_key: str) -> None:
+        """Remove the record of an update that could not be processed, so its redelivery is accepted"""
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        try:
+            table.delete_item(Key={'chat_id': update_key})
+        except ClientError as e:
+            # The record still expires after its ttl
+            log.error("Could not release %s: %s", update_key, e.response['Error']['Message'])
+
+    @metrics.timed("dynamodb_join_burst")
+    def join_burst(self, table_id, message_id: str, window: float, ttl: int) -> bool:
+        """Record a message the bot answers, returns True if it continues a burst
+
+        The id of a message that arrives within `window` seconds of the previous
+        one is added to the burst item of the chat, to be answered by
+        `claim_burst`. Only ids are kept there, the messages are in the history.
+        """
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        key = {'chat_id': f"{table_id}#burst"}
+        now = int(time.time() * 1000)
+        response = table.update_item(
+            Key=key,
+            UpdateExpression='SET last_at = :now, expires_at = :expires',
+            ExpressionAttributeValues={':now': now, ':expires': int(time.time()) + ttl},
+            ReturnValues='UPDATED_OLD',
+        )
+        last_at = response.get('Attributes', {}).get('last_at')
+        if last_at is None or now - int(last_at) > window * 1000:
+            return False
+        table.update_item(
+            Key=key,
+            UpdateExpression='SET ids = list_append(if_not_exists(ids, :empty), :id), '
+                             'latest = :latest, first_at = if_not_exists(first_at, :now)',
+            ExpressionAttributeValues={':empty': [], ':id': [message_id], ':latest': message_id, ':now': now},
+        )
+        return True
+
+    @metrics.timed("dynamodb_claim_burst")
+    def claim_burst(self, table_id, message_id: str, max_delay: float) -> Optional[List[str]]:
+        """Take the message ids of a burst, None if a later message of it will take them
+
+        The burst goes to its latest message, or to any of its messages once
+        the first one waited `max_delay` seconds.
+        """
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        try:
+            response = table.update_item(
+                Key={'chat_id': f"{table_id}#burst"},
+                UpdateExpression='REMOVE ids, latest, first_at',
+                ConditionExpression='latest = :id OR first_at <= :cutoff',
+                ExpressionAttributeValues={':id': message_id, ':cutoff': int((time.time() - max_delay) * 1000)},
+                ReturnValues='ALL_OLD',
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return None
+        return list(response.get('Attributes', {}).get('ids', []))
+
+    @metrics.timed("dynamodb_add_to_album")
+    def add_to_album(self, table_id, media_group_id: str, message: Dict[str, Any], ttl: int):
+        """Buffer a Telegram message of an album (media group) until `claim_album`"""
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        table.update_item(
+            Key={'chat_id': f"{table_id}#album#{media_group_id}"},
+            UpdateExpression='SET messages = list_append(if_not_exists(messages, :empty), :message), '
+                             'latest = :id, expires_at = :expires',
+            ExpressionAttributeValues={':empty': [], ':message': [json.dumps(message)],
+                                       ':id': str(message['message_id']), ':expires': int(time.time()) + ttl},
+        )
+
+    @metrics.timed("dynamodb_claim_album")
+    def claim_album(self, table_id, media_group_id: str, message_id: str) -> Optional[List[Dict[str, Any]]]:
+        """Take the buffered messages of an album, None unless `message_id` was buffered last"""
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        try:
+            response = table.delete_item(
+                Key={'chat_id': f"{table_id}#album#{media_group_id}"},
+                ConditionExpression='latest = :id',
+                ExpressionAttributeValues={':id': message_id},
+                ReturnValues='ALL_OLD',
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return None
+        return [json.loads(message) for message in response.get('Attributes', {}).get('messages', [])]
+
+    @metrics.timed("dynamodb_load_summary")
+    def load_summary(self, table_id) -> Optional[Dict[str, Any]]:
+        """The rolling summary of a chat as {"text", "covered", "version"}, None if there is none"""
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        item = table.get_item(Key={'chat_id': f"{table_id}#summary"}).get('Item')
+        if not item:
+            return None
+        return {"text": item.get('summary', ''), "covered": item.get('covered'), "version": int(item.get('version', 0))}
+
+    @metrics.timed("dynamodb_save_summary")
+    def save_summary(self, table_id, text: str, covered: str, version: int) -> bool:
+        """Store the summary of a chat if it is still at `version` (0 if there was none)
+
+        `covered` identifies the last message folded into the summary. Returns
+        False if another invocation updated the summary first.
+        """
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        try:
+            table.put_item(
+                Item={'chat_id': f"{table_id}#summary", 'summary': text, 'covered': covered, 'version': version + 1},
+                ConditionExpression='attribute_not_exists(version) OR version = :version',
+                ExpressionAttributeValues={':version': version},
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+        return True
+
+    @metrics.timed("dynamodb_reset")
     def reset_chat(self, table_id):
         """Reset a chat in a DynamoDB table"""
-        table = dynamodb.Table(DYNAMODB_TABLE_NAME)
+        if self.layout == "items":
+            table = self.dynamodb.Table(DYNAMODB_MESSAGES_TABLE_NAME)
+            with table.batch_writer() as batch:
+                for item in self._query_message_items(table_id, keys_only=True):
+                    batch.delete_item(Key={'chat_id': table_id, 'message_key': item['message_key']})
+            self._stored_items.pop(table_id, None)
+        self._blob_states.pop(table_id, None)
+        self.cache.invalidate(table_id)
+        table = self.dynamodb.Table(DYNAMODB_TABLE_NAME)
+        table.delete_item(Key={'chat_id': f"{table_id}#summary"})
+        table.delete_item(Key={'chat_id': f"{table_id}#burst"})
         response = table.delete_item(Key={'chat_id': table_id})
         return response
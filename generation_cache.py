@@ -0,0 +1,98 @@
+"""Cache of generated images shared by the requests of a warm container.
+
+Results are kept for IMAGE_CACHE_TTL seconds within an entry and a byte
+limit. Identical requests that arrive while the image is being generated
+wait for that generation instead of starting their own.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+IMAGE_CACHE_TTL = float(os.environ.get('IMAGE_CACHE_TTL', '3600'))
+IMAGE_CACHE_SIZE = int(os.environ.get('IMAGE_CACHE_SIZE', '32'))
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+
+def generation_key(prompt: str, aspect_ratio: Optional[str], model: str) -> str:
+    # Case and spacing do not change what is drawn
+    normalized = " ".join(prompt.casefold().split())
+    return hashlib.sha256(f"{model}\n{aspect_ratio or ''}\n{normalized}".encode("utf-8")).hexdigest()
+
+
+class generationCache:
+    def __init__(self, ttl: float = IMAGE_CACHE_TTL, max_entries: int = IMAGE_CACHE_SIZE,
+                 max_bytes: int = IMAGE_CACHE_MAX_BYTES) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.in_flight: Dict[str, Dict[str, Any]] = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats: Dict[str, float] = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "saved_ms": 0.0}
+
+    @property
+    def hit_rate(self) -> float:
+        served = self.stats["hits"] + self.stats["coalesced"]
+        total = served + self.stats["misses"]
+        return served / total if total else 0.0
+
+    def _drop(self, key: str) -> None:
+        entry = self.entries.pop(key)
+        self.size -= entry["size"]
+
+    def get_or_create(self, key: str, create: Callable[[], Optional[Dict[str, Any]]]) -> Tuple[Optional[Dict[str, Any]], str]:
+        """The cached result for `key`, or the one `create` returns
+
+        Returns the result and how it was obtained: "hit", "coalesced" (waited for
+        an identical request) or "miss". None results are not cached.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry["expires_at"] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["saved_ms"] += entry["duration_ms"]
+                return entry["value"], "hit"
+            if entry:
+                self._drop(key)
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = {"done": threading.Event(), "value": None}
+                self.stats["misses"] += 1
+
+        if not leader:
+            flight["done"].wait()
+            with self.lock:
+                self.stats["coalesced"] += 1
+            return flight["value"], "coalesced"
+
+        started = time.monotonic()
+        value = None
+        try:
+            value = create()
+        finally:
+            duration_ms = (time.monotonic() - started) * 1000
+            with self.lock:
+                self.in_flight.pop(key, None)
+                size = len((value or {}).get("data") or b"")
+                if value is not None and self.max_entries > 0 and size <= self.max_bytes:
+                    if key in self.entries:
+                        self._drop(key)
+                    self.entries[key] = {
+                        "value": value,
+                        "size": size,
+                        "duration_ms": duration_ms,
+                        "expires_at": time.monotonic() + self.ttl,
+                    }
+                    self.size += size
+                    while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                        self._drop(next(iter(self.entries)))
+                        self.stats["evictions"] += 1
+            flight["value"] = value
+            flight["done"].set()
+        return value, "miss"
@@ -0,0 +1,77 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+HISTORY_CACHE_SIZE = int(os.environ.get('HISTORY_CACHE_SIZE', '128'))
+HISTORY_CACHE_MAX_BYTES = int(os.environ.get('HISTORY_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+
+class historyCache:
+    """LRU cache of decoded chat histories kept by a warm container
+
+    Every entry is tagged with the version of the stored history it was decoded
+    from, a lookup only hits when the caller found the same version in storage.
+    """
+
+    def __init__(self, max_entries: int = HISTORY_CACHE_SIZE, max_bytes: int = HISTORY_CACHE_MAX_BYTES) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def version(self, chat_key: str) -> Optional[Any]:
+        """The version of the cached history of a chat, None if it is not cached"""
+        entry = self.entries.get(chat_key)
+        return entry["version"] if entry else None
+
+    def get(self, chat_key: str, version: Any, limit: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """Returns {"messages", "state"} if the cached history has `version` and covers `limit` messages"""
+        with self.lock:
+            entry = self.entries.get(chat_key)
+            if (
+                entry is None or version is None or entry["version"] != version or
+                (entry["limit"] is not None and (limit is None or limit > entry["limit"]))
+            ):
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(chat_key)
+            self.stats["hits"] += 1
+        messages = entry["messages"][-limit:] if limit else entry["messages"]
+        # Callers get their own dicts, so changing them does not corrupt the cache
+        return {"messages": [dict(message) for message in messages], "state": entry["state"]}
+
+    def put(self, chat_key: str, version: Any, messages: List[Dict[str, Any]], size: int,
+            limit: Optional[int] = None, state: Any = None) -> None:
+        """Cache a decoded history, `size` is its approximate size in bytes"""
+        if not self.enabled or size > self.max_bytes:
+            self.invalidate(chat_key)
+            return
+        with self.lock:
+            previous = self.entries.pop(chat_key, None)
+            if previous:
+                self.size -= previous["size"]
+            self.entries[chat_key] = {
+                "version": version,
+                "messages": [dict(message) for message in messages],
+                "size": size,
+                "limit": limit,
+                "state": state,
+            }
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted["size"]
+                self.stats["evictions"] += 1
+
+    def invalidate(self, chat_key: str) -> None:
+        with self.lock:
+            entry = self.entries.pop(chat_key, None)
+            if entry:
+                self.size -= entry["size"]
@@ -0,0 +1,45 @@
+"""Binary encoding of chat histories.
+
+A history is stored as one format byte followed by a zlib-compressed JSON
+array of message records. orjson is used for the JSON part when it is
+installed, the standard library otherwise.
+"""
+import json
+import os
+import zlib
+from typing import Any, Dict, List
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+HISTORY_COMPRESSION_LEVEL = int(os.environ.get('HISTORY_COMPRESSION_LEVEL', '6'))
+
+FORMAT_ZLIB_JSON_ARRAY = 1
+
+
+def _dumps(records: List[Dict[str, Any]]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(records)
+    return json.dumps(records, separators=(",", ":")).encode("utf-8")
+
+
+def _loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def encode_history(records: List[Dict[str, Any]]) -> bytes:
+    return bytes([FORMAT_ZLIB_JSON_ARRAY]) + zlib.compress(_dumps(records), HISTORY_COMPRESSION_LEVEL)
+
+
+def decode_history(data) -> List[Dict[str, Any]]:
+    # boto3 wraps binary attributes in a Binary object
+    data = bytes(getattr(data, "value", data))
+    if not data:
+        return []
+    if data[0] != FORMAT_ZLIB_JSON_ARRAY:
+        raise ValueError(f"Unknown history format {data[0]}")
+    return _loads(zlib.decompress(data[1:]))
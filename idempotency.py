@@ -0,0 +1,60 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict
+
+import metrics
+from dinamodb_client import dynamoDBClient, UPDATE_KEY_PREFIX
+
+UPDATE_DEDUP_TTL = int(os.environ.get('UPDATE_DEDUP_TTL', '86400'))
+UPDATE_DEDUP_CACHE_SIZE = int(os.environ.get('UPDATE_DEDUP_CACHE_SIZE', '1024'))
+
+
+class updateDeduplicator:
+    """Drops Telegram updates that were already delivered
+
+    Recently seen update ids are kept in memory for the life of the container,
+    other instances are covered by a conditional write in DynamoDB.
+    """
+
+    def __init__(self, dynamoDB_client: dynamoDBClient, namespace: str,
+                 cache_size: int = UPDATE_DEDUP_CACHE_SIZE, ttl: int = UPDATE_DEDUP_TTL) -> None:
+        self.dynamoDB_client = dynamoDB_client
+        self.namespace = namespace
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.seen: "OrderedDict[int, None]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats: Dict[str, int] = {"accepted": 0, "suppressed_memory": 0, "suppressed_storage": 0}
+
+    def claim(self, update_id) -> bool:
+        """Returns True the first time an update is seen, False for its duplicates"""
+        with self.lock:
+            if update_id in self.seen:
+                self.seen.move_to_end(update_id)
+                self.stats["suppressed_memory"] += 1
+                metrics.add("duplicate_updates_memory")
+                metrics.set_property("update_id", update_id)
+                return False
+            self.seen[update_id] = None
+            if len(self.seen) > self.cache_size:
+                self.seen.popitem(last=False)
+
+        if not self.dynamoDB_client.claim_update(f"{UPDATE_KEY_PREFIX}{update_id}_{self.namespace}", self.ttl):
+            self.stats["suppressed_storage"] += 1
+            metrics.add("duplicate_updates_storage")
+            metrics.set_property("update_id", update_id)
+            return False
+        self.stats["accepted"] += 1
+        return True
+
+    def release(self, update_id) -> None:
+        """Forget a claimed update that failed, so Telegram's redelivery of it is processed"""
+        with self.lock:
+            self.seen.pop(update_id, None)
+        self.dynamoDB_client.release_update(f"{UPDATE_KEY_PREFIX}{update_id}_{self.namespace}")
+        metrics.add("released_updates")
+
+    @property
+    def suppressed(self) -> int:
+        return self.stats["suppressed_memory"] + self.stats["suppressed_storage"]
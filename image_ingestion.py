@@ -0,0 +1,107 @@
+"""Preparation of user photos for the model.
+
+The smallest Telegram PhotoSize that still meets the target resolution is
+downloaded, downscaled and recompressed when Pillow is installed, and
+base64-encoded chunk by chunk.
+"""
+import base64
+import functools
+import io
+import os
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from logger import get_logger
+
+# The model scales images down to a 768 px shorter side (and 2048 px longer side) anyway
+IMAGE_TARGET_SIZE = int(os.environ.get('IMAGE_TARGET_SIZE', '768'))
+IMAGE_MAX_SIZE = int(os.environ.get('IMAGE_MAX_SIZE', '2048'))
+IMAGE_RECOMPRESS = os.environ.get('IMAGE_RECOMPRESS', 'true').lower() == 'true'
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', '85'))
+
+log = get_logger("telegram")
+
+
+@functools.lru_cache(maxsize=None)
+def _pillow():
+    """PIL.Image, imported on first use so updates without photos do not load it; None if it is not installed"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+
+def image_mime_type(data: bytes, default: str = "image/jpeg") -> str:
+    """MIME type of an image from its first bytes"""
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith(b"GIF8"):
+        return "image/gif"
+    return default
+
+
+def select_photo_size(photo_sizes: List[Dict[str, Any]], target: int = IMAGE_TARGET_SIZE) -> Dict[str, Any]:
+    """The smallest PhotoSize whose shorter side reaches `target`, the largest one if none does"""
+    sizes = sorted(photo_sizes, key=lambda size: size.get("width", 0) * size.get("height", 0))
+    for size in sizes:
+        if min(size.get("width", 0), size.get("height", 0)) >= target:
+            return size
+    return sizes[-1]
+
+
+def base64_chunks(chunks: Iterable[bytes]) -> Tuple[str, int]:
+    """Base64 of the concatenated chunks without joining the raw bytes, with their total length"""
+    parts: List[str] = []
+    rest = b""
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        data = rest + chunk
+        # Only whole 3-byte groups can be encoded without padding
+        cut = len(data) - len(data) % 3
+        parts.append(base64.b64encode(data[:cut]).decode("ascii"))
+        rest = data[cut:]
+    parts.append(base64.b64encode(rest).decode("ascii"))
+    return "".join(parts), total
+
+
+def recompress(data: bytes, target: int = IMAGE_TARGET_SIZE, max_size: int = IMAGE_MAX_SIZE,
+               quality: int = IMAGE_JPEG_QUALITY) -> Optional[bytes]:
+    """The image downscaled to the target resolution as JPEG, None if that would not make it smaller"""
+    Image = _pillow()
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+            scale = min(1.0, target / min(width, height), max_size / max(width, height))
+            if scale < 1.0:
+                image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+            output = io.BytesIO()
+            image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+    except (OSError, ValueError) as exc:
+        log.warning("Could not recompress an image: %s", exc)
+        return None
+    return output.getvalue() if output.tell() < len(data) else None
+
+
+def encode_image(chunks: Iterable[bytes], recompress_image: bool = IMAGE_RECOMPRESS) -> Tuple[str, Dict[str, int]]:
+    """Base64 of a downloaded image, recompressed when enabled and possible
+
+    Returns the encoded image and {"downloaded_bytes", "encoded_bytes"}.
+    """
+    if recompress_image and _pillow() is not None:
+        # Pillow needs the whole file, so it is read once into a single buffer
+        buffer = io.BytesIO()
+        for chunk in chunks:
+            buffer.write(chunk)
+        data = buffer.getvalue()
+        encoded = base64.b64encode(recompress(data) or data).decode("ascii")
+        downloaded = len(data)
+    else:
+        encoded, downloaded = base64_chunks(chunks)
+    return encoded, {"downloaded_bytes": downloaded, "encoded_bytes": len(encoded)}
@@ -1,16 +1,59 @@
 import json
+import os
 
-from telegram_client import telegramClient
+import metrics
+from logger import get_logger
+from idempotency import updateDeduplicator
+from telegram_client import telegramClient, dynamoDB_client, BOT_ID, COALESCE_WINDOW, ALBUM_CLAIM_KEY
+from work_queue import create_work_queue, drain
 
-telegram_client = telegramClient()
+# "sync" processes updates in the webhook, "queue" hands them to worker_handler
+PROCESSING_MODE = os.environ.get('PROCESSING_MODE', 'sync')
 
+log = get_logger("telegram")
+
+# The queue hands a chat's updates over one after another, they never overlap to be coalesced
+telegram_client = telegramClient(coalesce_window=0 if PROCESSING_MODE == "queue" else COALESCE_WINDOW)
+deduplicator = updateDeduplicator(dynamoDB_client, str(BOT_ID))
+work_queue = create_work_queue() if PROCESSING_MODE == "queue" else None
+
+@metrics.trace("lambda_handler")
 def lambda_handler(event, context):
     if "body" in event:
+        metrics.put("update_bytes", len(event["body"] or ""), metrics.BYTES)
+        claimed = None
         try:
             body = json.loads(event["body"])
-            telegram_client.process_message(body)
-        except Exception as e: 
-            print(e)
+            chat_id = telegram_client.validate_update(body)
+            # Telegram resends updates whose webhook was slow, they are dropped here
+            if chat_id is not None and "update_id" in body and not deduplicator.claim(body["update_id"]):
+                return {
+                    'statusCode': 200,
+                    'body': "Duplicate"
+                }
+            if chat_id is not None:
+                claimed = body.get("update_id")
+            if PROCESSING_MODE == "queue":
+                if chat_id is not None:
+                    # The photos of an album are only buffered here, the worker waits for the album
+                    claim_at = telegram_client.buffer_album(body)
+                    if claim_at is not None:
+                        body = dict(body, **{ALBUM_CLAIM_KEY: claim_at})
+                    work_queue.put(chat_id, body)
+            else:
+                # The photos of an album are answered once, by the update that carries all of them
+                if chat_id is not None:
+                    body = telegram_client.collect_album(body)
+                if body is None:
+                    return {
+                        'statusCode': 200,
+                        'body': "Buffered"
+                    }
+                telegram_client.process_message(body)
+        except Exception as e:
+            log.error("Could not handle the update: %s", e)
+            if claimed is not None:
+                deduplicator.release(claimed)
             return {
                 'statusCode': 200,
                 'body': "Error"
@@ -18,4 +61,34 @@ def lambda_handler(event, context):
     return {
         'statusCode': 200,
         'body': "Success"
-    }
\ No newline at end of file
+    }
+
+def worker_handler(event, context):
+    """Process the updates queued by lambda_handler
+
+    Invoked by an SQS FIFO event source with a batch of records, or with any
+    other event to drain the configured queue (e.g. the local SQLite one).
+    """
+    if "Records" not in event:
+        processed = drain(work_queue or create_work_queue(), telegram_client.process_queued)
+        return {
+            'statusCode': 200,
+            'body': f"Processed {processed} updates"
+        }
+
+    # Once an update of a chat fails the following ones of the same chat are
+    # returned too, so SQS redelivers them in order
+    failures = []
+    failed_chats = set()
+    for record in event["Records"]:
+        chat = record.get("attributes", {}).get("MessageGroupId")
+        if chat in failed_chats:
+            failures.append({"itemIdentifier": record["messageId"]})
+            continue
+        try:
+            telegram_client.process_queued(json.loads(record["body"]))
+        except Exception as e:
+            log.error("Could not process queued update %s: %s", record["messageId"], e)
+            failures.append({"itemIdentifier": record["messageId"]})
+            failed_chats.add(chat)
+    return {"batchItemFailures": failures}
@@ -0,0 +1,435 @@
+"""In-memory stand-in for the boto3 DynamoDB resource.
+
+Implements the subset of the Table API used by dynamoDBClient (items, key
+conditions, update/condition expressions, projections, batch writes) and
+counts requests and consumed capacity units, so storage layouts can be
+tested and benchmarked without AWS.
+"""
+import copy
+import math
+import re
+import threading
+import time
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+TOKEN_PATTERN = re.compile(r"\s*(<>|<=|>=|[=<>+\-(),\[\]]|:[A-Za-z0-9_]+|#[A-Za-z0-9_]+|[A-Za-z_][A-Za-z0-9_.]*|\d+)")
+FUNCTIONS = {"list_append", "if_not_exists", "size", "attribute_exists", "attribute_not_exists", "begins_with"}
+KEYWORDS = {"AND", "OR", "NOT", "BETWEEN", "SET", "REMOVE"}
+
+_MISSING = object()
+
+
+def _tokenize(expression: str) -> List[str]:
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        if not match:
+            raise ValueError(f"Unsupported expression: {expression}")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+def _to_dynamo(value: Any) -> Any:
+    """Mimic boto3: numbers come back as Decimal"""
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, list):
+        return [_to_dynamo(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _to_dynamo(item) for key, item in value.items()}
+    if isinstance(value, bytearray):
+        return bytes(value)
+    return value
+
+
+def _value_size(value: Any) -> int:
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (int, float, Decimal)):
+        return len(str(value)) // 2 + 1
+    if isinstance(value, list):
+        return 3 + sum(_value_size(item) + 1 for item in value)
+    if isinstance(value, dict):
+        return 3 + sum(len(key) + _value_size(item) + 1 for key, item in value.items())
+    return 1
+
+
+def item_size(item: Dict[str, Any]) -> int:
+    """Approximate DynamoDB item size in bytes"""
+    return sum(len(name.encode("utf-8")) + _value_size(value) for name, value in item.items())
+
+
+class _ExpressionEvaluator:
+    def __init__(self, tokens: List[str], names: Optional[Dict[str, str]], values: Optional[Dict[str, Any]]) -> None:
+        self.tokens = tokens
+        self.position = 0
+        self.names = names or {}
+        self.values = {key: _to_dynamo(value) for key, value in (values or {}).items()}
+
+    def peek(self) -> Optional[str]:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected: Optional[str] = None) -> str:
+        token = self.peek()
+        if token is None or (expected is not None and token.upper() != expected):
+            raise ValueError(f"Expected {expected}, got {token}")
+        self.position += 1
+        return token
+
+    def parse_path(self) -> List[Any]:
+        path: List[Any] = []
+        for segment in self.take().split("."):
+            path.append(self.names.get(segment, segment))
+        while self.peek() == "[":
+            self.take("[")
+            path.append(int(self.take()))
+            self.take("]")
+        return path
+
+    def resolve(self, item: Dict[str, Any], path: List[Any]) -> Any:
+        current: Any = item
+        for segment in path:
+            if isinstance(segment, int):
+                if not isinstance(current, list) or segment >= len(current):
+                    return _MISSING
+                current = current[segment]
+            else:
+                if not isinstance(current, dict) or segment not in current:
+                    return _MISSING
+                current = current[segment]
+        return current
+
+    def operand(self, item: Dict[str, Any]) -> Any:
+        token = self.peek()
+        if token.startswith(":"):
+            self.take()
+            return self.values[token]
+        if token in FUNCTIONS and self.tokens[self.position + 1:self.position + 2] == ["("]:
+            return self.function(item)
+        return self.resolve(item, self.parse_path())
+
+    def function(self, item: Dict[str, Any]) -> Any:
+        name = self.take()
+        self.take("(")
+        if name in ("attribute_exists", "attribute_not_exists"):
+            value = self.resolve(item, self.parse_path())
+            self.take(")")
+            return (value is not _MISSING) == (name == "attribute_exists")
+        first = self.operand(item)
+        if name == "size":
+            self.take(")")
+            return 0 if first is _MISSING else len(first)
+        self.take(",")
+        if name == "if_not_exists":
+            default = self.operand(item)
+            self.take(")")
+            return default if first is _MISSING else first
+        second = self.operand(item)
+        self.take(")")
+        if name == "list_append":
+            return list(first) + list(second)
+        return isinstance(first, str) and first.startswith(second)
+
+    def value(self, item: Dict[str, Any]) -> Any:
+        result = self.operand(item)
+        while self.peek() in ("+", "-"):
+            operator = self.take()
+            other = self.operand(item)
+            result = result + other if operator == "+" else result - other
+        return result
+
+    def condition(self, item: Dict[str, Any]) -> bool:
+        result = self.conjunction(item)
+        while self.peek() and self.peek().upper() == "OR":
+            self.take()
+            other = self.conjunction(item)
+            result = result or other
+        return result
+
+    def conjunction(self, item: Dict[str, Any]) -> bool:
+        result = self.negation(item)
+        while self.peek() and self.peek().upper() == "AND":
+            self.take()
+            other = self.negation(item)
+            result = result and other
+        return result
+
+    def negation(self, item: Dict[str, Any]) -> bool:
+        if self.peek() and self.peek().upper() == "NOT":
+            self.take()
+            return not self.negation(item)
+        if self.peek() == "(":
+            self.take("(")
+            result = self.condition(item)
+            self.take(")")
+            return result
+        token = self.peek()
+        if token in ("attribute_exists", "attribute_not_exists", "begins_with"):
+            return self.function(item)
+        left = self.operand(item)
+        operator = self.take()
+        if operator.upper() == "BETWEEN":
+            low = self.operand(item)
+            self.take("AND")
+            high = self.operand(item)
+            return left is not _MISSING and low <= left <= high
+        right = self.operand(item)
+        if left is _MISSING or right is _MISSING:
+            return operator == "<>"
+        return {
+            "=": left == right, "<>": left != right, "<": left < right,
+            "<=": left <= right, ">": left > right, ">=": left >= right,
+        }[operator]
+
+    def update(self, item: Dict[str, Any]) -> List[str]:
+        updated = []
+        source = copy.deepcopy(item)
+        while self.peek() is not None:
+            clause = self.take().upper()
+            while True:
+                path = self.parse_path()
+                updated.append(path[0])
+                if clause == "SET":
+                    self.take("=")
+                    self._assign(item, path, self.value(source))
+                elif clause == "REMOVE":
+                    self._remove(item, path)
+                else:
+                    raise ValueError(f"Unsupported update clause {clause}")
+                if self.peek() != ",":
+                    break
+                self.take(",")
+        return updated
+
+    def _assign(self, item: Dict[str, Any], path: List[Any], value: Any) -> None:
+        parent = self.resolve(item, path[:-1]) if len(path) > 1 else item
+        if isinstance(path[-1], int):
+            if path[-1] >= len(parent):
+                parent.append(value)
+            else:
+                parent[path[-1]] = value
+        else:
+            parent[path[-1]] = value
+
+    def _remove(self, item: Dict[str, Any], path: List[Any]) -> None:
+        parent = self.resolve(item, path[:-1]) if len(path) > 1 else item
+        if isinstance(path[-1], int):
+            if isinstance(parent, list) and path[-1] < len(parent):
+                parent.pop(path[-1])
+        elif isinstance(parent, dict):
+            parent.pop(path[-1], None)
+
+
+def _condition_holds(item: Dict[str, Any], expression: Optional[str], names, values) -> bool:
+    if not expression:
+        return True
+    return _ExpressionEvaluator(_tokenize(expression), names, values).condition(item)
+
+
+def _project(item: Dict[str, Any], projection: Optional[str], names) -> Dict[str, Any]:
+    if not projection:
+        return copy.deepcopy(item)
+    attributes = [(names or {}).get(name.strip(), name.strip()) for name in projection.split(",")]
+    return {name: copy.deepcopy(item[name]) for name in attributes if name in item}
+
+
+class localTable:
+    """A single in-memory table with optional simulated network latency"""
+
+    def __init__(self, name: str, key_schema: Tuple[str, ...] = ("chat_id",), latency: float = 0.0) -> None:
+        self.name = name
+        self.key_schema = key_schema
+        self.latency = latency
+        self.items: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+        self.request_count = 0
+        self.read_units = 0.0
+        self.write_units = 0.0
+        self._lock = threading.Lock()
+
+    def reset_stats(self) -> None:
+        self.request_count = 0
+        self.read_units = 0.0
+        self.write_units = 0.0
+
+    def _request(self) -> None:
+        self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _key(self, key: Dict[str, Any]) -> Tuple[Any, ...]:
+        return tuple(_to_dynamo(key[name]) for name in self.key_schema)
+
+    def _conditional_failure(self, operation: str) -> ClientError:
+        return ClientError(
+            {"Error": {"Code": "ConditionalCheckFailedException", "Message": "The conditional request failed"}},
+            operation,
+        )
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, **kwargs):
+        self._request()
+        with self._lock:
+            key = self._key(Item)
+            current = self.items.get(key, {})
+            if not _condition_holds(current, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+                self.write_units += 1
+                raise self._conditional_failure("PutItem")
+            item = _to_dynamo(copy.deepcopy(Item))
+            self.write_units += max(1, math.ceil(max(item_size(item), item_size(current)) / 1024))
+            self.items[key] = item
+        return {}
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, ConsistentRead=False, **kwargs):
+        self._request()
+        with self._lock:
+            item = self.items.get(self._key(Key))
+            size = item_size(item) if item else 0
+            self.read_units += max(1, math.ceil(size / 4096)) * (1 if ConsistentRead else 0.5)
+            if item is None:
+                return {}
+            return {"Item": _project(item, ProjectionExpression, ExpressionAttributeNames)}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                    ReturnValues="NONE", **kwargs):
+        self._request()
+        with self._lock:
+            key = self._key(Key)
+            current = self.items.get(key, {})
+            if not _condition_holds(current, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+                self.write_units += 1
+                raise self._conditional_failure("DeleteItem")
+            self.write_units += max(1, math.ceil(item_size(current) / 1024))
+            self.items.pop(key, None)
+        if ReturnValues == "ALL_OLD" and current:
+            return {"Attributes": copy.deepcopy(current)}
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues="NONE", **kwargs):
+        self._request()
+        with self._lock:
+            key = self._key(Key)
+            current = self.items.get(key)
+            item = copy.deepcopy(current) if current is not None else _to_dynamo(copy.deepcopy(Key))
+            if not _condition_holds(current or {}, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+                self.write_units += 1
+                raise self._conditional_failure("UpdateItem")
+            evaluator = _ExpressionEvaluator(_tokenize(UpdateExpression), ExpressionAttributeNames, ExpressionAttributeValues)
+            updated = evaluator.update(item)
+            self.write_units += max(1, math.ceil(max(item_size(item), item_size(current or {})) / 1024))
+            self.items[key] = item
+            if ReturnValues == "ALL_NEW":
+                return {"Attributes": copy.deepcopy(item)}
+            if ReturnValues == "UPDATED_NEW":
+                return {"Attributes": {name: copy.deepcopy(item[name]) for name in updated if name in item}}
+            if ReturnValues == "ALL_OLD" and current:
+                return {"Attributes": copy.deepcopy(current)}
+            if ReturnValues == "UPDATED_OLD" and current:
+                return {"Attributes": {name: copy.deepcopy(current[name]) for name in updated if name in current}}
+        return {}
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues=None, ExpressionAttributeNames=None,
+              ScanIndexForward=True, Limit=None, ExclusiveStartKey=None, ProjectionExpression=None,
+              ConsistentRead=False, **kwargs):
+        self._request()
+        with self._lock:
+            matches = [
+                item for item in self.items.values()
+                if _condition_holds(item, KeyConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+            ]
+            matches.sort(key=lambda item: tuple(item[name] for name in self.key_schema), reverse=not ScanIndexForward)
+            if ExclusiveStartKey:
+                start = self._key(ExclusiveStartKey)
+                positions = [self._key(item) for item in matches]
+                matches = matches[positions.index(start) + 1:] if start in positions else matches
+            page = matches[:Limit] if Limit else matches
+            self.read_units += max(1, math.ceil(sum(item_size(item) for item in page) / 4096)) * (1 if ConsistentRead else 0.5)
+            response: Dict[str, Any] = {
+                "Items": [_project(item, ProjectionExpression, ExpressionAttributeNames) for item in page],
+                "Count": len(page),
+            }
+            if Limit and len(matches) > Limit:
+                response["LastEvaluatedKey"] = {name: page[-1][name] for name in self.key_schema}
+            return response
+
+    def scan(self, ExclusiveStartKey=None, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        self._request()
+        with self._lock:
+            items = list(self.items.values())
+            self.read_units += max(1, math.ceil(sum(item_size(item) for item in items) / 4096)) * 0.5
+            return {"Items": [_project(item, ProjectionExpression, ExpressionAttributeNames) for item in items]}
+
+    def batch_writer(self, **kwargs) -> "_localBatchWriter":
+        return _localBatchWriter(self)
+
+
+class _localBatchWriter:
+    """Buffers writes and flushes them 25 at a time like BatchWriteItem"""
+
+    def __init__(self, table: localTable) -> None:
+        self.table = table
+        self.pending: List[Tuple[str, Dict[str, Any]]] = []
+
+    def put_item(self, Item):
+        self.pending.append(("put", Item))
+        if len(self.pending) >= 25:
+            self._flush()
+
+    def delete_item(self, Key):
+        self.pending.append(("delete", Key))
+        if len(self.pending) >= 25:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self.pending:
+            return
+        self.table._request()
+        with self.table._lock:
+            for action, payload in self.pending:
+                key = self.table._key(payload)
+                current = self.table.items.get(key, {})
+                if action == "put":
+                    item = _to_dynamo(copy.deepcopy(payload))
+                    self.table.write_units += max(1, math.ceil(max(item_size(item), item_size(current)) / 1024))
+                    self.table.items[key] = item
+                else:
+                    self.table.write_units += max(1, math.ceil(item_size(current) / 1024))
+                    self.table.items.pop(key, None)
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._flush()
+
+
+class localDynamoDBResource:
+    """Drop-in replacement for boto3.resource('dynamodb')"""
+
+    def __init__(self, key_schemas: Optional[Dict[str, Tuple[str, ...]]] = None, latency: float = 0.0) -> None:
+        self.key_schemas = key_schemas or {}
+        self.latency = latency
+        self.tables: Dict[str, localTable] = {}
+
+    def Table(self, name: str) -> localTable:
+        if name not in self.tables:
+            self.tables[name] = localTable(name, self.key_schemas.get(name, ("chat_id",)), self.latency)
+        return self.tables[name]
+
+    @property
+    def request_count(self) -> int:
+        return sum(table.request_count for table in self.tables.values())
+
+    def reset_stats(self) -> None:
+        for table in self.tables.values():
+            table.reset_stats()
@@ -0,0 +1,140 @@
+"""Local stand-in for the Telegram Bot API, for tests.
+
+An HTTP server on 127.0.0.1 that answers sendMessage, editMessageText,
+deleteMessage, sendPhoto and getFile like Telegram does and serves files.
+It records every call, can be told to fail the next calls (429 with a
+`retry_after`, or server errors) and, like Telegram's flood control, answers
+429 when a chat gets messages faster than `chat_interval`.
+"""
+import json
+import math
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+
+def _multipart_fields(content_type: str, body: bytes) -> Dict[str, Any]:
+    message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    fields: Dict[str, Any] = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        data = part.get_payload(decode=True)
+        fields[name] = data if part.get_filename() else data.decode("utf-8")
+    return fields
+
+
+class localTelegramServer:
+    def __init__(self, token: str = "token", chat_interval: float = 0.0) -> None:
+        self.token = token
+        self.chat_interval = chat_interval
+        self.calls: List[Dict[str, Any]] = []
+        self.files: Dict[str, bytes] = {}
+        self.failures: List[Dict[str, Any]] = []
+        self.last_message_at: Dict[Any, float] = {}
+        self.message_id = 0
+        self.lock = threading.Lock()
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def fail_next(self, count: int = 1, status: int = 429, retry_after: Optional[float] = 1) -> None:
+        """Answer the next `count` calls with `status` (and `retry_after` for 429)"""
+        with self.lock:
+            self.failures += [{"status": status, "retry_after": retry_after}] * count
+
+    def calls_of(self, method: str) -> List[Dict[str, Any]]:
+        return [call for call in self.calls if call["method"] == method]
+
+    def start(self) -> "localTelegramServer":
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def __enter__(self) -> "localTelegramServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _answer(self, method: str, payload: Dict[str, Any]):
+        """Status and body of a Bot API call"""
+        with self.lock:
+            now = time.monotonic()
+            self.calls.append({"method": method, "payload": payload, "time": now})
+            if self.failures:
+                failure = self.failures.pop(0)
+                body: Dict[str, Any] = {"ok": False, "error_code": failure["status"], "description": "Injected failure"}
+                if failure["status"] == 429:
+                    body["parameters"] = {"retry_after": failure["retry_after"]}
+                return failure["status"], body
+            chat_id = payload.get("chat_id")
+            if method in ("sendMessage", "sendPhoto", "editMessageText") and chat_id is not None:
+                previous = self.last_message_at.get(str(chat_id))
+                if previous is not None and now - previous < self.chat_interval:
+                    retry_after = math.ceil(self.chat_interval - (now - previous))
+                    return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                 "parameters": {"retry_after": retry_after}}
+                self.last_message_at[str(chat_id)] = now
+            if method in ("sendMessage", "sendPhoto"):
+                self.message_id += 1
+                result: Any = {"message_id": self.message_id, "chat": {"id": chat_id}, "text": payload.get("text")}
+                if method == "sendPhoto":
+                    photo = payload.get("photo")
+                    file_id = photo if isinstance(photo, str) else f"photo-{self.message_id}"
+                    result["photo"] = [{"file_id": file_id, "file_unique_id": file_id}]
+                return 200, {"ok": True, "result": result}
+            if method == "getFile":
+                file_id = payload.get("file_id")
+                if file_id not in self.files:
+                    return 400, {"ok": False, "error_code": 400, "description": "Bad Request: invalid file_id"}
+                return 200, {"ok": True, "result": {"file_id": file_id, "file_path": file_id}}
+            return 200, {"ok": True, "result": True}
+
+    def _handler(self):
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def _send(self, status: int, body: bytes, content_type: str) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self) -> None:
+                prefix = f"/file/bot{server.token}/"
+                data = server.files.get(self.path[len(prefix):]) if self.path.startswith(prefix) else None
+                if data is None:
+                    self._send(404, b"Not Found", "text/plain")
+                else:
+                    self._send(200, data, "application/octet-stream")
+
+            def do_POST(self) -> None:
+                prefix = f"/bot{server.token}/"
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if not self.path.startswith(prefix):
+                    self._send(404, json.dumps({"ok": False, "error_code": 404}).encode(), "application/json")
+                    return
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("multipart/form-data"):
+                    payload = _multipart_fields(content_type, body)
+                else:
+                    payload = json.loads(body or b"{}")
+                status, answer = server._answer(self.path[len(prefix):], payload)
+                self._send(status, json.dumps(answer).encode(), "application/json")
+
+        return handler
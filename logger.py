@@ -0,0 +1,100 @@
+"""Leveled log lines with per-category sampling and redaction of secrets.
+
+Lines keep the `[LOG]`, `[DEBUG]`, `[WARNING]` and `[ERROR]` prefixes. The
+message is formatted with its %-style arguments only when the line is
+written, i.e. when its level reaches LOG_LEVEL and the sampling of its
+category keeps it. Warnings and errors are never sampled out. Bot tokens,
+API keys and base64 payloads (images) are masked in every written line.
+"""
+import os
+import random
+import re
+from typing import Any, Dict
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+_LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+_PREFIXES = {DEBUG: "[DEBUG]", INFO: "[LOG]", WARNING: "[WARNING]", ERROR: "[ERROR]"}
+
+LOG_LEVEL = _LEVELS.get(os.environ.get('LOG_LEVEL', 'INFO').upper(), INFO)
+# Share of the debug and info lines of a category that are written, e.g. "update=0.01,tools=0.5"
+LOG_SAMPLING = os.environ.get('LOG_SAMPLING', '')
+
+# Longer base64 runs are images or files, never something worth reading in a log
+BASE64_MIN_LENGTH = 200
+
+_SECRETS = [value for value in (os.environ.get(name) for name in ('TELEGRAM_TOKEN', 'OPENAI_KEY', 'GEMINI_API_KEY'))
+            if value and len(value) >= 8]
+_PATTERNS = [
+    (re.compile(r"bot\d+:[A-Za-z0-9_-]{30,}"), "bot<redacted>"),
+    (re.compile(r"\b\d{6,}:[A-Za-z0-9_-]{30,}\b"), "<redacted token>"),
+    (re.compile(r"\bsk-[A-Za-z0-9_-]{20,}"), "<redacted key>"),
+    (re.compile(r"\bAIza[0-9A-Za-z_-]{35}"), "<redacted key>"),
+    (re.compile(r"data:([\w/+.-]+);base64,[A-Za-z0-9+/=]+"), r"data:\1;base64,<redacted>"),
+]
+_BASE64 = re.compile(r"[A-Za-z0-9+/]{%d,}={0,2}" % BASE64_MIN_LENGTH)
+# The repr of raw binary data, e.g. image bytes
+_BYTES = re.compile(r"b'(?=(?:[^'\\]|\\[^x])*\\x)(?:[^'\\]|\\.){%d,}'" % BASE64_MIN_LENGTH)
+
+
+def _sample_rates(setting: str) -> Dict[str, float]:
+    rates = {}
+    for entry in setting.split(","):
+        if "=" in entry:
+            category, rate = entry.split("=", 1)
+            try:
+                rates[category.strip()] = min(1.0, max(0.0, float(rate)))
+            except ValueError:
+                print(f"[WARNING] Ignoring the LOG_SAMPLING entry {entry!r}")
+    return rates
+
+
+_SAMPLE_RATES = _sample_rates(LOG_SAMPLING)
+
+
+def redact(text: str) -> str:
+    """The text with tokens, keys and base64 payloads masked"""
+    for secret in _SECRETS:
+        text = text.replace(secret, "<redacted>")
+    for pattern, replacement in _PATTERNS:
+        text = pattern.sub(replacement, text)
+    text = _BYTES.sub("<binary data>", text)
+    return _BASE64.sub(lambda match: f"<base64 {len(match.group(0))} chars>", text)
+
+
+class categoryLogger:
+    def __init__(self, category: str) -> None:
+        self.category = category
+        self.sample_rate = _SAMPLE_RATES.get(category, 1.0)
+
+    def enabled(self, level: int) -> bool:
+        """Whether lines of `level` are written at all, to skip building expensive diagnostics"""
+        return level >= LOG_LEVEL and (level >= WARNING or self.sample_rate > 0)
+
+    def log(self, level: int, message: str, *args: Any) -> None:
+        if level < LOG_LEVEL:
+            return
+        if level < WARNING and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        if args:
+            message = message % args
+        print(f"{_PREFIXES[level]} {redact(message)}")
+
+    def debug(self, message: str, *args: Any) -> None:
+        self.log(DEBUG, message, *args)
+
+    def info(self, message: str, *args: Any) -> None:
+        self.log(INFO, message, *args)
+
+    def warning(self, message: str, *args: Any) -> None:
+        self.log(WARNING, message, *args)
+
+    def error(self, message: str, *args: Any) -> None:
+        self.log(ERROR, message, *args)
+
+
+def get_logger(category: str) -> categoryLogger:
+    return categoryLogger(category)
@@ -0,0 +1,96 @@
+"""Size-bounded cache of media on local disk.
+
+Downloaded photos are kept under the file_unique_id Telegram gives them,
+generated images map their content hash to the file_id Telegram returned
+when they were first sent. Files are evicted least recently used first once
+the cache exceeds its size.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from logger import get_logger
+
+MEDIA_CACHE_PATH = os.environ.get('MEDIA_CACHE_PATH', '/tmp/media_cache')
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+log = get_logger("storage")
+
+
+def content_key(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class mediaCache:
+    def __init__(self, path: str = MEDIA_CACHE_PATH, max_bytes: int = MEDIA_CACHE_MAX_BYTES) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        # file name -> size, least recently used first
+        self.files: "OrderedDict[str, int]" = OrderedDict()
+        self.size = 0
+        if os.path.isdir(path):
+            # Files left by an earlier process of the same container
+            entries = sorted(os.scandir(path), key=lambda entry: entry.stat().st_mtime)
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    self.files[entry.name] = entry.stat().st_size
+                    self.size += entry.stat().st_size
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _name(self, namespace: str, key: str) -> str:
+        # Keys come from Telegram, only safe characters are used in file names
+        return f"{namespace}-{hashlib.sha1(key.encode('utf-8')).hexdigest()}"
+
+    def get(self, namespace: str, key: str) -> Optional[bytes]:
+        if not self.enabled:
+            return None
+        name = self._name(namespace, key)
+        with self.lock:
+            if name not in self.files:
+                self.stats["misses"] += 1
+                return None
+            self.files.move_to_end(name)
+        try:
+            with open(os.path.join(self.path, name), "rb") as file:
+                data = file.read()
+        except OSError:
+            with self.lock:
+                self.size -= self.files.pop(name, 0)
+                self.stats["misses"] += 1
+            return None
+        with self.lock:
+            self.stats["hits"] += 1
+        return data
+
+    def put(self, namespace: str, key: str, data: bytes) -> None:
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        name = self._name(namespace, key)
+        file_path = os.path.join(self.path, name)
+        temporary = f"{file_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(temporary, "wb") as file:
+                file.write(data)
+            os.replace(temporary, file_path)
+        except OSError as exc:
+            log.warning("Could not cache %s media: %s", namespace, exc)
+            return
+        with self.lock:
+            self.size += len(data) - self.files.pop(name, 0)
+            self.files[name] = len(data)
+            while self.size > self.max_bytes and self.files:
+                evicted, size = self.files.popitem(last=False)
+                self.size -= size
+                self.stats["evictions"] += 1
+                try:
+                    os.remove(os.path.join(self.path, evicted))
+                except OSError:
+                    pass
@@ -0,0 +1,159 @@
+"""Per-invocation metrics written as CloudWatch Embedded Metric Format (EMF) lines.
+
+An invocation runs inside `trace`. The stage durations, sizes and counters
+recorded meanwhile are written as one JSON line when the outermost trace
+ends, and CloudWatch extracts the metrics from the log. The trace belongs to
+the thread that started it; work handed to other threads records into it when
+it is wrapped with `in_current_trace`. Values recorded outside a trace are
+written right away. With
+METRICS_ENABLED=false nothing is collected and `timed` leaves functions as
+they are.
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from typing import Any, Callable, ContextManager, Dict, Iterator, Optional
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ChatGPTBot')
+
+MILLISECONDS = "Milliseconds"
+BYTES = "Bytes"
+COUNT = "Count"
+NONE = "None"
+
+_lock = threading.Lock()
+# The record of the invocation being traced, invocations on other threads have their own
+_current: "contextvars.ContextVar[Optional[Dict[str, Any]]]" = contextvars.ContextVar("metrics_trace", default=None)
+_cold_start = True
+
+
+def _new_record(name: str) -> Dict[str, Any]:
+    return {"trace": name, "metrics": {}, "units": {}, "properties": {}}
+
+
+def _emit(record: Dict[str, Any]) -> None:
+    metrics = {name: round(value, 1) if isinstance(value, float) else value
+               for name, value in record["metrics"].items()}
+    line = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [["trace"]],
+                "Metrics": [{"Name": name, "Unit": record["units"][name]} for name in metrics],
+            }],
+        },
+        **record["properties"],
+        **metrics,
+        "trace": record["trace"],
+    }
+    print(json.dumps(line, default=str))
+
+
+def _record(name: str, value: float, unit: str, accumulate: bool) -> None:
+    if not METRICS_ENABLED:
+        return
+    record = _current.get()
+    if record is not None:
+        with _lock:
+            metrics = record["metrics"]
+            metrics[name] = metrics.get(name, 0) + value if accumulate else value
+            record["units"][name] = unit
+        return
+    record = _new_record("background")
+    record["metrics"][name] = value
+    record["units"][name] = unit
+    _emit(record)
+
+
+def put(name: str, value: float, unit: str = COUNT) -> None:
+    """Set a metric of the current invocation"""
+    _record(name, value, unit, False)
+
+
+def add(name: str, value: float = 1, unit: str = COUNT) -> None:
+    """Add to a metric of the current invocation, e.g. the bytes of several downloads"""
+    _record(name, value, unit, True)
+
+
+def set_property(name: str, value: Any) -> None:
+    """Attach a searchable value that is not a metric (e.g. a chat id) to the current invocation"""
+    if not METRICS_ENABLED:
+        return
+    record = _current.get()
+    if record is not None:
+        with _lock:
+            record["properties"][name] = value
+
+
+def stage(name: str) -> ContextManager[None]:
+    """Time a block as the `{name}_ms` metric, the times of a repeated stage add up"""
+    return _stage(name) if METRICS_ENABLED else nullcontext()
+
+
+@contextmanager
+def _stage(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(f"{name}_ms", (time.perf_counter() - started) * 1000, MILLISECONDS)
+
+
+def timed(name: str) -> Callable[[Callable], Callable]:
+    """Decorator form of `stage`"""
+    def decorator(function: Callable) -> Callable:
+        if not METRICS_ENABLED:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def trace(name: str) -> Iterator[None]:
+    """Collect the metrics of an invocation, a trace inside another one is only a stage of it"""
+    global _cold_start
+    if not METRICS_ENABLED:
+        yield
+        return
+    root = _current.get() is None
+    if root:
+        record = _new_record(name)
+        with _lock:
+            # The first invocation of a container paid for its imports
+            record["properties"]["cold_start"] = _cold_start
+            _cold_start = False
+        token = _current.set(record)
+    try:
+        with _stage(name):
+            yield
+    except Exception as exc:
+        set_property("error", type(exc).__name__)
+        add("errors")
+        raise
+    finally:
+        if root:
+            _current.reset(token)
+            with _lock:
+                _emit(record)
+
+
+def in_current_trace(function: Callable) -> Callable:
+    """`function` recording into the trace of the caller when it runs on another thread"""
+    context = contextvars.copy_context()
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        # Every call gets its own copy, a context cannot be entered by two threads at once
+        return context.copy().run(function, *args, **kwargs)
+    return wrapper
@@ -1,15 +1,25 @@
 import base64
 import os
 import json
+import math
 import uuid
 import re
-from typing import Any, Dict, List, Optional
-
-from google import genai
-from google.genai import types
-from openai import OpenAI
-
-from dinamodb_client import dynamoDBClient
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+import logger
+import metrics
+from dinamodb_client import dynamoDBClient, trim_history
+from generation_cache import generationCache, generation_key
+from image_ingestion import image_mime_type
+from media_cache import content_key
+from blob_store import create_blob_store
+from context_window import CONTEXT_TOKEN_BUDGET, IMAGE_TOKENS, count_tokens, message_tokens, reply_chain, select_context, with_token_count
+
+if TYPE_CHECKING:
+    from openai.types.chat import ChatCompletionMessage
 
 OPENAI_KEY = os.environ.get('OPENAI_KEY')
 OPENAI_MODEL = os.environ.get('OPENAI_MODEL')
@@ -22,6 +32,25 @@ BOT_NAME = os.environ.get('BOT_NAME', 'assistant')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 GEMINI_IMAGE_MODEL = os.environ.get('GEMINI_IMAGE_MODEL', 'gemini-2.5-flash-image')
 IMAGE_MIME_TYPE = os.environ.get('IMAGE_MIME_TYPE', 'image/png')
+TOOL_MAX_WORKERS = int(os.environ.get('TOOL_MAX_WORKERS', '3'))
+TOOL_CALL_TIMEOUT = float(os.environ.get('TOOL_CALL_TIMEOUT', '60'))
+HISTORY_IMAGE_LIMIT = int(os.environ.get('HISTORY_IMAGE_LIMIT', '2'))
+SUMMARY_TRIGGER = int(os.environ.get('SUMMARY_TRIGGER', '30'))
+SUMMARY_KEEP_RECENT = int(os.environ.get('SUMMARY_KEEP_RECENT', '10'))
+SUMMARY_MODEL = os.environ.get('SUMMARY_MODEL') or OPENAI_MODEL
+SUMMARY_MAX_TOKENS = int(os.environ.get('SUMMARY_MAX_TOKENS', '1000'))
+# Attempts to fold messages into the summary before the history drops them
+SUMMARY_FOLD_ATTEMPTS = 3
+
+TOOL_INSTRUCTION = "TOOL USAGE INSTRUCTIONS: If any member of the chat asks to create, draw or render an image or a picture in any language, always call the `generate_image` tool and do not describe the JSON yourself or answer with some text. Otherwise return concise, human-friendly answers without technical prefixes. "
+
+SUMMARY_INSTRUCTION = (
+    "You maintain the running summary of a Telegram chat. Merge the new messages into the current summary. "
+    "Keep who said what, facts about the members, decisions, open questions and what was asked of the bot. "
+    "Drop small talk. Answer with the updated summary only, in the language of the chat, in at most 300 words."
+)
+
+log = logger.get_logger("openai")
 
 
 def _text_from_content(content: Any) -> str:
@@ -60,6 +89,22 @@ SUPPORTED_ASPECT_RATIOS = {
 }
 
 
+def _message_ref(message: Dict[str, Any]) -> Optional[str]:
+    # Tool calls and tool responses have no Telegram id, their tool call id is used instead
+    if message.get("id"):
+        return str(message["id"])
+    if message.get("tool_call_id"):
+        return message["tool_call_id"]
+    tool_calls = message.get("tool_calls") or []
+    return tool_calls[0].get("id") if tool_calls else None
+
+
+def _summary_threshold() -> int:
+    # Fold well before the messages are evicted from the CONTEXT_LENGTH window,
+    # a reply with tool calls adds several records at once
+    return max(1, min(SUMMARY_TRIGGER, CONTEXT_LENGTH // 2))
+
+
 def _normalize_aspect_ratio(aspect_ratio: Optional[str]) -> Optional[str]:
     if not aspect_ratio:
         return None
@@ -69,13 +114,57 @@ def _normalize_aspect_ratio(aspect_ratio: Optional[str]) -> Optional[str]:
 
 class openaiClient:
     def __init__(self, dynamoDB_client: dynamoDBClient) -> None:
-        self.client = OpenAI(api_key=OPENAI_KEY)
         self.dynamoDB_client = dynamoDB_client
+        self.blob_store = create_blob_store()
+        self.image_cache = generationCache()
+        self._gemini_client = None
+        self._gemini_lock = threading.Lock()
+        # The prompt prefix is built once so it stays byte-identical between
+        # requests and is served from the provider's prompt cache
+        self.tools = self._build_tools()
+        self.prompt_prefix = [
+            {"role": "system", "content": [{"type": "text", "text": SYSTEM_PROMPT}]},
+            {"role": "system", "content": [{"type": "text", "text": TOOL_INSTRUCTION}]},
+        ]
+        # The SDK clients and the memory index (numpy) are created on first use,
+        # so a cold start only pays for what the first request needs
+        self._client = None
+        self._memory = None
+        self._lazy_lock = threading.RLock()
+        # Messages dropped from the stored history are kept in the long-term memory of the chat,
+        # and are folded into its summary before they are dropped
+        dynamoDB_client.on_evict = self._remember
+        dynamoDB_client.before_evict = self._summarize_evicted
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lazy_lock:
+                if self._client is None:
+                    from openai import OpenAI
+                    self._client = OpenAI(api_key=OPENAI_KEY)
+        return self._client
+
+    @property
+    def memory(self):
+        """The long-term memory of chats, False when MEMORY_TOP_K disables it"""
+        if self._memory is None:
+            import chat_memory
+            with self._lazy_lock:
+                if self._memory is None and chat_memory.MEMORY_TOP_K <= 0:
+                    self._memory = False
+                    # Evicted messages are not needed, the storage need not read them
+                    if self.dynamoDB_client.on_evict == self._remember:
+                        self.dynamoDB_client.on_evict = None
+                elif self._memory is None:
+                    embedder = chat_memory.create_embedder(self.client)
+                    self._memory = chat_memory.chatMemory(embedder, self.blob_store)
+        return self._memory
 
     def _chat_key(self, chat_id: int, bot_id: int) -> str:
         return f"{str(chat_id)}_{str(bot_id)}"
 
-    def _format_message_for_model(self, message: Dict[str, Any], include_style_prompt: bool = False) -> Dict[str, Any]:
+    def _format_message_for_model(self, message: Dict[str, Any]) -> Dict[str, Any]:
         # If this is a persisted tool call or tool response, return it directly.
         # They are stored as raw dicts from OpenAI API (role='tool' or role='assistant' with tool_calls)
         if message.get("role") == "tool":
@@ -105,23 +194,41 @@ class openaiClient:
             prefix_parts.append(f"in reply to message {reply_id}")
         prefix = " ".join(prefix_parts)
         text_body = message.get("text", "")
-        if include_style_prompt and STYLE_PROMPT:
-            text_body = f"{text_body}\n{STYLE_PROMPT}"
         content_parts: List[Dict[str, Any]] = [{"type": "text", "text": f"{prefix}:\n{text_body}"}]
-        for image in message.get("images", []):
-            content_parts.append({
-                "type": "image_url",
-                "image_url": {"url": f"data:{IMAGE_MIME_TYPE};base64,{image}"}
-            })
-        return {"role": message.get("role", "user"), "content": content_parts}
+        role = message.get("role", "user")
+        # Assistant messages only take text, their images are sent by `_format_history`
+        if role != "assistant":
+            content_parts += self._image_parts(message)
+        return {"role": role, "content": content_parts}
+
+    def _image_parts(self, message: Dict[str, Any]) -> List[Dict[str, Any]]:
+        parts = [{"type": "image_url", "image_url": {"url": f"data:{IMAGE_MIME_TYPE};base64,{image}"}}
+                 for image in message.get("images", [])]
+        # Images of older messages, loaded from the blob store for this request
+        parts += [{"type": "image_url", "image_url": {"url": f"data:{image['mime_type']};base64,{image['data']}"}}
+                  for image in message.get("_images", [])]
+        return parts
+
+    def _format_history(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """The messages in the model's format, images the bot generated follow as user messages"""
+        formatted = []
+        for message in messages:
+            formatted.append(self._format_message_for_model(message))
+            if message.get("role") == "assistant" and not message.get("tool_calls"):
+                parts = self._image_parts(message)
+                if parts:
+                    formatted.append({"role": "user", "content": [{"type": "text", "text": (
+                        f"Image previously generated by @{BOT_NAME} (message {message.get('id')}):")}] + parts})
+        return formatted
 
     def _trim_and_save_messages(self, chat_key: str, messages: List[Dict[str, Any]]):
         # Filter out heavy image data before saving history to DynamoDB
         messages_to_save = []
         for msg in messages:
             msg_copy = msg.copy()
-            # Remove base64 image data to avoid exceeding DynamoDB item size limits
+            # Images are kept in the blob store, the history only holds references to them
             if "images" in msg_copy and msg_copy["images"]:
+                msg_copy["image_refs"] = msg_copy.get("image_refs", []) + self._store_images(chat_key, msg_copy["images"])
                 msg_copy["images"] = []
                 # Add metadata phrase if user attached an image
                 if msg_copy.get("role") == "user":
@@ -129,22 +236,115 @@ class openaiClient:
                 # Add metadata phrase if assistant generated an image
                 elif msg_copy.get("role") == "assistant" and msg_copy.get("tool_images_meta"):
                      msg_copy["text"] = f"{msg_copy.get('text', '')} [Assistant generated an image]"
+                with_token_count(msg_copy)
 
             messages_to_save.append(msg_copy)
 
         # Trim to CONTEXT_LENGTH but ensure we don't cut in the middle of a tool call sequence
-        trimmed = messages_to_save[-CONTEXT_LENGTH:]
-        
-        # If the first message is a tool response or orphaned, skip until we find a clean start
-        # A clean start is: user message, or assistant message without tool_calls
-        while trimmed and (
-            trimmed[0].get("role") == "tool" or 
-            (trimmed[0].get("role") == "assistant" and trimmed[0].get("tool_calls"))
-        ):
-            trimmed = trimmed[1:]
-        
+        trimmed = trim_history(messages_to_save, CONTEXT_LENGTH)
         self.dynamoDB_client.save_messages(chat_key, trimmed)
 
+    def _store_images(self, chat_key: str, images: List[Any]) -> List[Dict[str, str]]:
+        """Put images in the blob store, returns their references"""
+        refs = []
+        for image in images:
+            data = base64.b64decode(image) if isinstance(image, str) else bytes(image)
+            mime_type = image_mime_type(data, IMAGE_MIME_TYPE)
+            # Content addressed, storing the same image twice writes one object
+            key = f"images/{chat_key}/{content_key(data)}.{mime_type.split('/')[-1]}"
+            try:
+                with metrics.stage("blob_put"):
+                    self.blob_store.put(key, data, mime_type)
+            except Exception as exc:
+                log.error("Could not store an image of %s: %s", chat_key, exc)
+                continue
+            refs.append({"key": key, "mime_type": mime_type})
+        return refs
+
+    def _load_history_images(self, messages: List[Dict[str, Any]], budget: float, priority_ids) -> None:
+        """Load the images of the newest messages (replied ones first) that fit into `budget` tokens
+
+        The images are added to the messages as "_images", they are never stored.
+        """
+        candidates = [message for message in reversed(messages) if message.get("image_refs")]
+        # Stable sort: messages of the replied thread first, then the newest ones
+        candidates.sort(key=lambda message: message.get("id") not in priority_ids)
+        jobs = []
+        for message in candidates:
+            for ref in message["image_refs"]:
+                if len(jobs) >= HISTORY_IMAGE_LIMIT or budget < IMAGE_TOKENS:
+                    break
+                jobs.append((message, ref))
+                budget -= IMAGE_TOKENS
+        if not jobs:
+            return
+        with metrics.stage("history_images"), ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            results = list(executor.map(metrics.in_current_trace(lambda job: self._get_image(job[1]["key"])), jobs))
+        for (message, ref), data in zip(jobs, results):
+            if data:
+                message.setdefault("_images", []).append({
+                    "data": base64.b64encode(data).decode("ascii"),
+                    "mime_type": ref.get("mime_type", IMAGE_MIME_TYPE),
+                })
+        metrics.put("history_images_loaded", sum(1 for data in results if data))
+
+    def _get_image(self, key: str) -> Optional[bytes]:
+        try:
+            with metrics.stage("blob_get"):
+                return self.blob_store.get(key)
+        except Exception as exc:
+            log.error("Could not load image %s: %s", key, exc)
+            return None
+
+    def reset_chat(self, chat_id: int, bot_id: int) -> None:
+        """Forget what is kept about a chat outside its history"""
+        chat_key = self._chat_key(chat_id, bot_id)
+        if self.memory:
+            self.memory.forget(chat_key)
+        self.blob_store.delete_prefix(f"images/{chat_key}/")
+
+    def _remember(self, chat_key: str, messages: List[Dict[str, Any]]) -> None:
+        # Only buffered here, inside the history write; `flush_memory` indexes them
+        if self.memory and messages:
+            self.memory.remember(chat_key, messages)
+
+    def flush_memory(self) -> int:
+        """Index the messages evicted during this invocation, once the answer was delivered"""
+        if not self._memory:
+            return 0
+        try:
+            with metrics.stage("memory_flush"):
+                added = self._memory.flush()
+        except Exception as exc:
+            # Losing a memory must not fail the update
+            log.error("Could not index evicted messages: %s", exc)
+            return 0
+        if added:
+            metrics.add("memory_indexed_messages", added)
+        return added
+
+    def _recall(self, chat_key: str, text: str, context: List[Dict[str, Any]],
+                thread_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Remembered messages related to `text` that are not in the context already
+
+        The remembered part of the reply thread ending at `thread_id` comes first.
+        """
+        if not self.memory:
+            return []
+        try:
+            present = {message.get("id") for message in context}
+            recalled = []
+            with metrics.stage("memory_recall"):
+                for record in self.memory.thread(chat_key, thread_id) + self.memory.recall(chat_key, text):
+                    if record["id"] not in present:
+                        present.add(record["id"])
+                        recalled.append(record)
+            metrics.put("memory_recalled_messages", len(recalled))
+            return recalled
+        except Exception as exc:
+            log.error("Memory recall of %s failed: %s", chat_key, exc)
+            return []
+
     def _build_tools(self) -> List[Dict[str, Any]]:
         return [
             {
@@ -178,15 +378,40 @@ class openaiClient:
             if reply_id and reply_id != message.get("id"):
                 prefix += f" replying to {reply_id}"
             text_body = message.get("text", "")
+            if not text_body:
+                # Tool calls and tool responses carry no conversation
+                continue
             lines.append(f"{prefix}: {text_body}")
         return "\n".join(lines)
 
+    def _gemini(self):
+        """The Gemini client, created once and shared by all requests"""
+        with self._gemini_lock:
+            if self._gemini_client is None:
+                from google import genai
+                self._gemini_client = genai.Client(api_key=GEMINI_API_KEY)
+            return self._gemini_client
+
     def _generate_image(self, prompt: str, aspect_ratio: Optional[str], display_prompt: Optional[str]) -> Optional[Dict[str, Any]]:
         normalized_ratio = _normalize_aspect_ratio(aspect_ratio)
-        print(f"[LOG] Starting Gemini image generation. Prompt: {prompt[:200]}... Ratio: {normalized_ratio}")
+        # The same picture asked again (or twice at once) is generated only once
+        image, outcome = self.image_cache.get_or_create(
+            generation_key(prompt, normalized_ratio, GEMINI_IMAGE_MODEL),
+            lambda: self._render_image(prompt, normalized_ratio),
+        )
+        metrics.add(f"image_cache_{outcome}")
+        metrics.put("image_cache_hit_rate", self.image_cache.hit_rate, metrics.NONE)
+        metrics.put("image_cache_saved_ms", self.image_cache.stats["saved_ms"], metrics.MILLISECONDS)
+        if not image:
+            return None
+        return dict(image, prompt=prompt, display_prompt=display_prompt or prompt)
+
+    @metrics.timed("gemini_image")
+    def _render_image(self, prompt: str, normalized_ratio: Optional[str]) -> Optional[Dict[str, Any]]:
+        log.info("Starting Gemini image generation. Prompt: %s... Ratio: %s", prompt[:200], normalized_ratio)
+        from google.genai import types
         try:
-            client = genai.Client(api_key=GEMINI_API_KEY)
-            response = client.models.generate_content(
+            response = self._gemini().models.generate_content(
                 model=GEMINI_IMAGE_MODEL,
                 contents=[prompt],
                 config=types.GenerateContentConfig(
@@ -195,93 +420,224 @@ class openaiClient:
                     ),
                 ),
             )
-            print("[LOG] Gemini API response received.")
+            log.debug("Gemini API response received.")
         except Exception as exc:
-            print(f"[ERROR] Gemini generation failed: {exc}")
+            log.error("Gemini generation failed: %s", exc)
             return None
         if not response:
-            print("[ERROR] No response object from Gemini.")
+            log.error("No response object from Gemini.")
             return None
-        
-        # Log full response details for debugging
-        print(f"[DEBUG] Response type: {type(response)}")
-        print(f"[DEBUG] Response has parts: {hasattr(response, 'parts')}")
-        if hasattr(response, 'candidates') and response.candidates:
-            for i, candidate in enumerate(response.candidates):
-                print(f"[DEBUG] Candidate {i}: finish_reason={getattr(candidate, 'finish_reason', 'N/A')}")
-                if hasattr(candidate, 'content') and candidate.content:
-                    print(f"[DEBUG] Candidate {i} content parts: {len(candidate.content.parts) if candidate.content.parts else 0}")
-                    for j, part in enumerate(candidate.content.parts or []):
-                        print(f"[DEBUG] Part {j}: has text={hasattr(part, 'text') and part.text is not None}, has inline_data={hasattr(part, 'inline_data') and part.inline_data is not None}")
-                        if hasattr(part, 'text') and part.text:
-                            print(f"[DEBUG] Part {j} text: {part.text[:200] if part.text else 'None'}...")
-        
-        # Check for blocked content
-        if hasattr(response, 'prompt_feedback'):
-            print(f"[DEBUG] Prompt feedback: {response.prompt_feedback}")
-        
+        # Walking the candidates is only worth it when the lines are written
+        if log.enabled(logger.DEBUG):
+            self._log_gemini_response(response)
+
         # https://ai.google.dev/gemini-api/docs/image-generation#python_23
         if hasattr(response, "parts"):
-            for part in response.parts:
+            for part in response.parts or []:
                 if part.inline_data:
-                    print(f"[LOG] Image data found. Size: {len(part.inline_data.data)} bytes.")
+                    log.info("Image data found. Size: %s bytes.", len(part.inline_data.data))
                     return {
                         "data": part.inline_data.data,
                         "mime_type": part.inline_data.mime_type or IMAGE_MIME_TYPE,
-                        "prompt": prompt,
-                        "display_prompt": display_prompt or prompt,
                     }
-        print("[ERROR] No image parts found in Gemini response.")
+        # The finish reasons and the feedback tell why, e.g. a blocked prompt
+        log.error("No image parts found in Gemini response. Finish reasons: %s, prompt feedback: %s",
+                  [getattr(candidate, "finish_reason", None) for candidate in getattr(response, "candidates", None) or []],
+                  getattr(response, "prompt_feedback", None))
         return None
 
-    def _handle_tool_calls(self, tool_calls, conversation_messages: List[Dict[str, Any]], base_messages):
-        print(f"[LOG] Handling {len(tool_calls)} tool calls.")
+    def _log_gemini_response(self, response) -> None:
+        log.debug("Response type: %s, has parts: %s", type(response), hasattr(response, 'parts'))
+        for i, candidate in enumerate(getattr(response, 'candidates', None) or []):
+            log.debug("Candidate %s: finish_reason=%s", i, getattr(candidate, 'finish_reason', 'N/A'))
+            if not getattr(candidate, 'content', None):
+                continue
+            parts = candidate.content.parts or []
+            log.debug("Candidate %s content parts: %s", i, len(parts))
+            for j, part in enumerate(parts):
+                log.debug("Part %s: has text=%s, has inline_data=%s", j,
+                          getattr(part, 'text', None) is not None, getattr(part, 'inline_data', None) is not None)
+                if getattr(part, 'text', None):
+                    log.debug("Part %s text: %s...", j, part.text[:200])
+        if hasattr(response, 'prompt_feedback'):
+            log.debug("Prompt feedback: %s", response.prompt_feedback)
+
+    @metrics.timed("openai_completion")
+    def _create_completion(self, on_text: Optional[Callable[[str], None]] = None, **kwargs) -> "ChatCompletionMessage":
+        """Request a completion and return its message
+
+        When `on_text` is set the completion is streamed and `on_text` receives the
+        accumulated text after every content delta.
+        """
+        metrics.add("openai_completions")
+        if not on_text:
+            response = self.client.chat.completions.create(**kwargs)
+            self._report_usage(response.usage)
+            return response.choices[0].message
+
+        started = time.perf_counter()
+        first_token_received = False
+        text = ""
+        tool_calls: Dict[int, Dict[str, Any]] = {}
+        stream = self.client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+        for chunk in stream:
+            if chunk.usage:
+                self._report_usage(chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                if not first_token_received:
+                    first_token_received = True
+                    metrics.put("time_to_first_token_ms", (time.perf_counter() - started) * 1000, metrics.MILLISECONDS)
+                text += delta.content
+                on_text(_strip_prefix(text))
+            # Tool calls arrive in fragments addressed by their index
+            for tool_delta in delta.tool_calls or []:
+                call = tool_calls.setdefault(tool_delta.index, {
+                    "id": None,
+                    "type": "function",
+                    "function": {"name": "", "arguments": ""},
+                })
+                if tool_delta.id:
+                    call["id"] = tool_delta.id
+                if tool_delta.function and tool_delta.function.name:
+                    call["function"]["name"] += tool_delta.function.name
+                if tool_delta.function and tool_delta.function.arguments:
+                    call["function"]["arguments"] += tool_delta.function.arguments
+
+        message: Dict[str, Any] = {"role": "assistant", "content": text or None}
+        if tool_calls:
+            message["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+        from openai.types.chat import ChatCompletionMessage
+        return ChatCompletionMessage.model_validate(message)
+
+    def _report_usage(self, usage) -> None:
+        if usage:
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached = (getattr(details, "cached_tokens", None) if details else None) or 0
+            # Summed over the completions of the invocation (answer, tool follow-up, summary)
+            metrics.add("prompt_tokens", usage.prompt_tokens)
+            metrics.add("cached_tokens", cached)
+            metrics.add("completion_tokens", usage.completion_tokens)
+
+    def _image_metadata(self, image_data: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "prompt": _strip_prefix(image_data.get("display_prompt", "") or image_data.get("prompt", "")),
+            "mime_type": image_data.get("mime_type", IMAGE_MIME_TYPE),
+        }
+
+    def _run_tool_call(self, tool_call, on_image: Optional[Callable[[Dict[str, Any], bytes], None]] = None):
+        """Execute one tool call, returns its tool response and generated image (if any)"""
+        if tool_call.function.name != "generate_image":
+            return None, None
+        log.info("Processing generate_image tool call.")
+        args = json.loads(tool_call.function.arguments)
+        prompt = args.get("prompt", "")
+        aspect_ratio = args.get("aspect_ratio")
+        # Send only the clean image description to Gemini, without conversation context
+        # The conversation context was confusing Gemini into responding with text instead of generating an image
+        image_result = self._generate_image(prompt, aspect_ratio, prompt)
+        if not image_result:
+            log.error("Image generation failed or returned no result.")
+            return self._failed_tool_response(tool_call, "Image generation returned no data"), None
+        log.info("Image generation successful.")
+        if on_image:
+            on_image(self._image_metadata(image_result), image_result["data"])
+        return {
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "content": json.dumps({
+                "status": "image_generated",
+                "prompt": prompt,
+                "mime_type": image_result.get("mime_type", IMAGE_MIME_TYPE)
+            }),
+        }, image_result
+
+    def _failed_tool_response(self, tool_call, reason: str) -> Dict[str, Any]:
+        return {
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "content": json.dumps({
+                "status": "failed",
+                "reason": reason
+            }),
+        }
+
+    def _run_tool_calls(self, tool_calls, on_image: Optional[Callable[[Dict[str, Any], bytes], None]] = None):
+        """Execute tool calls concurrently, results keep the order of `tool_calls`"""
+        workers = max(1, min(TOOL_MAX_WORKERS, len(tool_calls)))
+        # Calls queued behind the parallelism cap may wait for a few rounds before they start
+        start_deadline = time.monotonic() + TOOL_CALL_TIMEOUT * math.ceil(len(tool_calls) / workers)
+        started_at: Dict[int, float] = {}
+        abandoned = set()
+
+        def run(index, tool_call):
+            started_at[index] = time.monotonic()
+
+            def deliver_image(image_meta, image_data):
+                if index not in abandoned:
+                    on_image(image_meta, image_data)
+
+            return self._run_tool_call(tool_call, deliver_image if on_image else None)
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        run = metrics.in_current_trace(run)
+        futures = [executor.submit(run, index, tool_call) for index, tool_call in enumerate(tool_calls)]
+        results = []
+        try:
+            for index, (tool_call, future) in enumerate(zip(tool_calls, futures)):
+                while True:
+                    # Every call gets TOOL_CALL_TIMEOUT seconds from the moment it starts
+                    deadline = started_at[index] + TOOL_CALL_TIMEOUT if index in started_at else start_deadline
+                    try:
+                        results.append(future.result(timeout=max(0.0, deadline - time.monotonic())))
+                        break
+                    except FutureTimeoutError:
+                        started = started_at.get(index)
+                        if started is not None and time.monotonic() < started + TOOL_CALL_TIMEOUT:
+                            # It started while we were waiting for the queue, wait for its own deadline
+                            continue
+                        log.error("Tool call %s timed out after %ss.", tool_call.id, TOOL_CALL_TIMEOUT)
+                        abandoned.add(index)
+                        future.cancel()
+                        results.append((self._failed_tool_response(tool_call, "Tool call timed out"), None))
+                        break
+                    except Exception as exc:
+                        # The model is told about the failure, the other calls keep their results
+                        log.error("Tool call %s failed: %s", tool_call.id, exc)
+                        results.append((self._failed_tool_response(tool_call, "Tool call failed"), None))
+                        break
+        finally:
+            # Do not wait for abandoned calls, their results are discarded
+            executor.shutdown(wait=False, cancel_futures=True)
+        return results
+
+    def _handle_tool_calls(self, tool_calls, conversation_messages: List[Dict[str, Any]], base_messages,
+                           on_text: Optional[Callable[[str], None]] = None,
+                           on_image: Optional[Callable[[Dict[str, Any], bytes], None]] = None):
+        log.info("Handling %s tool calls.", len(tool_calls))
         tool_responses = []
         generated_images: List[Dict[str, Any]] = []
-        for tool_call in tool_calls:
-            if tool_call.function.name == "generate_image":
-                print("[LOG] Processing generate_image tool call.")
-                args = json.loads(tool_call.function.arguments)
-                prompt = args.get("prompt", "")
-                aspect_ratio = args.get("aspect_ratio")
-                # Send only the clean image description to Gemini, without conversation context
-                # The conversation context was confusing Gemini into responding with text instead of generating an image
-                image_result = self._generate_image(prompt, aspect_ratio, prompt)
-                if image_result:
-                    print("[LOG] Image generation successful.")
-                    generated_images.append(image_result)
-                    tool_responses.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": json.dumps({
-                            "status": "image_generated",
-                            "prompt": prompt,
-                            "mime_type": image_result.get("mime_type", IMAGE_MIME_TYPE)
-                        }),
-                    })
-                else:
-                    print("[ERROR] Image generation failed or returned no result.")
-                    tool_responses.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": json.dumps({
-                            "status": "failed",
-                            "reason": "Image generation returned no data"
-                        }),
-                    })
+        for tool_response, image_result in self._run_tool_calls(tool_calls, on_image):
+            if tool_response:
+                tool_responses.append(tool_response)
+            if image_result:
+                generated_images.append(image_result)
         if not tool_responses:
-            print("[LOG] No tool responses generated.")
+            log.info("No tool responses generated.")
             return None, [], base_messages
         follow_up_messages = base_messages + tool_responses
-        print("[LOG] Sending tool outputs back to OpenAI model.")
-        response = self.client.chat.completions.create(
+        log.info("Sending tool outputs back to OpenAI model.")
+        message = self._create_completion(
+            on_text,
             model=OPENAI_MODEL,
             messages=follow_up_messages,
             temperature=TEMPERATURE,
             max_completion_tokens=MAX_COMPLETION_TOKENS,
-            tools=self._build_tools(),
+            tools=self.tools,
         )
-        return response.choices[0].message, generated_images, follow_up_messages
+        return message, generated_images, follow_up_messages
 
     def remember_only(self, chat_id: int, bot_id: int, message: Dict[str, Any]):
         chat_key = self._chat_key(chat_id, bot_id)
@@ -310,7 +666,7 @@ class openaiClient:
                 if tool_call_id and tool_call_id in current_valid_tool_call_ids:
                     result.append(msg)
                 else:
-                    print(f"[WARNING] Skipping orphaned tool message with tool_call_id={tool_call_id}")
+                    log.warning("Skipping orphaned tool message with tool_call_id=%s", tool_call_id)
             else:
                 # Regular user/assistant message - reset the valid tool call IDs
                 current_valid_tool_call_ids = set()
@@ -318,32 +674,186 @@ class openaiClient:
         
         return result
 
-    def complete_chat(self, user_message: Dict[str, Any], chat_id: int, bot_id: int):
-        """Generate the bot's answer to a user's message"""
+    def _resolve_replies(self, history: List[Dict[str, Any]], messages: List[Dict[str, Any]]) -> None:
+        """Point replies to the bot's Telegram messages at the records of its answers"""
+        answers = {message["telegram_id"]: message["id"] for message in history if message.get("telegram_id")}
+        for message in messages:
+            if message.get("reply_to_id") in answers:
+                message["reply_to_id"] = answers[message["reply_to_id"]]
+
+    def _summary_start(self, messages: List[Dict[str, Any]], summary: Optional[Dict[str, Any]]) -> int:
+        """Position of the first message after the last one folded into the summary"""
+        if not summary:
+            return 0
+        for index in range(len(messages) - 1, -1, -1):
+            if _message_ref(messages[index]) == summary["covered"]:
+                return index + 1
+        return 0
+
+    @metrics.timed("summary_update")
+    def update_summary(self, chat_id: int, bot_id: int) -> bool:
+        """Fold the oldest unsummarized messages into the chat summary once there are enough of them
+
+        Runs after the reply was delivered or for ignored messages, never before an answer.
+        Returns True if the summary was updated.
+        """
+        if SUMMARY_TRIGGER <= 0:
+            return False
         chat_key = self._chat_key(chat_id, bot_id)
-        previous_messages = self.dynamoDB_client.load_messages(chat_key)
-        limited_previous = previous_messages[-CONTEXT_LENGTH:]
+        try:
+            messages = self._filter_valid_tool_messages(self.dynamoDB_client.load_messages(chat_key, limit=CONTEXT_LENGTH))
+            summary = self.dynamoDB_client.load_summary(chat_key)
+            pending = messages[self._summary_start(messages, summary):]
+            threshold = _summary_threshold()
+            if len(pending) < threshold:
+                return False
+            end = len(pending) - min(SUMMARY_KEEP_RECENT, threshold // 2)
+            # A tool call and its responses are folded together
+            while end < len(pending) and pending[end].get("role") == "tool":
+                end += 1
+            return self._fold_summary(chat_key, pending[:end], summary)
+        except Exception as exc:
+            # The answer was already delivered, a failed summary is retried with the next message
+            log.error("Summary update of %s failed: %s", chat_key, exc)
+            return False
+
+    def _fold_summary(self, chat_key: str, segment: List[Dict[str, Any]], summary: Optional[Dict[str, Any]]) -> bool:
+        """Fold `segment` into the summary, False if none was generated or another invocation saved one first"""
+        previous_text = summary["text"] if summary else ""
+        result = self._create_completion(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_INSTRUCTION},
+                {"role": "user", "content": f"Current summary:\n{previous_text or '(empty)'}\n\n"
+                                            f"New messages:\n{self._summarize_conversation(segment)}"},
+            ],
+            max_completion_tokens=SUMMARY_MAX_TOKENS,
+        )
+        text = _text_from_content(result.content or "").strip()
+        if not text:
+            log.error("Empty summary for %s, keeping the previous one.", chat_key)
+            return False
+        saved = self.dynamoDB_client.save_summary(
+            chat_key, text, _message_ref(segment[-1]), summary["version"] if summary else 0)
+        metrics.put("summary_folded_messages", len(segment))
+        metrics.put("summary_saved", int(saved))
+        return saved
+
+    def _summarize_evicted(self, chat_key: str, dropped: List[Dict[str, Any]], kept: List[Dict[str, Any]]) -> bool:
+        """Fold the messages a history write drops into the summary first, unless it covers them
+
+        Installed as the storage's `before_evict`. Returns False if they could not
+        be folded, the write then keeps them for a later attempt.
+        """
+        if SUMMARY_TRIGGER <= 0:
+            return True
+        refs = [_message_ref(message) for message in dropped]
+        for _ in range(SUMMARY_FOLD_ATTEMPTS):
+            summary = self.dynamoDB_client.load_summary(chat_key)
+            covered = summary["covered"] if summary else None
+            if covered in refs:
+                segment = dropped[refs.index(covered) + 1:]
+            elif covered is not None and covered in {_message_ref(message) for message in kept}:
+                segment = []
+            else:
+                segment = dropped
+            if not segment:
+                return True
+            with metrics.stage("summary_evicted"):
+                if self._fold_summary(chat_key, segment, summary):
+                    metrics.add("summary_evicted_messages", len(segment))
+                    return True
+        return False
+
+    @metrics.timed("complete_chat")
+    def complete_chat(self, user_message: Dict[str, Any], chat_id: int, bot_id: int,
+                      on_text: Optional[Callable[[str], None]] = None,
+                      on_tool_calls: Optional[Callable[[str], None]] = None,
+                      on_image: Optional[Callable[[Dict[str, Any], bytes], None]] = None,
+                      burst_ids: Optional[List[str]] = None,
+                      on_answer: Optional[Callable[[str], Optional[int]]] = None):
+        """Generate the bot's answer to a user's message
+
+        Args:
+            burst_ids: ids of the messages of the burst that `user_message` ends, all of them
+                already stored in the history; they are answered in the same reply
+            on_answer: delivers the final text before the history is saved, returns the id of
+                the Telegram message that holds it; the history is saved even if it raises
+            on_text: if set, the completion is streamed and the partial answer is passed to it
+            on_tool_calls: called with the text of the first completion as soon as it requests tools,
+                while the tools run in the background
+            on_image: called with the metadata and bytes of every generated image as soon as it is ready
+        """
+        chat_key = self._chat_key(chat_id, bot_id)
+        limited_previous = self.dynamoDB_client.load_messages(chat_key, limit=CONTEXT_LENGTH)
         
         # Filter out orphaned tool messages that would cause OpenAI API errors
         limited_previous = self._filter_valid_tool_messages(limited_previous)
-        
-        formatted_history = [self._format_message_for_model(m) for m in limited_previous]
-        tool_instruction = "TOOL USAGE INSTRUCTIONS: If any member of the chat asks to create, draw or render an image or a picture in any language, always call the `generate_image` tool and do not describe the JSON yourself or answer with some text. Otherwise return concise, human-friendly answers without technical prefixes. "
-        model_messages = [
-            {"role": "system", "content": [{"type": "text", "text": SYSTEM_PROMPT}]},
-            {"role": "system", "content": [{"type": "text", "text": tool_instruction}]},
-        ] + formatted_history + [self._format_message_for_model(user_message, include_style_prompt=True)]
-
-        response = self.client.chat.completions.create(
+        earlier: List[Dict[str, Any]] = []
+        if burst_ids:
+            # The messages of the burst go last, next to the answered one, which is taken as
+            # its stored record so it is not written twice
+            stored = [m for m in limited_previous if m.get("id") == user_message.get("id")]
+            if stored:
+                user_message = stored[-1]
+            earlier = [m for m in limited_previous if m.get("id") in burst_ids and m is not user_message]
+            limited_previous = [m for m in limited_previous
+                                if m.get("id") not in burst_ids and m is not user_message] + earlier
+        self._resolve_replies(limited_previous, earlier + [user_message])
+
+        # Messages already folded into the summary are not sent again, unless they are in the replied thread
+        summary = self.dynamoDB_client.load_summary(chat_key) if SUMMARY_TRIGGER > 0 else None
+        # The whole window is kept in storage, only what fits into the token budget is sent
+        reply_to_id = user_message.get("reply_to_id")
+        context_messages = select_context(limited_previous, reply_to_id=reply_to_id,
+                                          start=self._summary_start(limited_previous, summary))
+        # Where the replied thread leaves the stored window, it is looked up in the long-term memory
+        chain = reply_chain(limited_previous, reply_to_id)
+        thread_id = limited_previous[chain[-1]].get("reply_to_id") if chain else reply_to_id
+        context_tokens = sum(message_tokens(m) for m in context_messages)
+        self._load_history_images(
+            context_messages,
+            CONTEXT_TOKEN_BUDGET - context_tokens if CONTEXT_TOKEN_BUDGET > 0 else float("inf"),
+            {limited_previous[position].get("id") for position in chain},
+        )
+        metrics.put("context_messages", len(context_messages))
+        metrics.put("window_messages", len(limited_previous))
+        metrics.put("context_tokens", context_tokens)
+        metrics.put("window_tokens", sum(message_tokens(m) for m in limited_previous))
+        metrics.put("summary_tokens", count_tokens(summary["text"]) if summary else 0)
+        formatted_history = self._format_history(context_messages)
+        # Stable parts first: the static prefix, the summary (changes only when messages
+        # are folded) and the history, whose turns serialize the same in every request.
+        # What changes per request comes last.
+        model_messages = list(self.prompt_prefix)
+        if summary:
+            model_messages.append({"role": "system", "content": [
+                {"type": "text", "text": f"Summary of the earlier conversation:\n{summary['text']}"}]})
+        model_messages += formatted_history
+        recalled = self._recall(chat_key, user_message.get("text", ""), limited_previous, thread_id)
+        if recalled:
+            model_messages.append({"role": "system", "content": [
+                {"type": "text", "text": "Earlier messages of this chat that may be relevant:\n" + "\n".join(
+                    f"@{record['username']} (message {record['id']}): {record['text']}" for record in recalled)}]})
+        if earlier:
+            model_messages.append({"role": "system", "content": [{"type": "text", "text": (
+                f"The last {len(earlier) + 1} user messages were sent in quick succession, "
+                "answer them together in one reply.")}]})
+        if STYLE_PROMPT:
+            # Sent next to the newest message instead of inside it, so the message
+            # serializes the same once it is part of the history
+            model_messages.append({"role": "system", "content": [{"type": "text", "text": STYLE_PROMPT}]})
+        model_messages.append(self._format_message_for_model(user_message))
+
+        first_choice = self._create_completion(
+            on_text,
             model=OPENAI_MODEL,
             messages=model_messages,
             temperature=TEMPERATURE,
             max_completion_tokens=MAX_COMPLETION_TOKENS,
-            tools=self._build_tools(),
+            tools=self.tools,
             tool_choice="auto",
         )
-
-        first_choice = response.choices[0].message
         assistant_message = first_choice
         tool_generated_images: List[Dict[str, Any]] = []
         
@@ -351,13 +861,21 @@ class openaiClient:
         tool_call_records = []
         if first_choice.tool_calls:
             # 1. Add the assistant's tool call message to history
-            tool_call_records.append(first_choice.model_dump())
+            tool_call_records.append(with_token_count(first_choice.model_dump()))
             
-            assistant_message, tool_generated_images, follow_up_messages = self._handle_tool_calls(
-                first_choice.tool_calls,
-                limited_previous + [user_message],
-                model_messages + [first_choice.model_dump()]
-            )
+            # Tools run in the background so the early answer is delivered without waiting for them
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                tool_future = executor.submit(
+                    metrics.in_current_trace(self._handle_tool_calls),
+                    first_choice.tool_calls,
+                    limited_previous + [user_message],
+                    model_messages + [first_choice.model_dump()],
+                    on_text,
+                    on_image,
+                )
+                if on_tool_calls:
+                    on_tool_calls(_strip_prefix(_text_from_content(first_choice.content or "")))
+                assistant_message, tool_generated_images, follow_up_messages = tool_future.result()
             
             # 2. Add the tool response messages to history (from follow_up_messages)
             # follow_up_messages contains [..., tool_call_msg, tool_response_msg_1, tool_response_msg_2, ...]
@@ -366,7 +884,7 @@ class openaiClient:
             # So we can scan follow_up_messages for role='tool'
             for msg in follow_up_messages:
                 if isinstance(msg, dict) and msg.get("role") == "tool":
-                     tool_call_records.append(msg)
+                     tool_call_records.append(with_token_count(dict(msg)))
 
         assistant_text = _strip_prefix(_text_from_content(assistant_message.content))
         
@@ -381,13 +899,7 @@ class openaiClient:
              elif isinstance(data, str):
                   assistant_images.append(data)
 
-        assistant_metadata = [
-            {
-                "prompt": _strip_prefix(image_data.get("display_prompt", "") or image_data.get("prompt", "")),
-                "mime_type": image_data.get("mime_type", IMAGE_MIME_TYPE),
-            }
-            for image_data in tool_generated_images
-        ]
+        assistant_metadata = [self._image_metadata(image_data) for image_data in tool_generated_images]
         assistant_id = f"{user_message.get('id', uuid.uuid4().hex)}-assistant"
         reply_to_id = user_message.get("id")
         if reply_to_id == assistant_id:
@@ -403,6 +915,7 @@ class openaiClient:
             "images": assistant_images,
             "tool_images_meta": assistant_metadata,
         }
+        with_token_count(assistant_record)
 
         # Prepare history to save: User -> Tools (if any) -> Assistant Text -> Image Messages (if any)
         history_to_save = limited_previous + [user_message]
@@ -424,8 +937,19 @@ class openaiClient:
                 "reply_to_id": reply_to_id,
                 "images": [],  # Don't store actual image data
             }
+            with_token_count(image_message_record)
             history_to_save.append(image_message_record)
-        
-        self._trim_and_save_messages(chat_key, history_to_save)
+
+        try:
+            # Users reply to the Telegram message, replies are chained through its id
+            telegram_id = on_answer(assistant_text) if on_answer else None
+            if telegram_id is not None:
+                assistant_record["telegram_id"] = str(telegram_id)
+        finally:
+            # The exchange is kept even if its delivery failed
+            self._trim_and_save_messages(chat_key, history_to_save)
+        # Told from the history at hand, so checking it costs no request
+        assistant_record["_summary_due"] = SUMMARY_TRIGGER > 0 and (
+            len(history_to_save) - self._summary_start(limited_previous, summary) >= _summary_threshold())
 
         return assistant_record
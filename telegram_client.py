@@ -1,13 +1,20 @@
 import base64
 import json
 import os
-import urllib3
 import random
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional
 
+import metrics
+from logger import get_logger
 from openai_client import openaiClient
 from dinamodb_client import dynamoDBClient
+from context_window import with_token_count
+from image_ingestion import encode_image, select_photo_size
+from media_cache import content_key, mediaCache
+from telegram_sender import telegramSender
 
 BOT_ID = int(os.environ.get('BOT_ID'))
 BOT_NAME = os.environ.get('BOT_NAME')
@@ -16,12 +23,31 @@ FREQUENCY = float(os.environ.get('FREQUENCY'))
 ALLOWED_CHATS = [int(num) for num in os.environ.get('ALLOWED_CHATS').split(',')]
 RESET_COMMAND = os.environ.get('RESET_COMMAND')
 CONTEXT_LENGTH = int(os.environ.get('CONTEXT_LENGTH'))
-
-SEND_MESSAGE_URL = 'https://api.telegram.org/bot' + TELEGRAM_TOKEN + '/sendMessage'
-SEND_PHOTO_URL = 'https://api.telegram.org/bot' + TELEGRAM_TOKEN + '/sendPhoto'
-GET_FILE_URL = 'https://api.telegram.org/bot' + TELEGRAM_TOKEN + '/getFile'
-FILE_DOWNLOAD_URL = 'https://api.telegram.org/file/bot' + TELEGRAM_TOKEN + '/{}'
-http = urllib3.PoolManager()
+STREAM_REPLIES = os.environ.get('STREAM_REPLIES', 'false').lower() == 'true'
+STREAM_PLACEHOLDER = os.environ.get('STREAM_PLACEHOLDER', '…')
+# Telegram allows about one edit per second in private chats and 20 per minute in groups
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', '1'))
+STREAM_GROUP_EDIT_INTERVAL = float(os.environ.get('STREAM_GROUP_EDIT_INTERVAL', '3'))
+MAX_MESSAGE_LENGTH = 4096
+IMAGE_ACK_TEXT = os.environ.get('IMAGE_ACK_TEXT', 'Rendering the image…')
+# Replaces the placeholder or partial answer when the answer could not be generated
+REPLY_ERROR_TEXT = os.environ.get('REPLY_ERROR_TEXT', 'Sorry, something went wrong. Please try again.')
+# Messages that follow each other within COALESCE_WINDOW seconds are answered together, 0 turns it off
+COALESCE_WINDOW = float(os.environ.get('COALESCE_WINDOW', '0'))
+# A long burst is answered once its first message waited this long
+COALESCE_MAX_DELAY = float(os.environ.get('COALESCE_MAX_DELAY', '10'))
+# Seconds the updates of an album (media group) are buffered to be answered once, 0 answers each photo
+MEDIA_GROUP_WAIT = float(os.environ.get('MEDIA_GROUP_WAIT', '1'))
+# Key of a queued update holding the time its album is claimed at
+ALBUM_CLAIM_KEY = "album_claim_at"
+# Burst and album records expire after an hour
+BUFFER_TTL = 3600
+
+sender = telegramSender(TELEGRAM_TOKEN)
+log = get_logger("telegram")
+# Whole webhook bodies, only written at DEBUG level
+update_log = get_logger("update")
+media_cache = mediaCache()
 
 dynamoDB_client = dynamoDBClient()
 openai_client = openaiClient(dynamoDB_client)
@@ -98,6 +124,21 @@ def format_with_code_blocks(text: str) -> str:
 
     return final_text
 
+def format_partial_for_telegram(text: str) -> str:
+    """
+    Formats a streamed, unfinished answer with format_with_code_blocks.
+
+    Unclosed code blocks are closed and trailing backticks of a fence that is
+    still being typed are dropped, so the partial text is always valid MarkdownV2.
+    """
+    # Leave room for the escaping and the closing fence
+    text = text[:MAX_MESSAGE_LENGTH // 2].rstrip("`")
+    if text.count("```") % 2:
+        text += "\n```"
+    if re.sub(r'```(?:.|\n)*?```', '', text, flags=re.DOTALL).count("`") % 2:
+        text += "`"
+    return format_with_code_blocks(text)
+
 def format_with_styles(text: str) -> str:
     """
     Formats text for Telegram MarkdownV2, preserving code blocks,
@@ -141,22 +182,35 @@ def _username_from_message(message: Dict[str, Any]) -> str:
     return message.get("from", {}).get("username") or message.get("from", {}).get("first_name") or "unknown_user"
 
 
-def _download_file(file_id: str) -> Optional[bytes]:
-    file_payload = {"file_id": file_id}
-    response = http.request('POST', GET_FILE_URL,
-                            headers={'Content-Type': 'application/json'},
-                            body=json.dumps(file_payload), timeout=10)
+def _file_url(file_id: str) -> Optional[str]:
+    response = sender.call("getFile", {"file_id": file_id})
     response_data = json.loads(response.data.decode())
     if not response_data.get("ok"):
         return None
     file_path = response_data.get("result", {}).get("file_path")
     if not file_path:
         return None
-    file_url = FILE_DOWNLOAD_URL.format(file_path)
-    file_response = http.request('GET', file_url, timeout=10)
-    if file_response.status != 200:
+    return sender.file_url(file_path)
+
+
+@metrics.timed("photo_download")
+def _download_image(file_id: str) -> Optional[str]:
+    """Download a photo and return it base64-encoded, ready for the model"""
+    file_url = _file_url(file_id)
+    if not file_url:
         return None
-    return file_response.data
+    # The file is read in chunks so it is encoded without keeping extra copies
+    file_response = sender.http.request('GET', file_url, timeout=sender.timeout, preload_content=False)
+    try:
+        if file_response.status != 200:
+            return None
+        encoded, stats = encode_image(file_response.stream(64 * 1024))
+    finally:
+        file_response.release_conn()
+    metrics.add("photos_downloaded")
+    metrics.add("photo_downloaded_bytes", stats["downloaded_bytes"], metrics.BYTES)
+    metrics.add("photo_encoded_bytes", stats["encoded_bytes"], metrics.BYTES)
+    return encoded
 
 
 def _extract_images(message: Dict[str, Any]) -> List[str]:
@@ -164,29 +218,144 @@ def _extract_images(message: Dict[str, Any]) -> List[str]:
     if "photo" in message:
         photo_sizes = message["photo"]
         if isinstance(photo_sizes, list) and photo_sizes:
-            selected_photo = photo_sizes[-1]
+            selected_photo = select_photo_size(photo_sizes)
             file_id = selected_photo.get("file_id")
-            if file_id:
-                raw = _download_file(file_id)
-                if raw:
-                    images.append(base64.b64encode(raw).decode("utf-8"))
+            # file_id differs between bots and over time, file_unique_id stays the same
+            unique_id = selected_photo.get("file_unique_id")
+            cached = media_cache.get("photo", unique_id) if unique_id else None
+            if cached:
+                metrics.add("photo_cache_hits")
+                metrics.add("photo_cache_bytes_saved", selected_photo.get("file_size", len(cached)), metrics.BYTES)
+                images.append(cached.decode("ascii"))
+            elif file_id:
+                image = _download_image(file_id)
+                if image:
+                    images.append(image)
+                    if unique_id:
+                        media_cache.put("photo", unique_id, image.encode("ascii"))
     return images
 
 
+def _extract_album_images(messages: List[Dict[str, Any]]) -> List[str]:
+    """The photos of the messages of an album, downloaded in parallel"""
+    with ThreadPoolExecutor(max_workers=len(messages)) as executor:
+        downloads = executor.map(metrics.in_current_trace(_extract_images), messages)
+        return [image for images in downloads for image in images]
+
+
 def _structured_user_message(message: Dict[str, Any], user_message: str) -> Dict[str, Any]:
-    return {
+    album = message.get("media_group")
+    return with_token_count({
         "role": "user",
         "username": _username_from_message(message),
         "text": user_message,
         "id": str(message.get("message_id")),
         "reply_to_id": str(message.get("reply_to_message", {}).get("message_id")) if message.get("reply_to_message") else None,
-        "images": _extract_images(message),
-    }
+        "images": _extract_album_images(album) if album else _extract_images(message),
+    })
+
+
+def _sent_photo_file_id(response) -> Optional[str]:
+    try:
+        photo_sizes = json.loads(response.data.decode()).get("result", {}).get("photo") or []
+    except (ValueError, AttributeError):
+        return None
+    return photo_sizes[-1].get("file_id") if photo_sizes else None
+
+
+def _sent_message_id(response) -> Optional[int]:
+    try:
+        return json.loads(response.data.decode()).get("result", {}).get("message_id")
+    except (ValueError, AttributeError):
+        return None
+
+
+class telegramReply:
+    """The bot's answer to one message
+
+    The text is posted early (a streaming placeholder or the acknowledgement of an
+    image request) and edited into the final answer, generated images are sent as
+    soon as they are ready.
+    """
+
+    def __init__(self, telegram_client: "telegramClient", chat_id, original_message_id) -> None:
+        self.telegram_client = telegram_client
+        self.chat_id = chat_id
+        self.original_message_id = original_message_id
+        self.message_id = None
+        self.edit_interval = STREAM_GROUP_EDIT_INTERVAL if chat_id < 0 else STREAM_EDIT_INTERVAL
+        self.last_edit_at = 0.0
+        self.last_text = ""
+        self.finished = False
+
+    def start(self):
+        """Post the placeholder message"""
+        self.message_id = self.telegram_client.send_message(STREAM_PLACEHOLDER, self.chat_id, self.original_message_id)
+        self.last_edit_at = time.monotonic()
+
+    def update(self, text: str):
+        """Show the partial answer, at most once per edit interval"""
+        if self.message_id is None or time.monotonic() - self.last_edit_at < self.edit_interval:
+            return
+        formatted = format_partial_for_telegram(text)
+        if not text.strip() or formatted == self.last_text:
+            return
+        # A partial answer is skipped rather than delayed when the chat is rate limited
+        if self.telegram_client.edit_message(formatted, self.chat_id, self.message_id, droppable=True):
+            self.last_text = formatted
+        self.last_edit_at = time.monotonic()
+
+    def acknowledge(self, text: str):
+        """Show the text of the first completion, or a notice, while tools are running"""
+        text = text.strip() or IMAGE_ACK_TEXT
+        if self.message_id is None:
+            self.message_id = self.telegram_client.send_message(text, self.chat_id, self.original_message_id)
+        else:
+            formatted = format_with_code_blocks(text)
+            self.telegram_client.edit_message(formatted, self.chat_id, self.message_id)
+            self.last_text = formatted
+        self.last_edit_at = time.monotonic()
+
+    def send_image(self, image_meta: Dict[str, Any], image_data):
+        if not image_data:
+            log.error("Encoded image data is missing.")
+            return
+        log.info("Sending image to Telegram chat %s...", self.chat_id)
+        image_bytes = base64.b64decode(image_data) if isinstance(image_data, str) else image_data
+        caption = image_meta.get("prompt", "").strip() or "Here is your image."
+        self.telegram_client.send_photo(self.chat_id, image_bytes, caption, self.original_message_id,
+                                        image_meta.get("mime_type", "image/png"))
+        log.debug("Image sent to chat %s.", self.chat_id)
+
+    def finish(self, text: str) -> Optional[int]:
+        """Replace the placeholder with the complete answer, returns the id of the answer's message"""
+        self.finished = True
+        if self.message_id is None:
+            if text:
+                return self.telegram_client.send_message(text, self.chat_id, self.original_message_id)
+            return None
+        if not text:
+            self.telegram_client.delete_message(self.chat_id, self.message_id)
+            return None
+        formatted = format_with_code_blocks(text)
+        if formatted != self.last_text:
+            self.telegram_client.edit_message(formatted, self.chat_id, self.message_id)
+        return self.message_id
+
+    def fail(self):
+        """Replace a posted placeholder or partial answer with REPLY_ERROR_TEXT, unless the answer was delivered"""
+        if self.message_id is None or self.finished:
+            return
+        try:
+            self.telegram_client.edit_message(format_with_code_blocks(REPLY_ERROR_TEXT), self.chat_id, self.message_id)
+        except Exception as e:
+            log.error("Could not replace the placeholder in %s: %s", self.chat_id, e)
 
 
 class telegramClient:
-    def __init__(self) -> None:
-        pass
+    def __init__(self, coalesce_window: float = COALESCE_WINDOW, media_group_wait: float = MEDIA_GROUP_WAIT) -> None:
+        self.coalesce_window = coalesce_window
+        self.media_group_wait = media_group_wait
 
     def send_message(self, text: str, chat_id, original_message_id):
         """ Reply to a message of a user
@@ -202,12 +371,61 @@ class telegramClient:
             "text": format_with_code_blocks(text),
             "reply_to_message_id": original_message_id
         }
-        response = http.request('POST', SEND_MESSAGE_URL,
-                                headers={'Content-Type': 'application/json'},
-                                body=json.dumps(payload), timeout=10)
-        print(response.data)
+        response = sender.call("sendMessage", payload, chat_id)
+        if response.status != 200:
+            log.error("Sending a message to %s failed: %s", chat_id, response.data)
+        else:
+            log.debug("sendMessage response: %s", response.data)
+        return _sent_message_id(response)
+
+    def edit_message(self, formatted_text: str, chat_id, message_id, droppable: bool = False) -> bool:
+        """ Replace the text of a message sent by the bot
+
+        Args:
+            formatted_text (str): the new text, already formatted for MarkdownV2
+            chat_id (int): id of a chat
+            message_id (int): id of the bot's message
+            droppable (bool): skip the edit instead of waiting when the chat is rate limited
+
+        Returns:
+            whether the message was edited
+        """
+        payload = {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "parse_mode": "MarkdownV2",
+            "text": formatted_text,
+        }
+        response = sender.call("editMessageText", payload, chat_id, droppable=droppable)
+        if response is None:
+            return False
+        if response.status != 200:
+            log.warning("Editing message %s failed: %s", message_id, response.data)
+        return response.status == 200
+
+    def delete_message(self, chat_id, message_id):
+        payload = {"chat_id": chat_id, "message_id": message_id}
+        sender.call("deleteMessage", payload, chat_id)
 
     def send_photo(self, chat_id: int, image_bytes: bytes, caption: str, original_message_id: int, mime_type: str = "image/png"):
+        # An image Telegram already has is sent by its file_id instead of uploading it again
+        image_key = content_key(image_bytes)
+        cached_file_id = media_cache.get("sent", image_key)
+        if cached_file_id:
+            payload = {
+                "chat_id": chat_id,
+                "caption": format_with_code_blocks(caption),
+                "reply_to_message_id": original_message_id,
+                "parse_mode": "MarkdownV2",
+                "photo": cached_file_id.decode("utf-8"),
+            }
+            response = sender.call("sendPhoto", payload, chat_id)
+            if response.status == 200:
+                metrics.add("sent_photo_cache_hits")
+                metrics.add("sent_photo_bytes_saved", len(image_bytes), metrics.BYTES)
+                return
+            log.warning("Sending a cached photo failed, uploading it: %s", response.data)
+
         # Ensure we send the actual file name in the tuple
         filename = f"image.{mime_type.split('/')[-1]}"
         
@@ -219,43 +437,36 @@ class telegramClient:
             "parse_mode": "MarkdownV2",
             "photo": (filename, image_bytes, mime_type),
         }
-        
-        # Note: urllib3 request with fields and encode_multipart=False (or implied via POST with fields) 
-        # usually handles multipart correctly if we don't set Content-Type manually to JSON.
-        # However, verify that we aren't sending 'Content-Type: application/json' which would break it.
-        # The PoolManager.request method generates the correct Content-Type header with boundary.
-        
+
+        # The multipart Content-Type header with its boundary is generated by urllib3
         try:
-            response = http.request(
-                'POST',
-                SEND_PHOTO_URL,
-                fields=fields
-            )
-            print(f"Send photo response: {response.data}")
+            metrics.add("photo_upload_bytes", len(image_bytes), metrics.BYTES)
+            response = sender.call("sendPhoto", chat_id=chat_id, fields=fields)
+            if response.status != 200:
+                log.error("Sending a photo to %s failed: %s", chat_id, response.data)
+            else:
+                log.debug("sendPhoto response: %s", response.data)
+            file_id = _sent_photo_file_id(response)
+            if file_id:
+                media_cache.put("sent", image_key, file_id.encode("utf-8"))
         except Exception as e:
-            print(f"Error sending photo: {e}")
+            log.error("Error sending photo: %s", e)
 
     def should_reply(self, message: dict):
         """ The function that decides whether the bot should reply to a message or not """
         entities = message.get("entities") or message.get("caption_entities") or []
         # Check both "text" (for regular messages) and "caption" (for photos/media)
         message_text = message.get("text", "") or message.get("caption", "")
-        
-        print(f"[DEBUG] should_reply: BOT_NAME={BOT_NAME}, message_text={message_text[:100] if message_text else 'empty'}")
-        print(f"[DEBUG] should_reply: entities={entities}")
-        
+
         mentions_bot = any(
             entity.get("type") == "mention" and ("@" + BOT_NAME) in message_text
             for entity in entities
         )
-        
-        print(f"[DEBUG] should_reply: mentions_bot={mentions_bot}")
-        
         is_direct_message = message["from"]["id"] == message["chat"]["id"]
         is_reply_to_bot = "reply_to_message" in message and message["reply_to_message"].get("from", {}).get("id") == BOT_ID
-        
-        print(f"[DEBUG] should_reply: is_direct_message={is_direct_message}, is_reply_to_bot={is_reply_to_bot}")
-        
+        log.debug("should_reply: mentions_bot=%s, is_direct_message=%s, is_reply_to_bot=%s, entities=%s",
+                  mentions_bot, is_direct_message, is_reply_to_bot, entities)
+
         if is_direct_message or is_reply_to_bot or mentions_bot:
             return True
         bet = random.random()
@@ -263,58 +474,166 @@ class telegramClient:
             return True
         return False
 
-    def process_message(self, body):
-        """ Process a message of a user and with some probability reply to it
+    def _claim_burst(self, chat_key: str, message_id: str) -> Optional[List[str]]:
+        """The ids of the stored messages to answer together, ending with `message_id`
+
+        Called for a message that continues a burst: it waits for the coalescing
+        window to pass, and the last one of the messages that arrived meanwhile
+        answers all of them. None is returned to the others.
+        """
+        time.sleep(self.coalesce_window)
+        burst = dynamoDB_client.claim_burst(chat_key, message_id, COALESCE_MAX_DELAY)
+        if burst is None:
+            metrics.add("coalesced_messages")
+            return None
+        metrics.put("burst_messages", len(burst))
+        log.info("Answering %s messages of %s together", len(burst), chat_key)
+        return burst
+
+    def buffer_album(self, body) -> Optional[float]:
+        """Buffer an update of an album, returns the time to claim the album at
+
+        None if the update is not part of an album or albums are not buffered.
+        """
+        message = body.get("message", {})
+        media_group_id = message.get("media_group_id")
+        if not media_group_id or self.media_group_wait <= 0:
+            return None
+        chat_key = f"{str(message['chat']['id'])}_{str(BOT_ID)}"
+        dynamoDB_client.add_to_album(chat_key, media_group_id, message, BUFFER_TTL)
+        return time.time() + self.media_group_wait
+
+    def claim_album(self, body, claim_at: float) -> Optional[Dict[str, Any]]:
+        """The update with all messages of its album, None for the other updates of the album
+
+        Waits until `claim_at`, then the update buffered last carries the album:
+        its message is the album's first one with all messages under
+        "media_group" and their captions joined.
+        """
+        message = body["message"]
+        chat_key = f"{str(message['chat']['id'])}_{str(BOT_ID)}"
+        time.sleep(max(0.0, claim_at - time.time()))
+        album = dynamoDB_client.claim_album(chat_key, message["media_group_id"], str(message["message_id"]))
+        if album is None:
+            metrics.add("album_updates_merged")
+            return None
+        album.sort(key=lambda part: part["message_id"])
+        merged = dict(album[0], media_group=album)
+        captions = [part["caption"] for part in album if part.get("caption")]
+        if captions:
+            merged["caption"] = "\n".join(captions)
+        metrics.put("album_messages", len(album))
+        log.info("Answering an album of %s messages in %s", len(album), chat_key)
+        return dict(body, message=merged)
+
+    def collect_album(self, body) -> Optional[Dict[str, Any]]:
+        """The update with all messages of its album, None for the other updates of the album
+
+        Telegram sends every photo of an album as an update of its own. They are
+        buffered for MEDIA_GROUP_WAIT seconds, see `claim_album`.
+        """
+        claim_at = self.buffer_album(body)
+        return body if claim_at is None else self.claim_album(body, claim_at)
+
+    def process_queued(self, body) -> None:
+        """Process an update queued by the webhook, claiming its album first if it was buffered"""
+        claim_at = body.get(ALBUM_CLAIM_KEY)
+        if claim_at is not None:
+            body = self.claim_album({key: value for key, value in body.items() if key != ALBUM_CLAIM_KEY}, claim_at)
+            if body is None:
+                return
+        self.process_message(body)
+
+    def validate_update(self, body) -> Optional[int]:
+        """ Check that an update is a message the bot handles
 
         Args:
-            body (str): a telegram webhook body
+            body (dict): a telegram webhook body
+
+        Returns:
+            the chat id of the message, or None if the update should be ignored
         """
-        print(body)
         if (
             "message" in body and
             (not body["message"]["from"]["is_bot"] or body["message"]["from"].get("username") == "GroupAnonymousBot") and
             "forward_from_message_id" not in body["message"]
             ):
-            message = body["message"]
-
-            chat_id = message["chat"]["id"]
-            message_id = message["message_id"]
+            chat_id = body["message"]["chat"]["id"]
             if chat_id not in ALLOWED_CHATS:
-                print(f"{chat_id} is not allower")
-                return
-
-            if "entities" in message and message["entities"][0]["type"]  == "bot_command" and  ("/" + RESET_COMMAND) in message["text"]:
-                dynamoDB_client.reset_chat(f"{str(chat_id)}_{str(BOT_ID)}")
-                return
+                log.info("%s is not allowed", chat_id)
+                return None
+            return chat_id
+        return None
 
-            # Extract the message of a user
-            if "text" in body["message"]:
-                user_message = message["text"]
-            elif "sticker" in body["message"] and "emoji" in body["message"]["sticker"]:
-                user_message = message["sticker"]["emoji"]
-            elif "photo" in body["message"]:
-                user_message = message.get("caption", "Image shared without caption")
-            else:
-                return
+    @metrics.trace("process_message")
+    def process_message(self, body):
+        """ Process a message of a user and with some probability reply to it
 
-            structured_message = _structured_user_message(message, user_message.replace("@" + BOT_NAME, ""))
-
-            if self.should_reply(message) or structured_message.get("images"):
-                bot_message = openai_client.complete_chat(structured_message, chat_id, BOT_ID)
-                reply_text = bot_message.get("text", "").strip()
-                if bot_message.get("text"):
-                    self.send_message(reply_text, chat_id, message_id)
-                if bot_message.get("tool_images_meta"):
-                    print(f"[LOG] Found {len(bot_message.get('tool_images_meta'))} images to send.")
-                    for image_meta, encoded in zip(bot_message.get("tool_images_meta", []), bot_message.get("images", [])):
-                        if not encoded:
-                            print("[ERROR] Encoded image data is missing.")
-                            continue
-                        print(f"[LOG] Sending image to Telegram chat {chat_id}...")
-                        image_bytes = base64.b64decode(encoded)
-                        caption = image_meta.get("prompt", "").strip() or "Here is your image."
-                        self.send_photo(chat_id, image_bytes, caption, message_id, image_meta.get("mime_type", "image/png"))
-                        print("[LOG] Image sent successfully.")
-            else:
-                previous_messages = dynamoDB_client.load_messages(f"{str(chat_id)}_{str(BOT_ID)}")[-CONTEXT_LENGTH:]
-                dynamoDB_client.save_messages(f"{str(chat_id)}_{str(BOT_ID)}", previous_messages[-(CONTEXT_LENGTH-1):] + [structured_message])
+        Args:
+            body (str): a telegram webhook body
+        """
+        update_log.debug("Update: %s", body)
+        chat_id = self.validate_update(body)
+        if chat_id is None:
+            return
+        message = body["message"]
+        metrics.set_property("chat_id", chat_id)
+
+        if "entities" in message and message["entities"][0]["type"]  == "bot_command" and  ("/" + RESET_COMMAND) in message["text"]:
+            dynamoDB_client.reset_chat(f"{str(chat_id)}_{str(BOT_ID)}")
+            openai_client.reset_chat(chat_id, BOT_ID)
+            return
+
+        # Extract the message of a user
+        if "text" in body["message"]:
+            user_message = message["text"]
+        elif "sticker" in body["message"] and "emoji" in body["message"]["sticker"]:
+            user_message = message["sticker"]["emoji"]
+        elif "photo" in body["message"]:
+            user_message = message.get("caption", "Image shared without caption")
+        else:
+            return
+
+        structured_message = _structured_user_message(message, user_message.replace("@" + BOT_NAME, ""))
+        chat_key = f"{str(chat_id)}_{str(BOT_ID)}"
+
+        summary_due = False
+        if self.should_reply(message) or structured_message.get("images"):
+            burst_ids = None
+            answer = True
+            # Images are answered on their own, they reach the blob store when the answer is saved
+            if self.coalesce_window > 0 and not structured_message.get("images") and dynamoDB_client.join_burst(
+                    chat_key, structured_message["id"], self.coalesce_window, BUFFER_TTL):
+                # A message that continues a burst is stored right away, so it is kept
+                # whichever message of the burst answers it and whether that succeeds
+                summary_due = dynamoDB_client.append_message(chat_key, structured_message)
+                burst_ids = self._claim_burst(chat_key, structured_message["id"])
+                # Otherwise it is answered with a later message of the burst
+                answer = burst_ids is not None
+            if answer:
+                metrics.add("replies")
+                reply = telegramReply(self, chat_id, int(structured_message["id"]))
+                if STREAM_REPLIES:
+                    reply.start()
+                try:
+                    # Text is delivered as soon as the model asks for an image, which is sent once generated
+                    bot_message = openai_client.complete_chat(
+                        structured_message, chat_id, BOT_ID,
+                        burst_ids=burst_ids,
+                        on_text=reply.update if STREAM_REPLIES else None,
+                        on_tool_calls=reply.acknowledge,
+                        on_image=reply.send_image,
+                        on_answer=reply.finish,
+                    )
+                except Exception:
+                    # The user is not left with a placeholder that never turns into an answer
+                    reply.fail()
+                    raise
+                summary_due = summary_due or bot_message.get("_summary_due", False)
+        else:
+            # An ignored message is one write, unless it filled the stored window
+            summary_due = dynamoDB_client.append_message(chat_key, structured_message)
+        if summary_due:
+            # Older messages are summarized once the answer (if any) was delivered
+            openai_client.update_summary(chat_id, BOT_ID)
+        openai_client.flush_memory()
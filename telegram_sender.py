@@ -0,0 +1,202 @@
+"""Outbound Telegram Bot API calls within Telegram's rate limits.
+
+Every call to a chat takes a token from the global bucket and from the
+bucket of its chat, waiting while one of them is empty. A 429 answer pauses
+the chat for the `retry_after` Telegram asks for and the call is sent again,
+server errors are retried with exponential backoff. Connections come from
+one pool shared by all calls of the container.
+
+The buckets only see the calls of one container; concurrent containers are
+kept in line by the 429 handling.
+"""
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import urllib3
+
+import metrics
+from logger import get_logger
+
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+# Telegram allows about 30 messages per second overall, one per second in a
+# private chat and 20 per minute in a group, with short bursts
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_GROUP_RATE = float(os.environ.get('TELEGRAM_GROUP_RATE', '20')) / 60
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', '3'))
+# Longest a call waits for its chat, a longer retry_after fails the call
+TELEGRAM_MAX_WAIT = float(os.environ.get('TELEGRAM_MAX_WAIT', '30'))
+TELEGRAM_TIMEOUT = float(os.environ.get('TELEGRAM_TIMEOUT', '10'))
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', '10'))
+
+# Buckets of chats that were not written to recently are dropped
+CHAT_BUCKETS = 1024
+
+log = get_logger("telegram")
+
+
+class tokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token can be taken"""
+        self._refill(now)
+        missing = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+        return max(missing, self.paused_until - now)
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds: float, now: float) -> None:
+        self.paused_until = max(self.paused_until, now + seconds)
+
+
+def _stage_name(method: str) -> str:
+    # sendMessage -> telegram_send_message
+    return "telegram_" + re.sub(r"(?<!^)(?=[A-Z])", "_", method).lower()
+
+
+def _retry_after(response) -> float:
+    try:
+        retry_after = json.loads(response.data.decode()).get("parameters", {}).get("retry_after")
+    except (ValueError, AttributeError):
+        retry_after = None
+    if retry_after is None:
+        retry_after = response.headers.get("Retry-After") if response.headers else None
+    try:
+        return max(0.0, float(retry_after))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+class telegramSender:
+    def __init__(self, token: str, api_url: str = TELEGRAM_API_URL, global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 chat_rate: float = TELEGRAM_CHAT_RATE, group_rate: float = TELEGRAM_GROUP_RATE,
+                 chat_burst: float = TELEGRAM_CHAT_BURST, max_retries: int = TELEGRAM_MAX_RETRIES,
+                 max_wait: float = TELEGRAM_MAX_WAIT, timeout: float = TELEGRAM_TIMEOUT,
+                 pool_size: int = TELEGRAM_POOL_SIZE) -> None:
+        self.api_url = api_url.rstrip("/")
+        self.token = token
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.timeout = urllib3.Timeout(connect=min(3.0, timeout), read=timeout)
+        # Keep-alive connections for the parallel calls of a reply (placeholder, edits,
+        # photos, downloads). Only failed connection attempts are retried here, a request
+        # that reached Telegram is retried by `call`, which knows whether that is safe.
+        self.http = urllib3.PoolManager(
+            maxsize=pool_size,
+            retries=urllib3.Retry(total=None, connect=2, read=0, redirect=2, status=0, other=0, backoff_factor=0.1),
+        )
+        self.global_bucket = tokenBucket(global_rate, global_rate)
+        self.chat_buckets: "OrderedDict[Any, tokenBucket]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def method_url(self, method: str) -> str:
+        return f"{self.api_url}/bot{self.token}/{method}"
+
+    def file_url(self, file_path: str) -> str:
+        return f"{self.api_url}/file/bot{self.token}/{file_path}"
+
+    def _chat_bucket(self, chat_id) -> tokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Negative ids are groups and channels
+            rate = self.group_rate if int(chat_id) < 0 else self.chat_rate
+            bucket = self.chat_buckets[chat_id] = tokenBucket(rate, self.chat_burst)
+            while len(self.chat_buckets) > CHAT_BUCKETS:
+                self.chat_buckets.popitem(last=False)
+        self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _acquire(self, chat_id, wait: bool) -> bool:
+        """Take the tokens of a call, False if it would have to wait and `wait` is not set"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                buckets = [self.global_bucket, self._chat_bucket(chat_id)]
+                now = time.monotonic()
+                delay = max(bucket.delay(now) for bucket in buckets)
+                # After waiting TELEGRAM_MAX_WAIT the call goes out anyway, Telegram has the last word
+                if delay <= 0 or (wait and waited >= self.max_wait):
+                    for bucket in buckets:
+                        bucket.take(now)
+                    break
+            if not wait:
+                return False
+            delay = min(delay, self.max_wait - waited)
+            time.sleep(delay)
+            waited += delay
+        if waited:
+            metrics.add("telegram_rate_wait_ms", waited * 1000, metrics.MILLISECONDS)
+        return True
+
+    def _pause(self, chat_id, seconds: float) -> None:
+        with self.lock:
+            bucket = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+            bucket.pause(seconds, time.monotonic())
+
+    def call(self, method: str, payload: Optional[Dict[str, Any]] = None, chat_id=None,
+             fields: Optional[Dict[str, Any]] = None, droppable: bool = False):
+        """Call a Bot API method with a JSON `payload` or multipart `fields`
+
+        Calls to a chat (`chat_id`) are rate limited. A `droppable` call (e.g. an
+        intermediate edit) is skipped instead of waiting, and None is returned.
+        Otherwise the last response is returned, connection errors are raised.
+        """
+        stage = _stage_name(method)
+        url = self.method_url(method)
+        attempt = 0
+        while True:
+            if chat_id is not None and not self._acquire(chat_id, wait=not droppable):
+                metrics.add("telegram_dropped")
+                return None
+            try:
+                with metrics.stage(stage):
+                    if fields is not None:
+                        response = self.http.request('POST', url, fields=fields, timeout=self.timeout)
+                    else:
+                        response = self.http.request('POST', url, headers={'Content-Type': 'application/json'},
+                                                     body=json.dumps(payload or {}), timeout=self.timeout)
+            except urllib3.exceptions.HTTPError:
+                metrics.add("telegram_failed")
+                raise
+            if attempt >= self.max_retries or (response.status != 429 and response.status < 500):
+                break
+            if response.status == 429:
+                retry_after = _retry_after(response)
+                metrics.add("telegram_rate_limited")
+                if retry_after > self.max_wait:
+                    log.error("%s to %s is rate limited for %ss, giving up", method, chat_id, retry_after)
+                    break
+                log.warning("%s to %s is rate limited, retrying in %ss", method, chat_id, retry_after)
+                self._pause(chat_id, retry_after)
+                if chat_id is None:
+                    time.sleep(retry_after)
+            else:
+                delay = min(self.max_wait, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.0)
+                log.warning("%s to %s failed with %s, retrying in %.1fs", method, chat_id, response.status, delay)
+                time.sleep(delay)
+            attempt += 1
+            metrics.add("telegram_retries")
+        metrics.add("telegram_delivered" if response.status == 200 else "telegram_failed")
+        return response
@@ -0,0 +1,73 @@
+import os
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("DYNAMODB_TABLE_NAME", "history")
+os.environ.setdefault("CONTEXT_LENGTH", "5")
+os.environ.setdefault("BOT_ID", "1")
+os.environ.setdefault("BOT_NAME", "test_bot")
+os.environ.setdefault("OPENAI_KEY", "key")
+os.environ.setdefault("TEMPERATURE", "1")
+os.environ.setdefault("MAX_TOKENS", "100")
+
+import base64
+
+import pytest
+
+import blob_store
+import openai_client
+from blob_store import create_blob_store, localBlobStore, s3BlobStore
+from dinamodb_client import dynamoDBClient
+from local_dynamodb import localDynamoDBResource
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+
+
+@pytest.mark.parametrize("key", ["../outside", "images/../../outside", "/etc/passwd", "."])
+def test_local_store_rejects_keys_outside_its_directory(tmp_path, key):
+    store = localBlobStore(str(tmp_path / "store"))
+    with pytest.raises(ValueError):
+        store.put(key, b"data")
+    assert not (tmp_path / "outside").exists()
+
+
+def test_local_store_keeps_nested_keys(tmp_path):
+    store = localBlobStore(str(tmp_path))
+    store.put("images/chat/a.png", b"a")
+    store.put("images/chat/b.png", b"b")
+
+    assert store.get("images/chat/a.png") == b"a"
+    assert store.keys("images/") == ["images/chat/a.png", "images/chat/b.png"]
+    assert store.delete_prefix("images/chat/") == 2
+    assert store.get("images/chat/a.png") is None
+
+
+def test_local_backend_on_lambda_warns(monkeypatch, capsys):
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "bot")
+    assert isinstance(create_blob_store(), localBlobStore)
+    assert "[WARNING]" in capsys.readouterr().out
+
+    monkeypatch.setattr(blob_store, "BLOB_STORE_BACKEND", "s3")
+    assert isinstance(create_blob_store(), s3BlobStore)
+    assert capsys.readouterr().out == ""
+
+
+def test_history_images_go_through_the_blob_store(tmp_path):
+    client = openai_client.openaiClient(dynamoDBClient(localDynamoDBResource()))
+    client.blob_store = localBlobStore(str(tmp_path))
+    image = base64.b64encode(PNG).decode("ascii")
+
+    client._trim_and_save_messages("chat", [
+        {"role": "user", "id": "1", "text": "look", "images": [image]},
+        {"role": "user", "id": "2", "text": "again", "images": [image]},
+    ])
+
+    # The history holds references, the same image is stored once
+    messages = client.dynamoDB_client.load_messages("chat")
+    assert [message["images"] for message in messages] == [[], []]
+    assert messages[0]["image_refs"] == messages[1]["image_refs"]
+    assert client.blob_store.keys("images/chat/") == [messages[0]["image_refs"][0]["key"]]
+
+    client._load_history_images(messages, openai_client.IMAGE_TOKENS, set())
+    # Only the newest image fits into the budget
+    assert "_images" not in messages[0]
+    assert messages[1]["_images"] == [{"data": image, "mime_type": "image/png"}]
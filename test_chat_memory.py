@@ -0,0 +1,60 @@
+from blob_store import localBlobStore
+from chat_memory import chatMemory, hashingEmbedder
+
+
+class _countingEmbedder(hashingEmbedder):
+    def __init__(self) -> None:
+        super().__init__(64)
+        self.calls = 0
+
+    def embed(self, texts):
+        self.calls += 1
+        return super().embed(texts)
+
+
+def _messages(start, count):
+    return [{"role": "user", "id": str(index), "text": f"message {index} about topic {index}"}
+            for index in range(start, start + count)]
+
+
+def test_remember_only_buffers_until_flush(tmp_path):
+    embedder = _countingEmbedder()
+    memory = chatMemory(embedder, localBlobStore(str(tmp_path)))
+
+    assert memory.remember("chat", _messages(0, 3)) == 3
+    assert memory.remember("chat", _messages(3, 2)) == 2
+    assert embedder.calls == 0
+    assert memory.store.keys("memory/") == []
+
+    assert memory.flush() == 5
+    assert embedder.calls == 1
+    assert len(memory.store.keys("memory/chat/")) == 1
+
+
+def test_memory_is_shared_through_the_store(tmp_path):
+    store = localBlobStore(str(tmp_path))
+    writer = chatMemory(hashingEmbedder(64), store)
+    # Another container, with an index loaded before the writer flushed
+    reader = chatMemory(hashingEmbedder(64), store, refresh_interval=0)
+    assert reader.recall("chat", "topic 7") == []
+
+    writer.remember("chat", _messages(0, 10))
+    writer.flush()
+
+    assert reader.recall("chat", "message 7 about topic 7", k=1)[0]["id"] == "7"
+    assert reader.thread("chat", "3")[0]["text"] == "message 3 about topic 3"
+
+
+def test_compaction_merges_segments_without_losing_records(tmp_path):
+    store = localBlobStore(str(tmp_path))
+    memory = chatMemory(hashingEmbedder(64), store, compact_segments=3)
+    for batch in range(7):
+        memory.remember("chat", _messages(batch * 2, 2))
+        memory.flush()
+
+    assert len(store.keys("memory/chat/")) <= 3
+    fresh = chatMemory(hashingEmbedder(64), store)
+    assert sorted(int(record["id"]) for record in fresh._index("chat").records) == list(range(14))
+
+    fresh.forget("chat")
+    assert store.keys("memory/chat/") == []
@@ -0,0 +1,74 @@
+from context_window import reply_chain, select_context
+
+
+def _message(message_id, tokens, **fields):
+    return {"role": "user", "id": message_id, "text": message_id, "token_count": tokens, **fields}
+
+
+def _ids(messages):
+    return [message["id"] for message in messages]
+
+
+def test_newest_messages_fill_the_budget_exactly():
+    messages = [_message("1", 10), _message("2", 10), _message("3", 10)]
+
+    assert _ids(select_context(messages, budget=30)) == ["1", "2", "3"]
+    assert _ids(select_context(messages, budget=29)) == ["2", "3"]
+    assert _ids(select_context(messages, budget=9)) == []
+    # A budget of 0 keeps everything from `start` on
+    assert _ids(select_context(messages, budget=0)) == ["1", "2", "3"]
+    assert _ids(select_context(messages, budget=0, start=1)) == ["2", "3"]
+
+
+def test_message_that_does_not_fit_is_skipped():
+    messages = [_message("1", 5), _message("2", 50), _message("3", 10)]
+
+    assert _ids(select_context(messages, budget=20)) == ["1", "3"]
+
+
+def test_images_count_against_the_budget():
+    messages = [_message("1", 10), _message("2", 10, images=["data"])]
+
+    assert _ids(select_context(messages, budget=100)) == ["1"]
+
+
+def test_tool_call_is_kept_with_its_responses():
+    messages = [
+        _message("1", 10),
+        {"role": "assistant", "tool_calls": [{"id": "call"}], "token_count": 10},
+        {"role": "tool", "tool_call_id": "call", "content": "done", "token_count": 10},
+        _message("2", 10),
+    ]
+
+    assert [message["role"] for message in select_context(messages, budget=35)] == ["assistant", "tool", "user"]
+    # Without room for both, neither is sent
+    assert _ids(select_context(messages, budget=25)) == ["1", "2"]
+
+
+def test_reply_chain_follows_ids_and_telegram_ids():
+    messages = [
+        _message("1", 1),
+        _message("1-assistant", 1, role="assistant", telegram_id=77, reply_to_id="1"),
+        _message("2", 1),
+        _message("3", 1, reply_to_id="77"),
+    ]
+
+    assert reply_chain(messages, "3") == [3, 1, 0]
+    assert reply_chain(messages, None) == []
+
+
+def test_reply_chain_stops_at_a_message_that_is_not_stored():
+    messages = [_message("2", 1, reply_to_id="1"), _message("3", 1, reply_to_id="2"),
+                _message("4", 1, reply_to_id="5"), _message("5", 1, reply_to_id="4")]
+
+    assert reply_chain(messages, "3") == [1, 0]
+    # A reply loop ends once every message of it was visited
+    assert reply_chain(messages, "4") == [2, 3]
+
+
+def test_reply_chain_is_packed_before_newer_messages():
+    messages = [_message("1", 10), _message("2", 10), _message("3", 10), _message("4", 10, reply_to_id="1")]
+
+    assert _ids(select_context(messages, budget=20, reply_to_id="4")) == ["1", "4"]
+    # The chain is kept even before `start`, within the budget
+    assert _ids(select_context(messages, budget=30, reply_to_id="1", start=3)) == ["1", "4"]
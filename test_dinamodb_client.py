@@ -0,0 +1,179 @@
+import os
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("DYNAMODB_TABLE_NAME", "history")
+os.environ.setdefault("DYNAMODB_MESSAGES_TABLE_NAME", "messages")
+os.environ.setdefault("CONTEXT_LENGTH", "5")
+os.environ.setdefault("BOT_ID", "1")
+os.environ.setdefault("BOT_NAME", "test_bot")
+os.environ.setdefault("TELEGRAM_TOKEN", "token")
+os.environ.setdefault("FREQUENCY", "0")
+os.environ.setdefault("ALLOWED_CHATS", "-100")
+os.environ.setdefault("RESET_COMMAND", "reset")
+os.environ.setdefault("OPENAI_KEY", "key")
+os.environ.setdefault("TEMPERATURE", "1")
+os.environ.setdefault("MAX_TOKENS", "100")
+
+import random
+import threading
+import time
+
+import pytest
+
+import dinamodb_client
+import telegram_client
+from dinamodb_client import dynamoDBClient, CONTEXT_LENGTH, DYNAMODB_MESSAGES_TABLE_NAME
+from local_dynamodb import localDynamoDBResource
+from test_telegram_client import _update, _use_client
+
+
+def _local_client(layout):
+    resource = localDynamoDBResource({DYNAMODB_MESSAGES_TABLE_NAME: ("chat_id", "message_key")})
+    return resource, dynamoDBClient(resource, layout)
+
+
+@pytest.mark.parametrize("layout", ["blob", "items"])
+def test_ignored_message_is_one_request(monkeypatch, layout):
+    resource, client = _local_client(layout)
+    _use_client(monkeypatch, client)
+    bot = telegram_client.telegramClient()
+
+    for message_id in range(1, CONTEXT_LENGTH):
+        resource.reset_stats()
+        bot.process_message(_update(message_id, f"message {message_id}"))
+        assert resource.request_count == 1
+
+    texts = [message["text"] for message in client.load_messages("-100_1")]
+    assert texts == [f"message {message_id}" for message_id in range(1, CONTEXT_LENGTH)]
+
+
+@pytest.mark.parametrize("layout", ["blob", "items"])
+def test_append_keeps_last_context_length_messages(layout):
+    _, client = _local_client(layout)
+    total = CONTEXT_LENGTH * 3 + 2
+    for index in range(total):
+        client.append_message("chat", {"text": str(index), "id": str(index)})
+
+    messages = client.load_messages("chat", limit=CONTEXT_LENGTH)
+    assert [message["text"] for message in messages] == [str(index) for index in range(total - CONTEXT_LENGTH, total)]
+
+
+def test_items_save_removes_appended_overflow():
+    resource, client = _local_client("items")
+    for index in range(CONTEXT_LENGTH * 2):
+        client.append_message("chat", {"text": str(index), "id": str(index)})
+
+    history = client.load_messages("chat", limit=CONTEXT_LENGTH)
+    client.save_messages("chat", history[1:] + [{"text": "reply", "id": "reply"}])
+
+    assert len(resource.Table(DYNAMODB_MESSAGES_TABLE_NAME).items) == CONTEXT_LENGTH
+
+
+def test_migrate_all_skips_records_that_are_not_histories():
+    resource, blob = _local_client("blob")
+    blob.save_messages("-100_1", [{"text": "hello", "id": "1"}])
+    blob.claim_update("update_7_1", 60)
+    blob.save_summary("-100_1", "a summary", "1", 0)
+    blob.join_burst("-100_1", "1", 1, 60)
+    blob.add_to_album("-100_1", "album", {"message_id": 1}, 60)
+
+    items = dynamoDBClient(resource, "items")
+    assert items.migrate_all() == 1
+    assert {item["chat_id"] for item in resource.Table(DYNAMODB_MESSAGES_TABLE_NAME).items.values()} == {"-100_1"}
+    assert [message["text"] for message in items.load_messages("-100_1")] == ["hello"]
+
+
+def test_first_save_keeps_a_history_stored_meanwhile():
+    resource = localDynamoDBResource()
+    writer, other = dynamoDBClient(resource, "blob"), dynamoDBClient(resource, "blob")
+    other.save_messages("chat", [{"role": "user", "text": "first", "id": "1"}])
+
+    # The writer never loaded the chat, its save must not overwrite the stored history
+    writer.save_messages("chat", [{"role": "user", "text": "second", "id": "2"},
+                                  {"role": "assistant", "text": "answer", "id": "2-assistant"}])
+
+    stored = [message["id"] for message in dynamoDBClient(resource, "blob").load_messages("chat")]
+    assert sorted(stored) == ["1", "2", "2-assistant"]
+    assert stored[-1] == "2-assistant"
+
+
+@pytest.mark.parametrize("layout", ["blob", "items"])
+def test_interleaved_updates_lose_no_messages(monkeypatch, layout):
+    monkeypatch.setattr(dinamodb_client, "CONTEXT_LENGTH", 1000)
+    resource = localDynamoDBResource({DYNAMODB_MESSAGES_TABLE_NAME: ("chat_id", "message_key")})
+    ignored = dynamoDBClient(resource, layout)
+    # Each reply is a separate client, like another Lambda instance
+    first_reply = dynamoDBClient(resource, layout)
+    second_reply = dynamoDBClient(resource, layout)
+
+    # An append takes its key before the replies load the history and lands after
+    early_key = ignored._new_message_key(0)
+    ignored.append_message("chat", {"text": "ignored-1", "id": "ignored-1"})
+    first_history = first_reply.load_messages("chat")
+    second_history = second_reply.load_messages("chat")
+    ignored._new_message_key = lambda offset: early_key
+    ignored.append_message("chat", {"text": "late", "id": "late"})
+    del ignored._new_message_key
+
+    # Both replies save the history they loaded, the second one after the first
+    for client, history, user_id in ((first_reply, first_history, "user-1"), (second_reply, second_history, "user-2")):
+        client.save_messages("chat", history + [
+            {"role": "user", "text": user_id, "id": user_id},
+            {"role": "assistant", "text": f"{user_id}-assistant", "id": f"{user_id}-assistant"},
+        ])
+    ignored.append_message("chat", {"text": "ignored-2", "id": "ignored-2"})
+
+    stored = [message["id"] for message in dynamoDBClient(resource, layout).load_messages("chat")]
+    assert sorted(stored) == sorted(["ignored-1", "late", "user-1", "user-1-assistant",
+                                     "user-2", "user-2-assistant", "ignored-2"])
+    # The bot's reply stays after the message it answers
+    for index, message_id in enumerate(stored):
+        if message_id.endswith("-assistant"):
+            assert stored.index(message_id[:-len("-assistant")]) < index
+
+
+@pytest.mark.parametrize("layout", ["blob", "items"])
+def test_parallel_updates_lose_no_messages(monkeypatch, layout):
+    monkeypatch.setattr(dinamodb_client, "CONTEXT_LENGTH", 1000)
+    resource = localDynamoDBResource({DYNAMODB_MESSAGES_TABLE_NAME: ("chat_id", "message_key")}, latency=0.001)
+    expected = set()
+    lock = threading.Lock()
+
+    def ignored_messages(worker):
+        client = dynamoDBClient(resource, layout)
+        for index in range(15):
+            message_id = f"ignored-{worker}-{index}"
+            client.append_message("chat", {"text": message_id, "id": message_id})
+            with lock:
+                expected.add(message_id)
+
+    def replies(worker):
+        # Each reply path is a separate client, like another Lambda instance
+        jitter = random.Random(worker)
+        for index in range(5):
+            client = dynamoDBClient(resource, layout)
+            history = client.load_messages("chat")
+            time.sleep(jitter.uniform(0, 0.01))
+            user_id = f"user-{worker}-{index}"
+            new_records = [
+                {"role": "user", "text": user_id, "id": user_id},
+                {"role": "assistant", "text": f"{user_id}-assistant", "id": f"{user_id}-assistant"},
+            ]
+            client.save_messages("chat", history + new_records)
+            with lock:
+                expected.update(record["id"] for record in new_records)
+
+    threads = [threading.Thread(target=ignored_messages, args=(worker,)) for worker in range(4)]
+    threads += [threading.Thread(target=replies, args=(worker,)) for worker in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stored = [message["id"] for message in dynamoDBClient(resource, layout).load_messages("chat")]
+    assert set(stored) == expected
+    assert len(stored) == len(expected)
+    # The bot's reply stays after the message it answers
+    for index, message_id in enumerate(stored):
+        if message_id.endswith("-assistant"):
+            assert stored.index(message_id[:-len("-assistant")]) < index
@@ -0,0 +1,90 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import generation_cache
+from generation_cache import generationCache, generation_key
+
+
+def _image(size):
+    return {"data": b"x" * size, "mime_type": "image/png"}
+
+
+class _countingEvent(threading.Event):
+    waiting = 0
+
+    def wait(self, timeout=None):
+        _countingEvent.waiting += 1
+        return super().wait(timeout)
+
+
+def test_identical_requests_generate_once(monkeypatch):
+    cache = generationCache()
+    monkeypatch.setattr(generation_cache, "threading", SimpleNamespace(Event=_countingEvent))
+    monkeypatch.setattr(_countingEvent, "waiting", 0)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def create():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return _image(10)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_create("key", create))) for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # Every follower waits for the leader's generation
+    deadline = time.monotonic() + 5
+    while _countingEvent.waiting < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(how for _, how in results) == ["coalesced"] * 4 + ["miss"]
+    assert all(value == _image(10) for value, _ in results)
+    assert cache.get_or_create("key", create) == (_image(10), "hit")
+    assert len(calls) == 1
+
+
+def test_failed_generation_is_not_cached():
+    cache = generationCache()
+    assert cache.get_or_create("key", lambda: None) == (None, "miss")
+    assert cache.get_or_create("key", lambda: _image(1)) == (_image(1), "miss")
+
+
+def test_expired_entry_is_generated_again():
+    cache = generationCache(ttl=0.05)
+    cache.get_or_create("key", lambda: _image(1))
+    assert cache.get_or_create("key", lambda: _image(2))[1] == "hit"
+
+    time.sleep(0.06)
+    assert cache.get_or_create("key", lambda: _image(3)) == (_image(3), "miss")
+    assert cache.size == 3
+
+
+def test_oldest_entries_are_evicted_beyond_the_byte_limit():
+    cache = generationCache(max_bytes=25)
+    for key in ("a", "b", "c"):
+        cache.get_or_create(key, lambda: _image(10))
+    assert list(cache.entries) == ["b", "c"]
+    assert cache.size == 20
+    assert cache.stats["evictions"] == 1
+
+    # A hit makes an entry the newest one, and a result larger than the limit is not kept
+    cache.get_or_create("b", lambda: _image(10))
+    cache.get_or_create("d", lambda: _image(10))
+    cache.get_or_create("e", lambda: _image(30))
+    assert list(cache.entries) == ["b", "d"]
+    assert cache.size == 20
+
+
+def test_generation_key_ignores_case_and_spacing():
+    assert generation_key("A  red Cat", "1:1", "model") == generation_key("a red cat ", "1:1", "model")
+    assert generation_key("a red cat", "1:1", "model") != generation_key("a red cat", "16:9", "model")
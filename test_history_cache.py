@@ -0,0 +1,67 @@
+from history_cache import historyCache
+
+
+def _messages(count):
+    return [{"role": "user", "id": str(number), "text": f"message {number}"} for number in range(count)]
+
+
+def test_lookup_hits_only_the_cached_version():
+    cache = historyCache()
+    cache.put("chat", 3, _messages(2), size=10, state={"version": 3})
+
+    assert cache.version("chat") == 3
+    assert cache.get("chat", 2) is None
+    assert cache.get("chat", None) is None
+    assert cache.get("chat", 3) == {"messages": _messages(2), "state": {"version": 3}}
+    assert cache.stats == {"hits": 1, "misses": 2, "evictions": 0}
+
+
+def test_partial_history_covers_only_its_limit():
+    cache = historyCache()
+    cache.put("chat", 1, _messages(3), size=10, limit=3)
+
+    assert [message["id"] for message in cache.get("chat", 1, limit=2)["messages"]] == ["1", "2"]
+    assert cache.get("chat", 1, limit=4) is None
+    assert cache.get("chat", 1) is None
+
+
+def test_callers_cannot_change_the_cached_messages():
+    cache = historyCache()
+    messages = _messages(1)
+    cache.put("chat", 1, messages, size=10)
+    messages[0]["text"] = "changed before"
+    cache.get("chat", 1)["messages"][0]["text"] = "changed after"
+
+    assert cache.get("chat", 1)["messages"] == _messages(1)
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = historyCache(max_entries=2, max_bytes=20)
+    cache.put("a", 1, _messages(1), size=10)
+    cache.put("b", 1, _messages(1), size=10)
+    cache.get("a", 1)
+    cache.put("c", 1, _messages(1), size=10)
+    assert list(cache.entries) == ["a", "c"]
+
+    # Replacing an entry updates the size, beyond max_bytes the oldest ones go
+    cache.put("c", 2, _messages(1), size=12)
+    assert list(cache.entries) == ["c"]
+    assert cache.size == 12
+    assert cache.stats["evictions"] == 2
+
+
+def test_history_larger_than_the_limit_is_not_cached():
+    cache = historyCache(max_bytes=20)
+    cache.put("chat", 1, _messages(1), size=10)
+    cache.put("chat", 2, _messages(1), size=30)
+
+    assert cache.version("chat") is None
+    assert cache.size == 0
+
+
+def test_disabled_cache_keeps_nothing():
+    cache = historyCache(max_entries=0)
+    cache.put("chat", 1, _messages(1), size=10)
+
+    assert not cache.enabled
+    assert cache.get("chat", 1) is None
@@ -0,0 +1,43 @@
+import zlib
+
+import pytest
+
+import history_codec
+from history_codec import decode_history, encode_history
+
+RECORDS = [
+    {"role": "user", "id": "1", "username": "alice", "text": "привет 👋", "images": []},
+    {"role": "assistant", "id": "1-assistant", "text": "hi", "token_count": 3,
+     "tool_calls": [{"id": "call_1", "function": {"name": "generate_image", "arguments": "{}"}}]},
+]
+
+
+@pytest.mark.parametrize("orjson", [True, False])
+def test_records_round_trip(monkeypatch, orjson):
+    if not orjson:
+        monkeypatch.setattr(history_codec, "orjson", None)
+
+    data = encode_history(RECORDS)
+
+    assert data[0] == history_codec.FORMAT_ZLIB_JSON_ARRAY
+    assert decode_history(data) == RECORDS
+    assert decode_history(encode_history([])) == []
+
+
+def test_binary_attribute_is_unwrapped():
+    class binary:
+        value = encode_history(RECORDS)
+
+    assert decode_history(binary()) == RECORDS
+    assert decode_history(b"") == []
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError):
+        decode_history(bytes([99]) + zlib.compress(b"[]"))
+
+
+def test_corrupt_data_is_rejected():
+    data = encode_history(RECORDS)
+    with pytest.raises(zlib.error):
+        decode_history(data[:len(data) // 2])
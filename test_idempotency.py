@@ -0,0 +1,115 @@
+import os
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("DYNAMODB_TABLE_NAME", "history")
+os.environ.setdefault("CONTEXT_LENGTH", "5")
+os.environ.setdefault("BOT_ID", "1")
+os.environ.setdefault("BOT_NAME", "test_bot")
+os.environ.setdefault("TELEGRAM_TOKEN", "token")
+os.environ.setdefault("FREQUENCY", "0")
+os.environ.setdefault("ALLOWED_CHATS", "-100")
+os.environ.setdefault("RESET_COMMAND", "reset")
+os.environ.setdefault("OPENAI_KEY", "key")
+os.environ.setdefault("TEMPERATURE", "1")
+os.environ.setdefault("MAX_TOKENS", "100")
+
+import json
+import time
+
+from botocore.exceptions import ClientError
+
+import lambda_function
+from dinamodb_client import dynamoDBClient, DYNAMODB_TABLE_NAME
+from idempotency import updateDeduplicator
+from local_dynamodb import localDynamoDBResource
+
+
+def _deduplicator(resource=None, **kwargs):
+    return updateDeduplicator(dynamoDBClient(resource or localDynamoDBResource()), "1", **kwargs)
+
+
+def test_repeated_update_is_dropped_from_memory():
+    resource = localDynamoDBResource()
+    deduplicator = _deduplicator(resource)
+
+    assert deduplicator.claim(10)
+    requests = resource.request_count
+    assert not deduplicator.claim(10)
+
+    assert resource.request_count == requests
+    assert deduplicator.stats == {"accepted": 1, "suppressed_memory": 1, "suppressed_storage": 0}
+
+
+def test_update_seen_by_another_container_is_dropped_by_the_conditional_write():
+    resource = localDynamoDBResource()
+    first, second = _deduplicator(resource), _deduplicator(resource)
+
+    assert first.claim(10)
+    assert not second.claim(10)
+    assert second.stats == {"accepted": 0, "suppressed_memory": 0, "suppressed_storage": 1}
+
+
+def test_update_evicted_from_memory_is_still_dropped():
+    deduplicator = _deduplicator(cache_size=2)
+    for update_id in (1, 2, 3):
+        assert deduplicator.claim(update_id)
+
+    assert list(deduplicator.seen) == [2, 3]
+    assert not deduplicator.claim(1)
+    assert deduplicator.stats["suppressed_storage"] == 1
+
+
+def test_expired_record_is_claimed_again(monkeypatch):
+    resource = localDynamoDBResource()
+    assert _deduplicator(resource, ttl=60).claim(10)
+
+    # DynamoDB may not have deleted the expired record yet
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert _deduplicator(resource, ttl=60).claim(10)
+
+
+def test_other_errors_let_the_update_through(monkeypatch):
+    resource = localDynamoDBResource()
+
+    def put_item(**kwargs):
+        raise ClientError({"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "slow down"}},
+                          "PutItem")
+
+    monkeypatch.setattr(resource.Table(DYNAMODB_TABLE_NAME), "put_item", put_item)
+    deduplicator = _deduplicator(resource)
+
+    assert deduplicator.claim(10)
+    assert deduplicator.stats["accepted"] == 1
+
+
+def test_released_update_is_claimed_again():
+    resource = localDynamoDBResource()
+    deduplicator, other = _deduplicator(resource), _deduplicator(resource)
+    assert deduplicator.claim(10)
+
+    deduplicator.release(10)
+
+    assert other.claim(10)
+    deduplicator.release(10)
+    assert deduplicator.claim(10)
+
+
+def test_failed_update_is_processed_when_telegram_resends_it(monkeypatch):
+    monkeypatch.setattr(lambda_function, "deduplicator", _deduplicator())
+    monkeypatch.setattr(lambda_function, "PROCESSING_MODE", "sync")
+    processed = []
+
+    def process_message(body):
+        processed.append(body["update_id"])
+        if len(processed) == 1:
+            raise RuntimeError("completion failed")
+
+    monkeypatch.setattr(lambda_function.telegram_client, "process_message", process_message)
+    event = {"body": json.dumps({"update_id": 10, "message": {
+        "message_id": 7, "from": {"id": 42, "is_bot": False}, "chat": {"id": -100}, "text": "hi"}})}
+
+    assert lambda_function.lambda_handler(event, None)["body"] == "Error"
+    assert lambda_function.lambda_handler(event, None)["body"] == "Success"
+    assert lambda_function.lambda_handler(event, None)["body"] == "Duplicate"
+    assert processed == [10, 10]
@@ -0,0 +1,77 @@
+import base64
+import io
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+import image_ingestion
+from image_ingestion import base64_chunks, encode_image, recompress, select_photo_size
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def _photo(width, height, format="PNG"):
+    output = io.BytesIO()
+    # Noise does not compress, so the source is larger than its JPEG
+    noise = random.Random(width * height).randbytes(width * height * 3)
+    Image.frombytes("RGB", (width, height), noise).save(output, format=format)
+    return output.getvalue()
+
+
+def test_large_photo_is_downscaled_to_the_target():
+    data = recompress(_photo(1600, 1200), target=768, max_size=2048)
+
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.format == "JPEG"
+        assert image.size == (1024, 768)
+
+
+def test_long_side_is_capped():
+    with Image.open(io.BytesIO(recompress(_photo(3000, 1000), target=768, max_size=2048))) as image:
+        assert image.size == (2048, 683)
+
+
+def test_small_photo_keeps_its_size():
+    with Image.open(io.BytesIO(recompress(_photo(300, 200), target=768))) as image:
+        assert image.size == (300, 200)
+
+
+def test_recompression_that_does_not_shrink_is_dropped():
+    data = _photo(64, 64, format="JPEG")
+    assert recompress(data, quality=100) is None
+
+
+def test_unreadable_image_is_not_recompressed(capsys):
+    assert recompress(b"not an image") is None
+    assert "[WARNING]" in capsys.readouterr().out
+
+
+def test_encoded_image_falls_back_to_the_original():
+    data = b"not an image" * 10
+    encoded, sizes = encode_image([data[:7], data[7:]])
+
+    assert base64.b64decode(encoded) == data
+    assert sizes == {"downloaded_bytes": len(data), "encoded_bytes": len(encoded)}
+
+
+def test_chunks_are_encoded_like_the_whole():
+    data = bytes(range(256)) * 3
+    assert base64_chunks([data[:10], data[10:11], data[11:]]) == (base64.b64encode(data).decode("ascii"), len(data))
+
+
+def test_smallest_photo_size_reaching_the_target_is_selected():
+    sizes = [{"file_id": "large", "width": 1280, "height": 960}, {"file_id": "small", "width": 90, "height": 68},
+             {"file_id": "medium", "width": 800, "height": 600}]
+
+    assert select_photo_size(sizes, target=500)["file_id"] == "medium"
+    assert select_photo_size(sizes, target=2000)["file_id"] == "large"
+
+
+def test_pillow_is_imported_on_first_use():
+    code = ("import sys, image_ingestion; assert 'PIL' not in sys.modules; "
+            "image_ingestion.recompress(b'not an image'); assert 'PIL' in sys.modules")
+    subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(image_ingestion.__file__)),
+                   check=True, capture_output=True)
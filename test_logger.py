@@ -0,0 +1,79 @@
+import base64
+
+import pytest
+
+import logger
+from logger import categoryLogger, redact
+
+TOKEN = "123456789:AAH" + "x" * 32
+
+
+@pytest.fixture
+def debug_level(monkeypatch):
+    monkeypatch.setattr(logger, "LOG_LEVEL", logger.DEBUG)
+
+
+def test_redact_masks_tokens_and_keys(monkeypatch):
+    monkeypatch.setattr(logger, "_SECRETS", ["configured-secret"])
+
+    text = redact(f"POST https://api.telegram.org/bot{TOKEN}/sendMessage failed")
+    assert TOKEN not in text and "bot<redacted>/sendMessage" in text
+    assert redact(f"token {TOKEN}") == "token <redacted token>"
+    assert redact("key sk-proj-" + "a" * 40) == "key <redacted key>"
+    assert redact("key AIza" + "b" * 35) == "key <redacted key>"
+    assert redact("using configured-secret here") == "using <redacted> here"
+
+
+def test_redact_masks_base64_and_binary_data():
+    image = base64.b64encode(bytes(range(256)) * 2).decode("ascii")
+
+    assert redact(f"url data:image/png;base64,{image} end") == "url data:image/png;base64,<redacted> end"
+    assert redact(f"payload {image}") == f"payload <base64 {len(image)} chars>"
+    assert redact(f"bytes {bytes(range(256))!r}") == "bytes <binary data>"
+    # Short values and ordinary text are kept
+    assert redact("message 12345 from @alice: aGVsbG8=") == "message 12345 from @alice: aGVsbG8="
+
+
+def test_written_lines_are_redacted(capsys, debug_level):
+    categoryLogger("telegram").info("Sending to %s", f"bot{TOKEN}")
+    assert capsys.readouterr().out == "[LOG] Sending to bot<redacted>\n"
+
+
+def test_sampling_keeps_a_share_of_info_lines(monkeypatch, capsys, debug_level):
+    monkeypatch.setattr(logger, "_SAMPLE_RATES", {"update": 0.5, "tools": 0.0})
+    update_log, tools_log = categoryLogger("update"), categoryLogger("tools")
+
+    monkeypatch.setattr(logger.random, "random", lambda: 0.4)
+    update_log.debug("kept")
+    monkeypatch.setattr(logger.random, "random", lambda: 0.6)
+    update_log.debug("dropped")
+    tools_log.info("dropped")
+    # Warnings and errors are never sampled out
+    tools_log.warning("warned")
+    tools_log.error("failed")
+
+    assert capsys.readouterr().out.splitlines() == ["[DEBUG] kept", "[WARNING] warned", "[ERROR] failed"]
+    assert not tools_log.enabled(logger.INFO)
+    assert tools_log.enabled(logger.WARNING)
+
+
+def test_arguments_are_formatted_only_for_written_lines(monkeypatch, capsys):
+    monkeypatch.setattr(logger, "LOG_LEVEL", logger.INFO)
+    formatted = []
+
+    class expensive:
+        def __str__(self):
+            formatted.append(1)
+            return "diagnostics"
+
+    categoryLogger("update").debug("Update: %s", expensive())
+    assert formatted == []
+    categoryLogger("update").info("Update: %s", expensive())
+    assert formatted == [1]
+    assert capsys.readouterr().out == "[LOG] Update: diagnostics\n"
+
+
+def test_sampling_setting_is_parsed_leniently(capsys):
+    assert logger._sample_rates("update=0.01, tools=2,memory=-1,bad=x,") == {
+        "update": 0.01, "tools": 1.0, "memory": 0.0}
+    assert "bad=x" in capsys.readouterr().out
@@ -0,0 +1,71 @@
+import os
+
+from media_cache import content_key, mediaCache
+
+
+def test_cached_media_is_read_back(tmp_path):
+    cache = mediaCache(str(tmp_path))
+    cache.put("photo", "unique-id", b"data")
+
+    assert cache.get("photo", "unique-id") == b"data"
+    assert cache.get("file_id", "unique-id") is None
+    assert cache.stats == {"hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_least_recently_used_files_are_evicted_beyond_max_bytes(tmp_path):
+    cache = mediaCache(str(tmp_path), max_bytes=25)
+    for key in ("a", "b"):
+        cache.put("photo", key, b"x" * 10)
+    cache.get("photo", "a")
+    cache.put("photo", "c", b"x" * 10)
+
+    assert cache.get("photo", "b") is None
+    assert cache.get("photo", "a") == cache.get("photo", "c") == b"x" * 10
+    assert cache.size == 20
+    assert cache.stats["evictions"] == 1
+    assert len(os.listdir(tmp_path)) == 2
+
+    # Rewriting a file replaces its size, a file larger than the cache is not kept
+    cache.put("photo", "a", b"x" * 5)
+    cache.put("photo", "d", b"x" * 30)
+    assert cache.size == 15
+    assert cache.get("photo", "d") is None
+
+
+def test_files_of_an_earlier_process_are_reused(tmp_path):
+    mediaCache(str(tmp_path)).put("photo", "a", b"data")
+
+    cache = mediaCache(str(tmp_path), max_bytes=10)
+    assert cache.size == 4
+    assert cache.get("photo", "a") == b"data"
+
+
+def test_deleted_file_is_a_miss(tmp_path):
+    cache = mediaCache(str(tmp_path))
+    cache.put("photo", "a", b"data")
+    for name in os.listdir(tmp_path):
+        os.remove(tmp_path / name)
+
+    assert cache.get("photo", "a") is None
+    assert cache.size == 0
+
+
+def test_disabled_cache_writes_nothing(tmp_path):
+    cache = mediaCache(str(tmp_path / "cache"), max_bytes=0)
+    cache.put("photo", "a", b"data")
+
+    assert cache.get("photo", "a") is None
+    assert not (tmp_path / "cache").exists()
+
+
+def test_content_key_depends_on_the_bytes_only():
+    assert content_key(b"image") == content_key(b"image") != content_key(b"other")
+
+
+def test_failed_write_is_logged(tmp_path, capsys):
+    (tmp_path / "file").write_bytes(b"")
+    cache = mediaCache(str(tmp_path / "file" / "cache"))
+    cache.put("photo", "a", b"data")
+
+    assert capsys.readouterr().out.startswith("[WARNING] Could not cache photo media")
+    assert cache.get("photo", "a") is None
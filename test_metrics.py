@@ -0,0 +1,122 @@
+import json
+import threading
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def lines(monkeypatch, capsys):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", True)
+    monkeypatch.setattr(metrics, "_cold_start", True)
+
+    def read():
+        return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    return read
+
+
+def test_trace_writes_one_emf_line(lines):
+    with metrics.trace("handler"):
+        metrics.put("update_bytes", 120, metrics.BYTES)
+        metrics.add("replies")
+        metrics.add("replies")
+        metrics.set_property("chat_id", -100)
+        with metrics.stage("completion"):
+            pass
+
+    [line] = lines()
+    directive = line["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == metrics.METRICS_NAMESPACE
+    assert directive["Dimensions"] == [["trace"]]
+    units = {metric["Name"]: metric["Unit"] for metric in directive["Metrics"]}
+    assert units == {"update_bytes": "Bytes", "replies": "Count", "completion_ms": "Milliseconds",
+                     "handler_ms": "Milliseconds"}
+    assert isinstance(line["_aws"]["Timestamp"], int)
+    assert line["trace"] == "handler"
+    assert line["update_bytes"] == 120
+    assert line["replies"] == 2
+    assert line["completion_ms"] >= 0
+    assert line["chat_id"] == -100
+    assert line["cold_start"] is True
+
+
+def test_nested_trace_is_a_stage_of_the_outer_one(lines):
+    with metrics.trace("outer"):
+        with metrics.trace("inner"):
+            metrics.add("calls")
+    with metrics.trace("outer"):
+        pass
+
+    first, second = lines()
+    assert first["trace"] == "outer"
+    assert {"outer_ms", "inner_ms", "calls"} <= set(first)
+    # Only the first invocation of the container is a cold start
+    assert (first["cold_start"], second["cold_start"]) == (True, False)
+
+
+def test_failed_trace_records_the_error(lines):
+    with pytest.raises(KeyError):
+        with metrics.trace("handler"):
+            raise KeyError("chat")
+
+    [line] = lines()
+    assert line["errors"] == 1
+    assert line["error"] == "KeyError"
+
+
+def test_metric_outside_a_trace_is_written_right_away(lines):
+    metrics.put("queue_depth", 3)
+
+    [line] = lines()
+    assert line["trace"] == "background"
+    assert line["queue_depth"] == 3
+
+
+def test_disabled_metrics_write_nothing(monkeypatch, capsys):
+    monkeypatch.setattr(metrics, "METRICS_ENABLED", False)
+
+    def function():
+        return "result"
+
+    assert metrics.timed("function")(function) is function
+    with metrics.trace("handler"):
+        metrics.put("update_bytes", 120)
+        metrics.add("replies")
+        metrics.set_property("chat_id", -100)
+        with metrics.stage("completion"):
+            pass
+    metrics.put("queue_depth", 3)
+
+    assert capsys.readouterr().out == ""
+    assert metrics._current.get() is None
+
+
+def test_traces_of_concurrent_threads_stay_separate(lines):
+    both_started = threading.Barrier(2)
+
+    def invocation(name):
+        with metrics.trace(name):
+            metrics.set_property("chat_id", name)
+            both_started.wait(5)
+            metrics.add("replies")
+            # Work handed to another thread records into the trace that started it
+            worker = threading.Thread(target=metrics.in_current_trace(metrics.add), args=(f"{name}_calls",))
+            worker.start()
+            worker.join()
+            both_started.wait(5)
+
+    threads = [threading.Thread(target=invocation, args=(name,)) for name in ("first", "second")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    records = {line["trace"]: line for line in lines()}
+    assert set(records) == {"first", "second"}
+    for name, other in (("first", "second"), ("second", "first")):
+        assert records[name]["chat_id"] == name
+        assert records[name]["replies"] == 1
+        assert records[name][f"{name}_calls"] == 1
+        assert f"{other}_calls" not in records[name]
+    assert metrics._current.get() is None
@@ -0,0 +1,242 @@
+import os
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("DYNAMODB_TABLE_NAME", "history")
+os.environ.setdefault("CONTEXT_LENGTH", "5")
+os.environ.setdefault("BOT_ID", "1")
+os.environ.setdefault("BOT_NAME", "test_bot")
+os.environ.setdefault("OPENAI_KEY", "key")
+os.environ.setdefault("TEMPERATURE", "1")
+os.environ.setdefault("MAX_TOKENS", "100")
+
+import base64
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import dinamodb_client
+import openai_client
+from blob_store import localBlobStore
+from dinamodb_client import dynamoDBClient, DYNAMODB_MESSAGES_TABLE_NAME
+from local_dynamodb import localDynamoDBResource
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+
+
+def _client(tmp_path):
+    client = openai_client.openaiClient(dynamoDBClient(localDynamoDBResource()))
+    client.blob_store = localBlobStore(str(tmp_path))
+    return client
+
+
+def test_generated_images_are_sent_as_user_messages(tmp_path):
+    client = _client(tmp_path)
+    image = base64.b64encode(PNG).decode("ascii")
+    client._trim_and_save_messages("chat", [
+        {"role": "user", "id": "1", "text": "draw a cat", "images": []},
+        {"role": "assistant", "id": "1-assistant", "text": "Here is the cat", "images": [image],
+         "tool_images_meta": [{"prompt": "a cat"}]},
+        {"role": "user", "id": "2", "text": "and this one?", "images": [image]},
+    ])
+    messages = client.dynamoDB_client.load_messages("chat")
+    client._load_history_images(messages, float("inf"), set())
+
+    formatted = client._format_history(messages)
+
+    for message in formatted:
+        if message["role"] == "assistant":
+            assert all(part["type"] == "text" for part in message["content"])
+    assert [message["role"] for message in formatted] == ["user", "assistant", "user", "user"]
+    generated = formatted[2]["content"]
+    assert "message 1-assistant" in generated[0]["text"]
+    assert generated[1]["image_url"]["url"] == f"data:image/png;base64,{image}"
+    assert formatted[3]["content"][1]["type"] == "image_url"
+
+
+@pytest.mark.parametrize("layout", ["blob", "items"])
+def test_evicted_messages_are_summarized_first(tmp_path, monkeypatch, layout):
+    resource = localDynamoDBResource({DYNAMODB_MESSAGES_TABLE_NAME: ("chat_id", "message_key")})
+    client = openai_client.openaiClient(dynamoDBClient(resource, layout))
+    client.blob_store = localBlobStore(str(tmp_path))
+    folded = []
+
+    def create_completion(**kwargs):
+        folded.append(kwargs["messages"][1]["content"])
+        return SimpleNamespace(content=f"summary {len(folded)}")
+    monkeypatch.setattr(client, "_create_completion", create_completion)
+    evicted = []
+    client.dynamoDB_client.on_evict = lambda chat_key, messages: evicted.extend(messages)
+
+    # Ignored messages and replies overflow the window several times, without update_summary
+    for number in range(1, 46):
+        message = {"role": "user", "id": str(number), "text": f"message {number}"}
+        if number % 4:
+            client.dynamoDB_client.append_message("chat", message)
+        else:
+            history = client.dynamoDB_client.load_messages("chat")
+            client._trim_and_save_messages("chat", history + [
+                message, {"role": "assistant", "id": f"{number}-assistant", "text": "ok"}])
+
+    summary = client.dynamoDB_client.load_summary("chat")
+    covered = int(summary["covered"].split("-")[0])
+    assert evicted and folded
+    assert all(int(message["id"].split("-")[0]) <= covered for message in evicted)
+    # Every message left the window through the summary, none was folded twice
+    stored = {message["id"] for message in client.dynamoDB_client.load_messages("chat")}
+    assert {message["id"] for message in evicted} | stored >= {str(number) for number in range(1, 46)}
+    assert sum(text.count(": message ") for text in folded) == len({m["id"] for m in evicted if m["role"] == "user"})
+
+
+def test_messages_stay_stored_while_their_summary_fails(tmp_path, monkeypatch):
+    client = _client(tmp_path)
+
+    def create_completion(**kwargs):
+        raise RuntimeError("unavailable")
+    monkeypatch.setattr(client, "_create_completion", create_completion)
+    history = [{"role": "user", "id": str(number), "text": f"message {number}"} for number in range(1, 6)]
+    client._trim_and_save_messages("chat", history)
+
+    client._trim_and_save_messages("chat", history[2:] + [{"role": "user", "id": "6", "text": "message 6"}])
+
+    # The dropped messages are kept for the next write, not lost
+    assert [message["id"] for message in client.dynamoDB_client.load_messages("chat", limit=10)] == [
+        "1", "2", "3", "4", "5", "6"]
+    assert client.dynamoDB_client.load_summary("chat") is None
+
+
+def test_exchange_is_saved_when_its_delivery_fails(tmp_path, monkeypatch):
+    client = _client(tmp_path)
+    monkeypatch.setattr(client, "_create_completion",
+                        lambda on_text=None, **kwargs: SimpleNamespace(content="hello alice", tool_calls=None))
+
+    def on_answer(text):
+        raise ConnectionError("Telegram is down")
+
+    with pytest.raises(ConnectionError):
+        client.complete_chat({"role": "user", "id": "1", "username": "alice", "text": "hi"}, -100, 1,
+                             on_answer=on_answer)
+
+    messages = client.dynamoDB_client.load_messages(client._chat_key(-100, 1))
+    assert [(message["role"], message["text"]) for message in messages] == [
+        ("user", "hi"), ("assistant", "hello alice")]
+
+
+def test_consecutive_requests_share_their_prefix(tmp_path, monkeypatch):
+    monkeypatch.setattr(openai_client, "SYSTEM_PROMPT", "You are a helpful bot.")
+    monkeypatch.setattr(openai_client, "STYLE_PROMPT", "Answer briefly.")
+    client = _client(tmp_path)
+    requests = []
+
+    def create_completion(on_text=None, **kwargs):
+        requests.append(kwargs)
+        return SimpleNamespace(content=f"answer {len(requests)}", tool_calls=None)
+    monkeypatch.setattr(client, "_create_completion", create_completion)
+
+    for number in (1, 2):
+        client.complete_chat({"role": "user", "id": str(number), "username": "alice", "text": f"question {number}"},
+                             -100, 1)
+
+    first, second = requests
+    assert second["tools"] is first["tools"]
+    # Only the style prompt and the new message follow the shared prefix
+    assert first["messages"][-2] == second["messages"][-2] == {
+        "role": "system", "content": [{"type": "text", "text": "Answer briefly."}]}
+    shared = len(first["messages"]) - 2
+    assert json.dumps(second["messages"][:shared]) == json.dumps(first["messages"][:shared])
+    assert second["messages"][shared]["content"] == first["messages"][-1]["content"]
+
+
+def _tool_call(prompt):
+    return SimpleNamespace(id=f"call_{prompt}", function=SimpleNamespace(
+        name="generate_image", arguments=json.dumps({"prompt": prompt})))
+
+
+def test_tool_results_keep_the_order_of_the_calls(tmp_path, monkeypatch):
+    client = _client(tmp_path)
+    monkeypatch.setattr(openai_client, "TOOL_MAX_WORKERS", 3)
+    delays = {"slow": 0.2, "fast": 0.0, "medium": 0.1}
+
+    def generate_image(prompt, aspect_ratio, display_prompt):
+        time.sleep(delays[prompt])
+        return {"data": prompt.encode(), "mime_type": "image/png", "prompt": prompt}
+    monkeypatch.setattr(client, "_generate_image", generate_image)
+    delivered = []
+
+    results = client._run_tool_calls([_tool_call(prompt) for prompt in delays],
+                                     lambda meta, data: delivered.append(data))
+
+    assert [response["tool_call_id"] for response, _ in results] == ["call_slow", "call_fast", "call_medium"]
+    assert [image["data"] for _, image in results] == [b"slow", b"fast", b"medium"]
+    # Images are delivered as soon as they are ready
+    assert delivered == [b"fast", b"medium", b"slow"]
+
+
+def test_failed_tool_calls_get_a_failed_response(tmp_path, monkeypatch):
+    client = _client(tmp_path)
+    monkeypatch.setattr(openai_client, "TOOL_CALL_TIMEOUT", 0.2)
+    release = threading.Event()
+
+    def generate_image(prompt, aspect_ratio, display_prompt):
+        if prompt == "raises":
+            raise RuntimeError("Gemini is down")
+        if prompt == "hangs":
+            release.wait(5)
+        return {"data": prompt.encode(), "mime_type": "image/png", "prompt": prompt}
+    monkeypatch.setattr(client, "_generate_image", generate_image)
+    delivered = []
+
+    try:
+        results = client._run_tool_calls([_tool_call(prompt) for prompt in ("hangs", "raises", "works")],
+                                         lambda meta, data: delivered.append(data))
+    finally:
+        release.set()
+
+    statuses = [json.loads(response["content"])["status"] for response, _ in results]
+    assert statuses == ["failed", "failed", "image_generated"]
+    assert json.loads(results[0][0]["content"])["reason"] == "Tool call timed out"
+    assert [image and image["data"] for _, image in results] == [None, None, b"works"]
+    # The abandoned call no longer delivers its image
+    time.sleep(0.05)
+    assert delivered == [b"works"]
+
+
+def test_summary_folds_the_oldest_messages_once_due(tmp_path, monkeypatch):
+    monkeypatch.setattr(openai_client, "CONTEXT_LENGTH", 10)
+    monkeypatch.setattr(dinamodb_client, "CONTEXT_LENGTH", 10)
+    monkeypatch.setattr(openai_client, "SUMMARY_TRIGGER", 4)
+    monkeypatch.setattr(openai_client, "SUMMARY_KEEP_RECENT", 1)
+    client = _client(tmp_path)
+    summaries, requests = [], []
+
+    def create_completion(on_text=None, **kwargs):
+        if kwargs["messages"][0]["content"] == openai_client.SUMMARY_INSTRUCTION:
+            summaries.append(kwargs["messages"][1]["content"])
+            return SimpleNamespace(content=f"summary {len(summaries)}", tool_calls=None)
+        requests.append(kwargs["messages"])
+        return SimpleNamespace(content=f"answer {len(requests)}", tool_calls=None)
+    monkeypatch.setattr(client, "_create_completion", create_completion)
+
+    def ask(number):
+        return client.complete_chat({"role": "user", "id": str(number), "username": "alice",
+                                     "text": f"question {number}"}, -100, 1)
+
+    assert not ask(1)["_summary_due"]
+    assert ask(2)["_summary_due"]
+    assert client.update_summary(-100, 1)
+
+    # The newest message stays unsummarized, the watermark is the last folded one
+    chat_key = client._chat_key(-100, 1)
+    assert client.dynamoDB_client.load_summary(chat_key) == {"text": "summary 1", "covered": "2", "version": 1}
+    [folded] = summaries
+    assert "question 1" in folded and "answer 1" in folded and "question 2" in folded
+    assert "answer 2" not in folded
+
+    assert not ask(3)["_summary_due"]
+    assert not client.update_summary(-100, 1)
+    assert len(summaries) == 1
+    # The folded messages are sent as the summary only
+    sent = json.dumps(requests[-1])
+    assert "summary 1" in sent and "question 1" not in sent and "answer 2" in sent
@@ -0,0 +1,206 @@
+import os
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("DYNAMODB_TABLE_NAME", "history")
+os.environ.setdefault("DYNAMODB_MESSAGES_TABLE_NAME", "messages")
+os.environ.setdefault("CONTEXT_LENGTH", "5")
+os.environ.setdefault("BOT_ID", "1")
+os.environ.setdefault("BOT_NAME", "test_bot")
+os.environ.setdefault("TELEGRAM_TOKEN", "token")
+os.environ.setdefault("FREQUENCY", "0")
+os.environ.setdefault("ALLOWED_CHATS", "-100")
+os.environ.setdefault("RESET_COMMAND", "reset")
+os.environ.setdefault("OPENAI_KEY", "key")
+os.environ.setdefault("TEMPERATURE", "1")
+os.environ.setdefault("MAX_TOKENS", "100")
+
+import threading
+import time
+
+import pytest
+
+import telegram_client
+from dinamodb_client import dynamoDBClient
+from local_dynamodb import localDynamoDBResource
+from local_telegram import localTelegramServer
+from telegram_client import format_partial_for_telegram
+from telegram_sender import telegramSender
+
+
+class _noOpenAI:
+    def __getattr__(self, name):
+        raise AssertionError(f"OpenAI was called ({name})")
+
+
+def _use_client(monkeypatch, client):
+    """Route the Telegram and OpenAI clients to `client` and fail on any OpenAI call"""
+    monkeypatch.setattr(telegram_client, "dynamoDB_client", client)
+    monkeypatch.setattr(telegram_client.openai_client, "dynamoDB_client", client)
+    monkeypatch.setattr(telegram_client.openai_client, "_client", _noOpenAI())
+
+
+def _update(message_id, text):
+    return {
+        "update_id": message_id,
+        "message": {
+            "message_id": message_id,
+            "from": {"id": 42, "is_bot": False, "username": "alice"},
+            "chat": {"id": -100},
+            "text": text,
+        },
+    }
+
+
+@pytest.mark.parametrize("text, formatted", [
+    ("Hello *bold", "Hello \\*bold"),
+    ("an _italic", "an \\_italic"),
+    ("a *b* and _c", "a \\*b\\* and \\_c"),
+    ("code ```py\nx = 1", "code ```py\nx = 1\n```"),
+    ("inline `x", "inline `x`"),
+    ("```a``` and `b", "```a``` and `b`"),
+    # A fence still being typed is dropped until it is complete
+    ("fence ``", "fence "),
+])
+def test_partial_answer_is_valid_markdown(text, formatted):
+    assert format_partial_for_telegram(text) == formatted
+
+
+def test_partial_answer_leaves_room_for_escaping():
+    formatted = format_partial_for_telegram("```\n" + "." * telegram_client.MAX_MESSAGE_LENGTH)
+
+    assert formatted.endswith("\n```")
+    assert len(formatted) <= telegram_client.MAX_MESSAGE_LENGTH
+
+
+@pytest.mark.parametrize("answered", [False, True])
+def test_placeholder_is_replaced_when_the_answer_fails(monkeypatch, answered):
+    _use_client(monkeypatch, dynamoDBClient(localDynamoDBResource(), "blob"))
+    monkeypatch.setattr(telegram_client, "STREAM_REPLIES", True)
+
+    def complete_chat(user_message, chat_id, bot_id, on_text=None, on_answer=None, **kwargs):
+        on_text("partial")
+        if answered:
+            on_answer("the answer")
+        raise RuntimeError("completion failed")
+
+    monkeypatch.setattr(telegram_client.openai_client, "complete_chat", complete_chat)
+    update = {"update_id": 1, "message": {"message_id": 7, "from": {"id": 42, "is_bot": False}, "chat": {"id": -100},
+                                          "text": "hi", "reply_to_message": {"message_id": 1, "from": {"id": 1}}}}
+
+    with localTelegramServer() as server:
+        monkeypatch.setattr(telegram_client, "sender", telegramSender(server.token, server.api_url))
+        with pytest.raises(RuntimeError):
+            telegram_client.telegramClient(coalesce_window=0).process_message(update)
+
+    assert server.calls_of("sendMessage")[0]["payload"]["text"] == telegram_client.STREAM_PLACEHOLDER
+    last_text = server.calls_of("editMessageText")[-1]["payload"]["text"]
+    if answered:
+        # A delivered answer is left alone
+        assert last_text == "the answer"
+    else:
+        assert last_text == telegram_client.format_with_code_blocks(telegram_client.REPLY_ERROR_TEXT)
+
+
+def _send_burst(bot, count):
+    threads = []
+    for message_id in range(1, count + 1):
+        update = _update(message_id, f"message {message_id}")
+        update["message"]["reply_to_message"] = {"message_id": 0, "from": {"id": telegram_client.BOT_ID}}
+        threads.append(threading.Thread(target=bot.process_message, args=(update,)))
+        threads[-1].start()
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+
+
+def test_burst_is_answered_once(monkeypatch):
+    client = dynamoDBClient(localDynamoDBResource(), "blob")
+    _use_client(monkeypatch, client)
+    answered = []
+
+    def complete_chat(user_message, chat_id, bot_id, burst_ids=None, **kwargs):
+        answered.append((user_message["text"], burst_ids))
+        return {"text": ""}
+
+    monkeypatch.setattr(telegram_client.openai_client, "complete_chat", complete_chat)
+    monkeypatch.setattr(telegram_client.openai_client, "update_summary", lambda chat_id, bot_id: None)
+    _send_burst(telegram_client.telegramClient(coalesce_window=0.3), 4)
+
+    # The first message is answered right away, the rest of the burst in one completion
+    assert answered == [("message 1", None), ("message 4", ["2", "3", "4"])]
+    # and is stored as it arrives
+    assert [message["id"] for message in client.load_messages("-100_1")] == ["2", "3", "4"]
+
+
+def test_burst_is_kept_when_its_answer_fails(monkeypatch):
+    client = dynamoDBClient(localDynamoDBResource(), "blob")
+    _use_client(monkeypatch, client)
+
+    def complete_chat(user_message, chat_id, bot_id, burst_ids=None, **kwargs):
+        if burst_ids:
+            raise RuntimeError("completion failed")
+        return {"text": ""}
+
+    monkeypatch.setattr(telegram_client.openai_client, "complete_chat", complete_chat)
+    monkeypatch.setattr(telegram_client.openai_client, "update_summary", lambda chat_id, bot_id: None)
+    monkeypatch.setattr(threading, "excepthook", lambda args: None)
+    _send_burst(telegram_client.telegramClient(coalesce_window=0.3), 3)
+
+    # The answer failed, the messages of the burst are kept
+    assert [message["id"] for message in client.load_messages("-100_1")] == ["2", "3"]
+
+
+@pytest.mark.parametrize("mode", ["sync", "queue"])
+def test_album_is_answered_once(monkeypatch, mode):
+    client = dynamoDBClient(localDynamoDBResource(), "blob")
+    _use_client(monkeypatch, client)
+    monkeypatch.setattr(telegram_client.media_cache, "max_bytes", 0)
+    answered = []
+
+    def complete_chat(user_message, chat_id, bot_id, **kwargs):
+        answered.append(user_message)
+        return {"text": ""}
+
+    monkeypatch.setattr(telegram_client.openai_client, "complete_chat", complete_chat)
+    monkeypatch.setattr(telegram_client.openai_client, "update_summary", lambda chat_id, bot_id: None)
+    bot = telegram_client.telegramClient(media_group_wait=0.3)
+
+    with localTelegramServer() as server:
+        monkeypatch.setattr(telegram_client, "sender", telegramSender(server.token, server.api_url))
+
+        def album_update(message_id):
+            server.files[f"photo-{message_id}"] = b"\xff\xd8 photo %d" % message_id
+            message = {"message_id": message_id, "media_group_id": "album", "from": {"id": 42, "is_bot": False},
+                       "chat": {"id": -100}, "photo": [{"file_id": f"photo-{message_id}", "width": 90, "height": 90}]}
+            if message_id == 1:
+                message["caption"] = "our trip"
+            return {"update_id": message_id, "message": message}
+
+        updates = [album_update(message_id) for message_id in (1, 2, 3)]
+        if mode == "sync":
+            def handle(update):
+                update = bot.collect_album(update)
+                if update is not None:
+                    bot.process_message(update)
+
+            threads = [threading.Thread(target=handle, args=(update,)) for update in updates]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            # The webhook only buffers the photos, the worker takes them one after another
+            started = time.monotonic()
+            queued = [dict(update, **{telegram_client.ALBUM_CLAIM_KEY: bot.buffer_album(update)}) for update in updates]
+            assert time.monotonic() - started < 0.3
+            for update in queued:
+                bot.process_queued(update)
+            # Only the first queued photo waits for the album
+            assert time.monotonic() - started < 0.6
+
+        assert len(server.calls_of("getFile")) == 3
+
+    assert len(answered) == 1
+    assert answered[0]["id"] == "1"
+    assert answered[0]["text"] == "our trip"
+    assert len(answered[0]["images"]) == 3
@@ -0,0 +1,106 @@
+import os
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("DYNAMODB_TABLE_NAME", "history")
+os.environ.setdefault("CONTEXT_LENGTH", "5")
+os.environ.setdefault("BOT_ID", "1")
+os.environ.setdefault("BOT_NAME", "test_bot")
+os.environ.setdefault("TELEGRAM_TOKEN", "token")
+os.environ.setdefault("FREQUENCY", "0")
+os.environ.setdefault("ALLOWED_CHATS", "-100")
+os.environ.setdefault("RESET_COMMAND", "reset")
+os.environ.setdefault("OPENAI_KEY", "key")
+os.environ.setdefault("TEMPERATURE", "1")
+os.environ.setdefault("MAX_TOKENS", "100")
+
+import threading
+import time
+
+import pytest
+
+import telegram_client
+from local_telegram import localTelegramServer
+from telegram_sender import telegramSender
+
+
+@pytest.fixture
+def server():
+    with localTelegramServer() as server:
+        yield server
+
+
+def _sender(server, **kwargs):
+    return telegramSender(server.token, server.api_url, **kwargs)
+
+
+def test_rate_limited_call_is_sent_again_after_retry_after(server):
+    server.fail_next(1, status=429, retry_after=1)
+    sender = _sender(server)
+
+    started = time.monotonic()
+    response = sender.call("sendMessage", {"chat_id": 42, "text": "hi"}, 42)
+
+    assert response.status == 200
+    assert time.monotonic() - started >= 1
+    assert len(server.calls_of("sendMessage")) == 2
+
+
+def test_burst_to_one_chat_stays_within_its_rate(server):
+    server.chat_interval = 0.05
+    sender = _sender(server, chat_rate=10, chat_burst=1)
+
+    threads = [threading.Thread(target=sender.call, args=("sendMessage", {"chat_id": 42, "text": str(n)}, 42))
+               for n in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    calls = server.calls_of("sendMessage")
+    assert len(calls) == 5
+    times = [call["time"] for call in calls]
+    assert all(later - earlier >= 0.05 for earlier, later in zip(times, times[1:]))
+
+
+def test_chats_do_not_wait_for_each_other(server):
+    sender = _sender(server, chat_rate=1, chat_burst=1)
+
+    started = time.monotonic()
+    for chat_id in range(1, 6):
+        assert sender.call("sendMessage", {"chat_id": chat_id, "text": "hi"}, chat_id).status == 200
+
+    assert time.monotonic() - started < 1
+
+
+def test_server_errors_are_retried_and_bad_requests_are_not(server):
+    sender = _sender(server)
+    server.fail_next(2, status=502)
+    assert sender.call("sendMessage", {"chat_id": 42, "text": "hi"}, 42).status == 200
+    assert len(server.calls_of("sendMessage")) == 3
+
+    server.fail_next(1, status=400)
+    assert sender.call("sendMessage", {"chat_id": 42, "text": "hi"}, 42).status == 400
+    assert len(server.calls_of("sendMessage")) == 4
+
+
+def test_droppable_call_is_skipped_while_the_chat_is_busy(server):
+    sender = _sender(server, chat_rate=0.5, chat_burst=1)
+
+    assert sender.call("sendMessage", {"chat_id": 42, "text": "hi"}, 42).status == 200
+    assert sender.call("editMessageText", {"chat_id": 42, "message_id": 1, "text": "h"}, 42, droppable=True) is None
+    assert server.calls_of("editMessageText") == []
+
+
+def test_telegram_client_delivers_through_the_sender(monkeypatch, server):
+    monkeypatch.setattr(telegram_client, "sender", _sender(server))
+    monkeypatch.setattr(telegram_client.media_cache, "max_bytes", 0)
+    bot = telegram_client.telegramClient()
+
+    message_id = bot.send_message("hello", 42, 7)
+    assert bot.edit_message("hello again", 42, message_id)
+    bot.send_photo(42, b"\x89PNG image", "a cat", 7)
+
+    photo = server.calls_of("sendPhoto")[0]["payload"]
+    assert photo["photo"] == b"\x89PNG image"
+    assert photo["chat_id"] == "42"
+    assert server.calls_of("sendMessage")[0]["payload"]["reply_to_message_id"] == 7
@@ -0,0 +1,128 @@
+import os
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("DYNAMODB_TABLE_NAME", "history")
+os.environ.setdefault("CONTEXT_LENGTH", "5")
+os.environ.setdefault("BOT_ID", "1")
+os.environ.setdefault("BOT_NAME", "test_bot")
+os.environ.setdefault("TELEGRAM_TOKEN", "token")
+os.environ.setdefault("FREQUENCY", "0")
+os.environ.setdefault("ALLOWED_CHATS", "-100")
+os.environ.setdefault("RESET_COMMAND", "reset")
+os.environ.setdefault("OPENAI_KEY", "key")
+os.environ.setdefault("TEMPERATURE", "1")
+os.environ.setdefault("MAX_TOKENS", "100")
+
+import json
+import random
+import threading
+import time
+
+import pytest
+
+import lambda_function
+import work_queue
+from work_queue import drain, sqliteQueue, workQueue
+
+
+def test_work_queue_is_abstract():
+    with pytest.raises(TypeError):
+        workQueue()
+
+
+def test_sqlite_queue_hands_out_one_update_per_chat_in_order():
+    queue = sqliteQueue(":memory:")
+    queue.put(1, {"n": 1})
+    queue.put(1, {"n": 2})
+    queue.put(2, {"n": 1})
+
+    first = queue.get()
+    assert (first["chat_id"], first["body"]) == (1, {"n": 1})
+    # The second update of chat 1 waits until the first one is done
+    other = queue.get()
+    assert (other["chat_id"], other["body"]) == (2, {"n": 1})
+    assert queue.get() is None
+
+    queue.ack(first)
+    second = queue.get()
+    assert (second["chat_id"], second["body"]) == (1, {"n": 2})
+    queue.ack(second)
+    queue.ack(other)
+    assert len(queue) == 0
+
+
+def test_sqlite_queue_retries_a_released_update_then_drops_it(monkeypatch):
+    monkeypatch.setattr(work_queue, "WORK_QUEUE_MAX_ATTEMPTS", 2)
+    queue = sqliteQueue(":memory:")
+    queue.put(1, {"n": 1})
+    queue.put(1, {"n": 2})
+
+    failing = queue.get()
+    queue.release(failing)
+    # A released update is handed out again before the later ones of its chat
+    retried = queue.get()
+    assert retried["body"] == {"n": 1}
+    queue.release(retried)
+    assert queue.get()["body"] == {"n": 2}
+
+
+def test_drain_keeps_the_order_of_each_chat():
+    queue = sqliteQueue(":memory:")
+    for n in range(10):
+        for chat_id in (1, 2, 3):
+            queue.put(chat_id, {"chat": chat_id, "n": n})
+    processed = {1: [], 2: [], 3: []}
+    running = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def handler(body):
+        with lock:
+            if body["chat"] in running:
+                overlaps.append(body)
+            running.add(body["chat"])
+        time.sleep(random.uniform(0, 0.005))
+        with lock:
+            running.discard(body["chat"])
+            processed[body["chat"]].append(body["n"])
+
+    assert drain(queue, handler, workers=4) == 30
+    assert overlaps == []
+    assert processed == {chat_id: list(range(10)) for chat_id in (1, 2, 3)}
+
+
+def _record(message_id, chat_id, body):
+    return {"messageId": message_id, "body": json.dumps(body), "attributes": {"MessageGroupId": str(chat_id)}}
+
+
+def test_worker_handler_returns_the_failed_update_and_the_rest_of_its_chat(monkeypatch):
+    processed = []
+
+    def process_queued(body):
+        if body["n"] == "a1":
+            raise RuntimeError("completion failed")
+        processed.append(body["n"])
+
+    monkeypatch.setattr(lambda_function.telegram_client, "process_queued", process_queued)
+    event = {"Records": [
+        _record("1", "a", {"n": "a1"}),
+        _record("2", "b", {"n": "b1"}),
+        _record("3", "a", {"n": "a2"}),
+        _record("4", "b", {"n": "b2"}),
+    ]}
+
+    result = lambda_function.worker_handler(event, None)
+
+    # a2 is redelivered after a1 instead of being answered before it
+    assert result == {"batchItemFailures": [{"itemIdentifier": "1"}, {"itemIdentifier": "3"}]}
+    assert processed == ["b1", "b2"]
+
+
+def test_sqlite_queue_on_lambda_warns(monkeypatch, capsys):
+    monkeypatch.setattr(work_queue, "sqliteQueue", lambda: sqliteQueue(":memory:"))
+    work_queue.create_work_queue()
+    assert capsys.readouterr().out == ""
+
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "bot")
+    assert isinstance(work_queue.create_work_queue(), sqliteQueue)
+    assert "[WARNING] WORK_QUEUE_BACKEND is sqlite on Lambda" in capsys.readouterr().out
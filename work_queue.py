@@ -0,0 +1,175 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from logger import get_logger
+
+WORK_QUEUE_BACKEND = os.environ.get('WORK_QUEUE_BACKEND', 'sqlite')
+WORK_QUEUE_URL = os.environ.get('WORK_QUEUE_URL')
+WORK_QUEUE_PATH = os.environ.get('WORK_QUEUE_PATH', '/tmp/work_queue.db')
+# Seconds a received update stays invisible to other workers before it is retried
+WORK_QUEUE_VISIBILITY_TIMEOUT = int(os.environ.get('WORK_QUEUE_VISIBILITY_TIMEOUT', '300'))
+WORK_QUEUE_MAX_ATTEMPTS = int(os.environ.get('WORK_QUEUE_MAX_ATTEMPTS', '3'))
+
+log = get_logger("queue")
+
+
+class workQueue(ABC):
+    """Queue of Telegram updates waiting to be processed
+
+    Updates of one chat are handed out one at a time and in the order they were
+    put, updates of different chats can be processed in parallel.
+    """
+
+    @abstractmethod
+    def put(self, chat_id: int, body: Dict[str, Any]) -> None:
+        """Add an update of a chat"""
+
+    @abstractmethod
+    def get(self) -> Optional[Dict[str, Any]]:
+        """Receive the next update as {"id", "chat_id", "body"}, or None if nothing is available"""
+
+    @abstractmethod
+    def ack(self, item: Dict[str, Any]) -> None:
+        """Remove a processed update"""
+
+    @abstractmethod
+    def release(self, item: Dict[str, Any]) -> None:
+        """Make a failed update available again"""
+
+
+class sqliteQueue(workQueue):
+    """Local queue backend, use ":memory:" for an in-process queue"""
+
+    def __init__(self, path: str = WORK_QUEUE_PATH) -> None:
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS updates ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id TEXT NOT NULL, body TEXT NOT NULL, "
+                "leased_until REAL, attempts INTEGER NOT NULL DEFAULT 0)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS updates_chat ON updates (chat_id, id)")
+
+    def put(self, chat_id: int, body: Dict[str, Any]) -> None:
+        with self.lock:
+            self.connection.execute("INSERT INTO updates (chat_id, body) VALUES (?, ?)", (str(chat_id), json.dumps(body)))
+
+    def get(self) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                # Only the oldest update of a chat can be received, and only if it is not leased
+                row = self.connection.execute(
+                    "SELECT id, chat_id, body FROM updates AS u "
+                    "WHERE (leased_until IS NULL OR leased_until < ?) "
+                    "AND NOT EXISTS (SELECT 1 FROM updates AS o WHERE o.chat_id = u.chat_id AND o.id < u.id) "
+                    "ORDER BY id LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row:
+                    self.connection.execute(
+                        "UPDATE updates SET leased_until = ?, attempts = attempts + 1 WHERE id = ?",
+                        (now + WORK_QUEUE_VISIBILITY_TIMEOUT, row[0]),
+                    )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        if not row:
+            return None
+        return {"id": row[0], "chat_id": int(row[1]), "body": json.loads(row[2])}
+
+    def ack(self, item: Dict[str, Any]) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM updates WHERE id = ?", (item["id"],))
+
+    def release(self, item: Dict[str, Any]) -> None:
+        with self.lock:
+            self.connection.execute("DELETE FROM updates WHERE id = ? AND attempts >= ?", (item["id"], WORK_QUEUE_MAX_ATTEMPTS))
+            self.connection.execute("UPDATE updates SET leased_until = NULL WHERE id = ?", (item["id"],))
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM updates").fetchone()[0]
+
+
+class sqsQueue(workQueue):
+    """SQS FIFO backend, the chat id is the message group so a chat is processed in order"""
+
+    def __init__(self, queue_url: str = WORK_QUEUE_URL) -> None:
+        import boto3
+        self.queue_url = queue_url
+        self.sqs = boto3.client('sqs')
+
+    def put(self, chat_id: int, body: Dict[str, Any]) -> None:
+        self.sqs.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps(body),
+            MessageGroupId=str(chat_id),
+            MessageDeduplicationId=str(body.get("update_id", time.time_ns())),
+        )
+
+    def get(self) -> Optional[Dict[str, Any]]:
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=1,
+            VisibilityTimeout=WORK_QUEUE_VISIBILITY_TIMEOUT,
+            AttributeNames=['MessageGroupId'],
+        )
+        messages = response.get('Messages', [])
+        if not messages:
+            return None
+        message = messages[0]
+        return {
+            "id": message['ReceiptHandle'],
+            "chat_id": int(message['Attributes']['MessageGroupId']),
+            "body": json.loads(message['Body']),
+        }
+
+    def ack(self, item: Dict[str, Any]) -> None:
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=item["id"])
+
+    def release(self, item: Dict[str, Any]) -> None:
+        self.sqs.change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=item["id"], VisibilityTimeout=0)
+
+
+def create_work_queue() -> workQueue:
+    if WORK_QUEUE_BACKEND == 'sqs':
+        return sqsQueue()
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        # The webhook and the worker run in different containers, each with its own /tmp
+        log.warning("WORK_QUEUE_BACKEND is %s on Lambda: updates queued in %s are only seen by this container "
+                    "and lost when it is recycled, set WORK_QUEUE_BACKEND=sqs", WORK_QUEUE_BACKEND, WORK_QUEUE_PATH)
+    return sqliteQueue()
+
+
+def drain(queue: workQueue, handler: Callable[[Dict[str, Any]], None], workers: int = 1) -> int:
+    """Process queued updates until the queue is empty, returns the number of processed updates"""
+    processed = []
+
+    def work():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            try:
+                handler(item["body"])
+            except Exception as e:
+                log.error("Could not process queued update %s: %s", item["id"], e)
+                queue.release(item)
+            else:
+                queue.ack(item)
+                processed.append(item["id"])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in range(workers):
+            executor.submit(work)
+    return len(processed)